@@ -37,6 +37,8 @@ config = configparser.ConfigParser()
 config.read(os.path.join(INSTALL_PATH, "configuration", "site.cfg"))
 
 VASP_POTENTIALS = config.get("VASP", "potential_path")
+PACK_STRUCTURES = config.getboolean("database", "pack_structures", fallback=False)
+ATOM_ROWS = config.getboolean("database", "atom_rows", fallback=True)
 
 if not os.path.exists(LOG_PATH):
     oldmask = os.umask(666)
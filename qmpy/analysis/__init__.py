@@ -1,9 +1,17 @@
 from .nearest_neighbors import *
+from .voronoi import VoronoiAnalysis
 from .miedema import *
-from .pdf import PDF
+from .pdf import PDF, PDFIndex, get_pdf_fingerprint, get_rdfs
 from .network import *
-from .xrd import XRD, Peak
+from .xrd import XRD, Peak, XRDIndex, bin_pattern, get_xrd_pattern
 from .griddata import GridData
 from .elastic import *
 from .interface_finder import *
 from .mining import *
+from .fingerprint import *
+from .bond_valence import (
+    assign_oxidation_states,
+    get_bond_valence_sums,
+    get_global_instability_index,
+    get_oxidation_states,
+)
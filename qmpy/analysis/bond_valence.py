@@ -2,25 +2,387 @@
 """
 Implementation of the Bond-Valence Sum method.
 
-Data sourced from: 
+The valence of a bond between a cation and an anion a distance R apart is
+exp((R0 - R)/B), and in a well formed ionic structure the valences of the
+bonds of each ion add up to its oxidation state. How far they are from
+doing so is measured by the global instability index, which is used to pick
+the most plausible charge balanced set of oxidation states of a structure.
+
+Data sourced from:
     http://www.iucr.org/resources/data/datasets/bond-valence-parameters
 """
 
-import numpy as np
+import itertools
 import logging
+from multiprocessing import Pool
+
+import numpy as np
+import yaml
 
 import qmpy
+from qmpy.utils import *
+from qmpy.analysis.nearest_neighbors import get_neighbor_list
+from qmpy.analysis.symmetry.routines import get_symmetry_dataset
 
 logger = logging.getLogger(__name__)
 
+PARAMS_PATH = qmpy.INSTALL_PATH + "/data/bond_valence/bond_valence_parameters.yml"
+
+# preferred sources, when there are several sets of parameters for a bond:
+# Brown and Altermatt (1985), then Brese and O'Keeffe (1991)
+REFERENCE_RANK = {"a": 0, "b": 1}
+
+# cation valence which stands for any valence in the parameter table
+ANY_VALENCE = 9
+
+# largest number of (assignments x bonds) evaluated at once
+CHUNK_SIZE = 2 ** 22
+
+_params = None
+_cation_valences = None
+_anion_valences = None
+
+
+def get_param_table():
+    """
+    Returns the table of bond valence parameters, a dict of
+    (cation, cation valence, anion, anion valence):(R0, B), read from the
+    data file on first use.
+
+    Where the file has several sets of parameters for the same bond, checked
+    ones are preferred over "unchecked" ones, then those from the preferred
+    references (see `REFERENCE_RANK`), then the first one listed. A cation
+    valence of 9 means the parameters hold for any valence.
+
+    Examples::
+
+        >>> get_param_table()[('Fe', 3, 'O', -2)]
+        (1.759, 0.37)
+
+    """
+    global _params, _cation_valences, _anion_valences
+    if _params is None:
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(PARAMS_PATH) as f:
+            rows = yaml.load(f, Loader=loader)
+        ranked = {}
+        cations, anions = {}, {}
+        for n, row in enumerate(rows):
+            key = (
+                row["A_species"],
+                row["A_valence"],
+                row["B_species"],
+                row["B_valence"],
+            )
+            rank = (
+                row["details"] == "unchecked",
+                REFERENCE_RANK.get(row["reference"], len(REFERENCE_RANK)),
+                n,
+            )
+            if key not in ranked or rank < ranked[key][0]:
+                params = (float(row["param_r0"]), float(row["param_B"]))
+                ranked[key] = (rank, params)
+            cation, cval, anion, aval = key
+            if 0 < cval < ANY_VALENCE:
+                cations.setdefault(cation, set()).add(cval)
+            if aval < 0:
+                anions.setdefault(anion, set()).add(aval)
+        _cation_valences = dict((k, sorted(v)) for k, v in cations.items())
+        _anion_valences = dict((k, sorted(v, reverse=True)) for k, v in anions.items())
+        _params = dict((k, v[1]) for k, v in ranked.items())
+    return _params
+
+
+def _lookup(cation, cval, anion, aval):
+    """(R0, B) of a cation-anion bond, or None if there are no parameters."""
+    params = get_param_table()
+    found = params.get((cation, cval, anion, aval))
+    if found is None:
+        found = params.get((cation, ANY_VALENCE, anion, aval))
+    return found
+
+
+def get_params(elt1, elt2, val1=None, val2=None):
+    """
+    Finds the bond valence parameters of a bond between `elt1` and `elt2`,
+    with oxidation states `val1` and `val2` if given. Either element can be
+    the cation.
+
+    Returns:
+        dict with "param_r0" and "param_B", or None if there are none.
+
+    Examples::
+
+        >>> get_params('O', 'Fe', -2, 3)
+        {'param_r0': 1.759, 'param_B': 0.37}
+
+    """
+    get_param_table()
+    for (cation, cval), (anion, aval) in [
+        ((elt1, val1), (elt2, val2)),
+        ((elt2, val2), (elt1, val1)),
+    ]:
+        if (cval is not None and cval <= 0) or (aval is not None and aval >= 0):
+            continue
+        cvals = [cval] if cval is not None else _cation_valences.get(cation, [])
+        avals = [aval] if aval is not None else _anion_valences.get(anion, [])
+        for cv, av in itertools.product(cvals, avals):
+            params = _lookup(cation, cv, anion, av)
+            if params is not None:
+                return {"param_r0": params[0], "param_B": params[1]}
+    return None
+
+
+def get_valence_candidates(element, elements):
+    """
+    Oxidation states `element` may take in a structure of `elements`: the
+    cation valences with parameters for a bond to one of the other elements
+    as an anion, followed by the anion valences with parameters for a bond
+    to one of them as a cation.
+
+    Examples::
+
+        >>> get_valence_candidates('Fe', ['Fe', 'O'])
+        [2, 3, 4, 6]
+
+    """
+    get_param_table()
+    others = [e for e in elements if e != element]
+    states = []
+    for cval in _cation_valences.get(element, []):
+        if any(
+            _lookup(element, cval, e, aval) is not None
+            for e in others
+            for aval in _anion_valences.get(e, [])
+        ):
+            states.append(cval)
+    for aval in _anion_valences.get(element, []):
+        if any(
+            _lookup(e, cval, element, aval) is not None
+            for e in others
+            for cval in _cation_valences.get(e, [])
+        ):
+            states.append(aval)
+    return states
+
+
+def _species_tables(species):
+    """
+    (S, S) arrays of R0 and B between the (element, oxidation state) pairs
+    `species`, nan where the pair is not a cation and an anion with known
+    parameters.
+    """
+    r0 = np.full((len(species), len(species)), np.nan)
+    b = np.full((len(species), len(species)), np.nan)
+    for p, (e1, v1) in enumerate(species):
+        for q, (e2, v2) in enumerate(species):
+            if not v1 > 0 > v2:
+                continue
+            params = _lookup(e1, int(v1), e2, int(v2))
+            if params is not None:
+                r0[p, q] = r0[q, p] = params[0]
+                b[p, q] = b[q, p] = params[1]
+    return r0, b
+
+
+def _valence_sums(codes, r0, b, neighbors, weights):
+    """
+    Bond valence sums of the atoms for each row of `codes`, the (K, N)
+    indices of the species of the atoms in the `_species_tables`.
+    """
+    i, j, distances = neighbors
+    k, n = codes.shape
+    ci, cj = codes[:, i], codes[:, j]
+    s = np.exp((r0[ci, cj] - distances) / b[ci, cj])
+    s = np.where(np.isnan(s), 0.0, s) * weights[j]
+    rows = (np.arange(k)[:, None] * n + i).ravel()
+    return np.bincount(rows, weights=s.ravel(), minlength=k * n).reshape(k, n)
+
+
+def _instability(sums, ox, weights):
+    """Global instability index of each row of `sums`, see
+    `get_global_instability_index`."""
+    deviations = (sums - abs(ox)) ** 2
+    return np.sqrt(deviations.dot(weights) / weights.sum())
 
-def get_params(elt1, elt2):
-    raise NotImplementedError
+
+def _bonds(structure, cutoff):
+    """(i, j, distances) of all pairs of atoms closer than `cutoff`."""
+    i, j, images, distances = get_neighbor_list(structure, cutoff)
+    bonds = distances > 1e-3
+    return i[bonds], j[bonds], distances[bonds]
+
+
+def get_bond_valence_sums(structure, oxidation_states=None, cutoff=5.0):
+    """
+    Computes the bond valence sum of every atom of `structure`: the total
+    valence of its bonds to the atoms of opposite oxidation state within
+    `cutoff`, weighted by their occupancies.
+
+    Keyword Arguments:
+        oxidation_states:
+            Oxidation state of each atom, by default those of the structure.
+            Atoms without one don't form bonds.
+
+    Returns:
+        numpy.ndarray of shape (natoms,).
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_NaCl')
+        >>> get_bond_valence_sums(s, [1, -1])
+        array([1.11..., 1.11...])
+
+    """
+    if oxidation_states is None:
+        oxidation_states = structure.oxidation_states
+    ox = np.nan_to_num(np.array(oxidation_states, dtype=float))
+    types = structure.atom_types
+    species = sorted(set(zip(types, ox)))
+    lookup = dict((s, n) for n, s in enumerate(species))
+    codes = np.array([[lookup[s] for s in zip(types, ox)]])
+    r0, b = _species_tables(species)
+    neighbors = _bonds(structure, cutoff)
+    return _valence_sums(codes, r0, b, neighbors, structure.occupancies)[0]
+
+
+def get_global_instability_index(structure, oxidation_states=None, cutoff=5.0):
+    """
+    Computes the global instability index of `structure`: the root mean
+    square difference between the bond valence sum and the magnitude of the
+    oxidation state of the atoms. Well formed ionic structures have values
+    below about 0.2.
+
+    See `get_bond_valence_sums` for the arguments.
+
+    """
+    if oxidation_states is None:
+        oxidation_states = structure.oxidation_states
+    ox = np.nan_to_num(np.array(oxidation_states, dtype=float))
+    sums = get_bond_valence_sums(structure, ox, cutoff=cutoff)
+    return float(_instability(sums[None], ox[None], structure.occupancies)[0])
+
+
+def _atom_classes(structure, symmetry=True, symprec=1e-3):
+    """
+    Index of the class of each atom, with the atoms of each element split
+    into symmetry orbits if `symmetry`.
+    """
+    classes = np.unique(structure.atom_types, return_inverse=True)[1]
+    if symmetry and len(structure.sites) == len(structure):
+        dataset = get_symmetry_dataset(structure, symprec=symprec)
+        if dataset:
+            orbits = np.array(dataset["equivalent_atoms"])
+            keys = np.column_stack([classes, orbits])
+            classes = np.unique(keys, axis=0, return_inverse=True)[1]
+    return np.asarray(classes).ravel()
+
+
+def assign_oxidation_states(
+    structure, cutoff=5.0, max_combinations=10 ** 5, symprec=1e-3
+):
+    """
+    Finds the charge balanced oxidation states of the atoms of `structure`
+    with the lowest global instability index.
+
+    Symmetrically equivalent atoms get the same oxidation state, each chosen
+    from the states of its element with bond valence parameters (see
+    `get_valence_candidates`). All combinations of them are enumerated and
+    the charge balanced ones are scored at once, from a single neighbor
+    list. If there are more than `max_combinations`, all atoms of an
+    element get the same oxidation state instead.
+
+    Returns:
+        numpy.ndarray of the oxidation state of each atom, or None if no
+        combination is charge balanced.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/fe3o4.cif')
+        >>> assign_oxidation_states(s)
+        array([ 3.,  3., ... -2., -2.])
+
+    """
+    types = structure.atom_types
+    weights = structure.occupancies
+    elements = sorted(set(types))
+    for symmetry in [True, False]:
+        classes = _atom_classes(structure, symmetry=symmetry, symprec=symprec)
+        nclasses = classes.max() + 1
+        first = np.unique(classes, return_index=True)[1]
+        candidates = [get_valence_candidates(types[k], elements) for k in first]
+        if not all(candidates):
+            return None
+        shape = [len(c) for c in candidates]
+        if np.prod(shape, dtype=float) <= max_combinations:
+            break
+    else:
+        logger.warning("Too many oxidation state combinations for %s", structure.name)
+        return None
+
+    species = []
+    for k, states in zip(first, candidates):
+        species += [(types[k], v) for v in states]
+    offsets = np.cumsum([0] + shape[:-1])
+    choices = np.indices(shape).reshape(nclasses, -1).T + offsets
+    states = np.array([v for e, v in species], dtype=float)
+    counts = np.bincount(classes, weights=weights, minlength=nclasses)
+    balanced = abs(states[choices].dot(counts)) < 1e-6 * len(structure)
+    choices = choices[balanced]
+    if not len(choices):
+        return None
+
+    r0, b = _species_tables(species)
+    neighbors = _bonds(structure, cutoff)
+    chunk = max(1, CHUNK_SIZE // max(len(neighbors[0]), len(structure)))
+    gii = np.empty(len(choices))
+    for start in range(0, len(choices), chunk):
+        codes = choices[start : start + chunk][:, classes]
+        sums = _valence_sums(codes, r0, b, neighbors, weights)
+        gii[start : start + chunk] = _instability(sums, states[codes], weights)
+    return states[choices[np.argmin(gii)]][classes]
+
+
+def get_oxidation_states(structures, processes=1, **kwargs):
+    """
+    Assigns the oxidation states (see `assign_oxidation_states`) of many
+    structures, without changing them.
+
+    Keyword Arguments:
+        processes:
+            Number of worker processes. If None, uses all available cpus.
+            Default=1
+        **kwargs: Passed on to `assign_oxidation_states`.
+
+    Returns:
+        List of arrays of oxidation states, or None where there is no charge
+        balanced assignment.
+
+    """
+    tasks = [(s, kwargs) for s in structures]
+    if processes != 1 and len(tasks) > 1:
+        # neither the neighbor list nor the symmetry queries the database
+        with Pool(processes) as pool:
+            return pool.map(
+                _assign_oxidation_states, tasks, chunksize=max(1, len(tasks) // 64)
+            )
+    return list(map(_assign_oxidation_states, tasks))
+
+
+def _assign_oxidation_states(args):
+    """Assigns the oxidation states of a structure, see
+    `get_oxidation_states`."""
+    structure, kwargs = args
+    try:
+        return assign_oxidation_states(structure, **kwargs)
+    except Exception:
+        logger.exception("Failed to assign oxidation states of %s", structure.name)
+        return None
 
 
 def v_ij(atom1, atom2, params=None):
     if params is None:
-        params = get_params(atom1.element_id, atom2.element_id)
+        params = get_params(atom1.element_id, atom2.element_id, atom1.ox, atom2.ox)
     if params is None:
         return None
     R = atom1.structure.get_distance(atom1, atom2)
@@ -40,7 +402,17 @@ def valence_sum(atom):
     return valence
 
 
-def total_valence_sum(structure):
-    structure.find_nearest_neighbors()
-    for atom in structure.atoms:
-        atom.charge = valence_sum(atom)
+def total_valence_sum(structure, cutoff=5.0):
+    """
+    Sets the charge of every atom of `structure` to its bond valence sum,
+    assigning oxidation states first if the structure has none.
+    """
+    ox = structure.oxidation_states
+    if np.isnan(ox).all():
+        ox = assign_oxidation_states(structure, cutoff=cutoff)
+        if ox is None:
+            return
+        structure.oxidation_states = ox
+    sums = get_bond_valence_sums(structure, ox, cutoff=cutoff)
+    for atom, charge in zip(structure.atoms, sums):
+        atom.charge = charge
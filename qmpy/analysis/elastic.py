@@ -1,9 +1,10 @@
+import itertools
 import numpy as np
+import numpy.linalg as la
 
 import qmpy
 from qmpy.utils import *
 
-# from . import symmetry.routines as routines
 from .symmetry import routines
 
 import logging
@@ -11,46 +12,412 @@ import logging
 logger = logging.getLogger(__name__)
 
 """
-Module to determine the necessary distortions for describing the full elastic
-tensor for an arbitrary input Structure.
+Module to determine the distortions needed to describe the full elastic
+tensor of an arbitrary input Structure, and to fit the tensor to the stresses
+calculated for the distorted structures.
 
-To do: need to convert the symmetry operations of a structure from the lattice
-basis to cartesian.
+Strains and stresses are 6-vectors in Voigt notation, ordered xx, yy, zz, yz,
+xz, xy, with engineering shear strains (e4 = 2*eps_yz). Elastic constants
+and stresses are in GPa.
 """
 
-vectors = [
-    [0.1, 0.0, 0.0],
-    [0.0, 0.1, 0.0],
-    [0.0, 0.0, 0.1],
-    [0.1, 0.1, 0.0],
-    [0.1, 0.0, 0.1],
-    [0.0, 0.1, 0.1],
+__all__ = [
+    "LAUE_CLASSES",
+    "ElasticTensor",
+    "get_laue_class",
+    "get_strain_set",
+    "get_deformations",
+    "get_unique_transforms",
 ]
 
+# Voigt index of each pair of cartesian indices
+VOIGT = np.array([[0, 5, 4], [5, 1, 3], [4, 3, 2]])
+VOIGT_PAIRS = [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]
 
-def get_unique_transforms(structure):
-    uniq_transforms = []
-
-    structure.symmetrize()
-    for mod in np.array(vectors):
-        found = False
-        mod = mod + 1
-        cell = structure.cell * mod
-        print("right")
-        print(cell)
-        print("tests:")
-        for trans, cell2 in uniq_transforms:
-            for rotation in structure.rotations:
-                test = rotation.dot(cell2)
-                if np.allclose(cell, test):
-                    found = True
-                    print(test)
-                    print("FOUND")
-                    break
-            if found:
-                break
-
-        if not found:
-            uniq_transforms.append([mod, cell])
-
-    return uniq_transforms
+# order of the stresses stored by Calculation (xx, yy, zz, xy, yz, zx), in
+# Voigt order
+CALCULATION_ORDER = [0, 1, 2, 4, 5, 3]
+
+# point group:Laue class
+LAUE_CLASSES = {
+    "1": "-1",
+    "-1": "-1",
+    "2": "2/m",
+    "m": "2/m",
+    "2/m": "2/m",
+    "222": "mmm",
+    "mm2": "mmm",
+    "mmm": "mmm",
+    "4": "4/m",
+    "-4": "4/m",
+    "4/m": "4/m",
+    "422": "4/mmm",
+    "4mm": "4/mmm",
+    "-42m": "4/mmm",
+    "4/mmm": "4/mmm",
+    "3": "-3",
+    "-3": "-3",
+    "32": "-3m",
+    "3m": "-3m",
+    "-3m": "-3m",
+    "6": "6/m",
+    "-6": "6/m",
+    "6/m": "6/m",
+    "622": "6/mmm",
+    "6mm": "6/mmm",
+    "-6m2": "6/mmm",
+    "6/mmm": "6/mmm",
+    "23": "m-3",
+    "m-3": "m-3",
+    "432": "m-3m",
+    "-43m": "m-3m",
+    "m-3m": "m-3m",
+}
+
+# candidate strain states: the six unit strains, then the sums of two
+CANDIDATE_STRAINS = np.array(
+    list(np.eye(6))
+    + [np.eye(6)[i] + np.eye(6)[j] for i, j in itertools.combinations(range(6), 2)]
+)
+
+
+def voigt_to_tensor(C):
+    """Converts (..., 6, 6) Voigt matrices to (..., 3, 3, 3, 3) tensors."""
+    C = np.asarray(C)
+    return C[..., VOIGT[:, :, None, None], VOIGT[None, None, :, :]]
+
+
+def tensor_to_voigt(C):
+    """Converts (..., 3, 3, 3, 3) tensors to (..., 6, 6) Voigt matrices."""
+    i, j = np.array(VOIGT_PAIRS).T
+    C = np.asarray(C)
+    return C[..., i[:, None], j[:, None], i[None, :], j[None, :]]
+
+
+def strain_matrix(strain):
+    """Converts Voigt strains of shape (..., 6) to (..., 3, 3) matrices."""
+    strain = np.asarray(strain, dtype=float)
+    scale = np.array([1, 1, 1, 0.5, 0.5, 0.5])
+    return (strain * scale)[..., VOIGT]
+
+
+def get_cartesian_rotations(structure, symprec=1e-3):
+    """
+    Point group operations of the crystal of `structure` as cartesian
+    rotation matrices, an (N, 3, 3) array. These are taken from the
+    standardized cell, so a supercell whose lattice is less symmetric than
+    the crystal still gets every operation.
+    """
+    dataset = routines.get_symmetry_dataset(structure, symprec=symprec)
+    if dataset is None:
+        return np.eye(3)[None]
+    ops = routines.get_symmetry_from_database(dataset["hall_number"])
+    rotations = np.unique(np.array(ops["rotations"]), axis=0)
+    p = np.transpose(dataset["std_lattice"])
+    rotations = np.einsum("ij,njk,kl->nil", p, rotations, la.inv(p))
+    # back to the orientation of the input cell
+    q = np.array(dataset["std_rotation_matrix"])
+    rotations = np.einsum("ji,njk,kl->nil", q, rotations, q)
+    # the nearest orthogonal matrices, as the cell may only be symmetric to
+    # within `symprec`
+    u, s, vt = la.svd(rotations)
+    return np.einsum("nij,njk->nik", u, vt)
+
+
+def get_laue_class(structure, symprec=1e-3):
+    """
+    Laue class of `structure`, e.g. 'm-3m' for a cubic structure with full
+    point symmetry, or None if spglib can not determine the symmetry.
+    """
+    dataset = routines.get_symmetry_dataset(structure, symprec=symprec)
+    if dataset is None:
+        return None
+    return LAUE_CLASSES.get(dataset["pointgroup"].strip())
+
+
+def get_symmetric_basis(structure, symprec=1e-3, tol=1e-6):
+    """
+    Basis of the elastic tensors compatible with the point symmetry of
+    `structure`, found by averaging each of the 21 independent components of
+    a general tensor over the point group.
+
+    Returns:
+        (K, 6, 6) array of Voigt matrices, where K is the number of
+        independent elastic constants (3 for cubic, 21 for triclinic).
+
+    """
+    rotations = get_cartesian_rotations(structure, symprec=symprec)
+    pairs = [(i, j) for i in range(6) for j in range(i, 6)]
+    units = np.zeros((len(pairs), 6, 6))
+    for n, (i, j) in enumerate(pairs):
+        units[n, i, j] = units[n, j, i] = 1
+    tensors = voigt_to_tensor(units)
+    average = np.einsum(
+        "gia,gjb,gkc,gld,nabcd->nijkl",
+        rotations,
+        rotations,
+        rotations,
+        rotations,
+        tensors,
+        optimize=True,
+    ) / len(rotations)
+    i, j = np.triu_indices(6)
+    vectors = tensor_to_voigt(average)[:, i, j]
+    u, s, vt = la.svd(vectors)
+    vt = vt[s > tol * s.max()]
+    basis = np.zeros((len(vt), 6, 6))
+    basis[:, i, j] = vt
+    basis[:, j, i] = vt
+    return basis
+
+
+def _design_matrix(basis, strains):
+    """
+    Linear map from the coefficients of `basis` to the stresses caused by
+    each of `strains`, an (N * 6, K) array.
+    """
+    return np.einsum("kij,nj->nik", basis, strains).reshape(-1, len(basis))
+
+
+def get_strain_set(structure, symprec=1e-3):
+    """
+    Finds a smallest set of strain states which determines every independent
+    elastic constant of `structure`.
+
+    The strains are chosen greedily among the unit Voigt strains and their
+    pairwise sums, taking at each step the state which determines the most
+    new combinations of the symmetry-allowed constants (and, of those, the
+    best conditioned one), until all are determined. Strain states related
+    by a symmetry operation never determine anything new, so the set has a
+    single member of each family, e.g. one state for a cubic structure and
+    two for a hexagonal one.
+
+    Returns:
+        (M, 6) array of Voigt strain states.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> get_strain_set(s)
+        array([[1., 0., 0., 1., 0., 0.]])
+
+    """
+    basis = get_symmetric_basis(structure, symprec=symprec)
+    chosen = []
+    rank = 0
+    while rank < len(basis):
+        best = None
+        for strain in CANDIDATE_STRAINS:
+            s = la.svd(_design_matrix(basis, np.array(chosen + [strain])))[1]
+            r = np.sum(s > 1e-8 * s.max())
+            score = (r, s[r - 1])
+            if best is None or score > best[0]:
+                best = (score, strain)
+        if best[0][0] == rank:
+            break
+        rank = best[0][0]
+        chosen.append(best[1])
+    return np.array(chosen)
+
+
+def get_deformations(structure, magnitudes=(-0.01, -0.005, 0.005, 0.01), symprec=1e-3):
+    """
+    Deformed copies of `structure`, one for each magnitude of each strain
+    state of :func:`get_strain_set`, to be used as the inputs of fixed cell
+    calculations whose stresses determine the elastic tensor.
+
+    The atoms keep their fractional coordinates.
+
+    Returns:
+        List of (Voigt strain, Structure) pairs.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> [strain for strain, deformed in get_deformations(s)]
+        [array([-0.01, 0., 0., -0.01, 0., 0.]), ..., array([0.01, ...])]
+
+    """
+    deformations = []
+    for state in get_strain_set(structure, symprec=symprec):
+        for magnitude in magnitudes:
+            strain = state * magnitude
+            deformed = structure.copy()
+            deformed.cell = structure.cell.dot(np.eye(3) + strain_matrix(strain))
+            deformations.append((strain, deformed))
+    return deformations
+
+
+def get_unique_transforms(structure, magnitude=0.01, symprec=1e-3):
+    """
+    Deformation gradients of the symmetry-inequivalent strain states of
+    `structure` (see :func:`get_strain_set`) at `magnitude`.
+
+    Returns:
+        List of (deformation gradient, deformed cell) pairs.
+
+    """
+    transforms = []
+    for state in get_strain_set(structure, symprec=symprec):
+        F = np.eye(3) + strain_matrix(state * magnitude)
+        transforms.append([F, structure.cell.dot(F)])
+    return transforms
+
+
+def get_strains(reference, cells):
+    """
+    Green-Lagrange strains, in Voigt notation, of each of `cells` relative to
+    the cell of `reference`, an (N, 6) array.
+    """
+    cells = np.asarray(cells, dtype=float)
+    F = la.solve(reference.cell[None], cells).transpose(0, 2, 1)
+    E = (np.einsum("nki,nkj->nij", F, F) - np.eye(3)) / 2
+    i, j = np.array(VOIGT_PAIRS).T
+    return E[:, i, j] * np.array([1, 1, 1, 2, 2, 2])
+
+
+class ElasticTensor(object):
+    """
+    Elastic stiffness tensor of a crystal, with the moduli derived from it.
+
+    Attributes:
+        voigt: Elastic constants, (6, 6) numpy.ndarray in GPa.
+        residual_stress: Stress of the undeformed structure (GPa), found by
+        the fit.
+        residuals: Root mean square error of the fitted stresses (GPa).
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> strains = [strain for strain, deformed in get_deformations(s)]
+        >>> et = ElasticTensor.from_stresses(s, strains, stresses)
+        >>> et.bulk_modulus, et.shear_modulus
+        (136.66..., 48.33...)
+
+    """
+
+    def __init__(self, voigt, residual_stress=None, residuals=None):
+        self.voigt = np.array(voigt, dtype=float)
+        self.residual_stress = residual_stress
+        self.residuals = residuals
+
+    def __str__(self):
+        return "\n".join(" ".join("%8.2f" % c for c in row) for row in self.voigt)
+
+    @classmethod
+    def from_stresses(cls, structure, strains, stresses, symprec=1e-3):
+        """
+        Fits the symmetry-allowed elastic constants of `structure` to the
+        `stresses` (N x 6, GPa, Voigt order) caused by `strains` (N x 6), in a
+        single least squares problem. The residual stress of the undeformed
+        structure is fit along with the constants.
+        """
+        strains = np.asarray(strains, dtype=float).reshape(-1, 6)
+        stresses = np.asarray(stresses, dtype=float).reshape(-1, 6)
+        basis = get_symmetric_basis(structure, symprec=symprec)
+        A = _design_matrix(basis, strains)
+        A = np.hstack([A, np.tile(np.eye(6), (len(strains), 1))])
+        solution, residuals, rank, s = la.lstsq(A, stresses.ravel(), rcond=None)
+        if rank < A.shape[1]:
+            logger.warn(
+                "Strains determine %d of %d elastic constants" % (rank - 6, len(basis))
+            )
+        rms = np.sqrt(np.mean((A.dot(solution) - stresses.ravel()) ** 2))
+        voigt = np.einsum("k,kij->ij", solution[: len(basis)], basis)
+        return cls(voigt, residual_stress=solution[len(basis) :], residuals=rms)
+
+    @classmethod
+    def from_calculations(cls, structure, calculations, symprec=1e-3):
+        """
+        Fits the elastic constants of `structure` to the stresses of fixed
+        cell `calculations` of its deformations (see
+        :func:`get_deformations`). The strains are recovered from the input
+        cell of each calculation, and the stresses (in kB, positive under
+        compression, as written by VASP) are taken from its output.
+        """
+        calculations = [c for c in calculations if c.converged]
+        cells = [c.input.cell for c in calculations]
+        stresses = np.array([c.output.stresses for c in calculations], dtype=float)
+        stresses = -0.1 * stresses[:, CALCULATION_ORDER]
+        strains = get_strains(structure, cells)
+        return cls.from_stresses(structure, strains, stresses, symprec=symprec)
+
+    @property
+    def compliance(self):
+        """Elastic compliance, (6, 6) numpy.ndarray in 1/GPa."""
+        return la.inv(self.voigt)
+
+    @property
+    def bulk_voigt(self):
+        C = self.voigt
+        return (C[0, 0] + C[1, 1] + C[2, 2] + 2 * (C[0, 1] + C[1, 2] + C[0, 2])) / 9
+
+    @property
+    def bulk_reuss(self):
+        S = self.compliance
+        return 1 / (S[0, 0] + S[1, 1] + S[2, 2] + 2 * (S[0, 1] + S[1, 2] + S[0, 2]))
+
+    @property
+    def shear_voigt(self):
+        C = self.voigt
+        normal = C[0, 0] + C[1, 1] + C[2, 2]
+        off = C[0, 1] + C[1, 2] + C[0, 2]
+        return (normal - off + 3 * (C[3, 3] + C[4, 4] + C[5, 5])) / 15
+
+    @property
+    def shear_reuss(self):
+        S = self.compliance
+        normal = S[0, 0] + S[1, 1] + S[2, 2]
+        off = S[0, 1] + S[1, 2] + S[0, 2]
+        return 15 / (4 * normal - 4 * off + 3 * (S[3, 3] + S[4, 4] + S[5, 5]))
+
+    @property
+    def bulk_modulus(self):
+        """Voigt-Reuss-Hill bulk modulus (GPa)."""
+        return (self.bulk_voigt + self.bulk_reuss) / 2
+
+    @property
+    def shear_modulus(self):
+        """Voigt-Reuss-Hill shear modulus (GPa)."""
+        return (self.shear_voigt + self.shear_reuss) / 2
+
+    @property
+    def youngs_modulus(self):
+        """Isotropic Young's modulus from the Hill averages (GPa)."""
+        K, G = self.bulk_modulus, self.shear_modulus
+        return 9 * K * G / (3 * K + G)
+
+    @property
+    def poisson_ratio(self):
+        """Isotropic Poisson's ratio from the Hill averages."""
+        K, G = self.bulk_modulus, self.shear_modulus
+        return (3 * K - 2 * G) / (2 * (3 * K + G))
+
+    @property
+    def universal_anisotropy(self):
+        """Universal anisotropy index, 0 for an isotropic tensor."""
+        return (
+            5 * self.shear_voigt / self.shear_reuss
+            + self.bulk_voigt / self.bulk_reuss
+            - 6
+        )
+
+    @property
+    def is_stable(self):
+        """True if the tensor is positive definite (Born stability)."""
+        return bool(np.all(la.eigvalsh(self.voigt) > 0))
+
+    def debye_temperature(self, structure):
+        """
+        Debye temperature of `structure` from the Hill averaged moduli, see
+        :func:`qmpy.analysis.thermodynamics.debye_temperature`.
+        """
+        from qmpy.analysis.thermodynamics.debye import debye_temperature
+
+        mass = np.mean([atom.element.mass for atom in structure])
+        return debye_temperature(
+            structure.get_volume() / len(structure),
+            mass,
+            self.bulk_modulus,
+            self.shear_modulus,
+        )
@@ -0,0 +1,216 @@
+# qmpy/analysis/fingerprint.py
+
+"""
+Cheap structure fingerprints, used to narrow the candidates for a full
+:meth:`~qmpy.Structure.compare` when searching for duplicate structures.
+
+A fingerprint is a string of the form::
+
+    <key>|<shape>
+
+where the key is made of discrete invariants of the primitive cell, which
+must be identical for two structures to match, and the shape is a list of
+scale invariant lattice descriptors which are compared within a tolerance.
+Since matching keys are string prefixes, candidates can be looked up with an
+indexed ``fingerprint__startswith`` query, and whole sets of structures can be
+grouped by key before comparing them (see :func:`cluster_structures`).
+
+"""
+
+import hashlib
+import itertools
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+import numpy.linalg as la
+
+import qmpy
+from qmpy.utils import *
+
+logger = logging.getLogger(__name__)
+
+
+def get_fingerprint(structure, shell=1.25):
+    """
+    Computes the fingerprint of `structure`.
+
+    The key contains:
+
+    - the reduced composition
+    - the number of atoms in the primitive cell
+    - a hash of the first coordination shell of every atom: the number of
+      neighbors of each element within `shell` times the shortest
+      interatomic distance
+
+    The shape contains the sorted length ratios b/a and c/a of the reduced
+    primitive cell, its sorted angles (folded into [0, 90] degrees, so type I
+    and type II cells agree) and its volume normalized by a*b*c.
+
+    The spacegroup is not part of the key, since slightly distorted copies
+    of a structure, which :meth:`~qmpy.Structure.compare` accepts, can be
+    assigned a subgroup of its spacegroup.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> get_fingerprint(s)
+        'Fe:1:27cf5d6cd8bd|1.00000 1.00000 60.00000 60.00000 60.00000 0.70711'
+
+    """
+    s = structure.copy()
+    s.make_primitive()
+    s.reduce()
+
+    key = "%s:%d:%s" % (
+        format_comp(reduce_comp(s.comp)),
+        len(s),
+        _shell_hash(s, shell),
+    )
+
+    a, b, c, alpha, beta, gamma = s.lat_params
+    a, b, c = sorted([a, b, c])
+    angles = sorted(min(x, 180 - x) for x in [alpha, beta, gamma])
+    shape = [b / a, c / a] + angles + [s.get_volume() / (a * b * c)]
+    return "%s|%s" % (key, " ".join("%.5f" % x for x in shape))
+
+
+def _shell_hash(structure, shell):
+    """Hash of the element resolved first coordination shell of each atom."""
+    cart = structure.cartesian_coords
+    images = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+    images = images.dot(structure.cell)
+    vecs = cart[None, :, None, :] + images[None, None, :, :] - cart[:, None, None, :]
+    dists = la.norm(vecs, axis=-1)
+    dists[dists < 1e-3] = np.inf
+    cutoff = shell * dists.min()
+
+    types = structure.atom_types
+    shells = []
+    for i, elt in enumerate(types):
+        counts = (dists[i] < cutoff).sum(axis=1)
+        neighbors = {}
+        for other, count in zip(types, counts):
+            neighbors[other] = neighbors.get(other, 0) + int(count)
+        shells.append((elt, tuple(sorted(neighbors.items()))))
+    text = repr(sorted(shells)).encode()
+    return hashlib.md5(text).hexdigest()[:12]
+
+
+def parse_fingerprint(fingerprint):
+    """
+    Splits a fingerprint into its key and its shape array.
+
+    Examples::
+
+        >>> parse_fingerprint('Fe:1:27cf5d6cd8bd|1.0 1.0 60.0 60.0 60.0 0.7')
+        ('Fe:1:27cf5d6cd8bd', array([ 1. ,  1. , 60. , 60. , 60. ,  0.7]))
+
+    """
+    key, shape = fingerprint.split("|")
+    return key, np.array(shape.split(), dtype=float)
+
+
+def fingerprints_match(fp1, fp2, tol=1e-2):
+    """
+    Tests whether two fingerprints could belong to the same structure.
+
+    The keys must be identical and every shape descriptor must agree to
+    within twice the relative tolerance `tol` used by
+    :meth:`~qmpy.Structure.compare`.
+
+    """
+    key1, shape1 = parse_fingerprint(fp1)
+    key2, shape2 = parse_fingerprint(fp2)
+    if key1 != key2:
+        return False
+    diff = abs(shape1 - shape2) / np.maximum(np.minimum(shape1, shape2), 1e-8)
+    return bool(np.all(diff <= 2 * tol))
+
+
+def cluster_structures(structures, tol=1e-2, processes=1, **kwargs):
+    """
+    Groups `structures` into classes of equivalent structures.
+
+    Structures are first bucketed by fingerprint key. Within a bucket, each
+    structure is compared (with :meth:`~qmpy.Structure.compare`) to the
+    first member of every class found so far whose fingerprint shape
+    matches, and starts a new class if none match. Fingerprints which are
+    missing are computed and stored on the structures.
+
+    Arguments:
+        structures: List of :mod:`~qmpy.Structure` objects.
+
+    Keyword Arguments:
+        tol: Tolerance passed to `fingerprints_match` and `compare`.
+        processes:
+            Number of worker processes used to fingerprint the structures and
+            to compare the buckets. If None, uses all available cpus. Default=1
+        **kwargs: Passed on to `compare`.
+
+    Returns:
+        List of lists of indices into `structures`, one per class, ordered by
+        their first index.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> s2 = io.read(INSTALL_PATH+'/io/files/POSCAR_BCC')
+        >>> cluster_structures([s, s2, s.copy()])
+        [[0, 2], [1]]
+
+    """
+    structures = list(structures)
+    pool = None
+    if processes != 1 and len(structures) > 1:
+        # forked workers inherit the database connections, but neither
+        # fingerprinting nor comparing structures queries the database
+        pool = Pool(processes)
+    try:
+        mapper = pool.map if pool else map
+        missing = [s for s in structures if not s.fingerprint]
+        for s, fp in zip(missing, mapper(get_fingerprint, missing)):
+            s.fingerprint = fp
+
+        buckets = {}
+        for i, s in enumerate(structures):
+            key = parse_fingerprint(s.fingerprint)[0]
+            buckets.setdefault(key, []).append(i)
+        buckets = sorted(list(buckets.values()), key=len, reverse=True)
+        tasks = [
+            ([structures[i] for i in bucket], tol, kwargs)
+            for bucket in buckets
+            if len(bucket) > 1
+        ]
+        results = iter(mapper(_cluster_bucket, tasks))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    clusters = []
+    for bucket in buckets:
+        if len(bucket) == 1:
+            clusters.append(bucket)
+            continue
+        for cluster in next(results):
+            clusters.append([bucket[i] for i in cluster])
+    return sorted(clusters)
+
+
+def _cluster_bucket(args):
+    """Clusters structures with the same fingerprint key, see
+    `cluster_structures`."""
+    structures, tol, kwargs = args
+    clusters = []
+    for i, s in enumerate(structures):
+        for cluster in clusters:
+            rep = structures[cluster[0]]
+            if not fingerprints_match(s.fingerprint, rep.fingerprint, tol=tol):
+                continue
+            if rep.compare(s, tol=tol, **kwargs):
+                cluster.append(i)
+                break
+        else:
+            clusters.append([i])
+    return clusters
@@ -2,9 +2,13 @@
 
 import numpy as np
 import numpy.linalg as la
+from scipy import ndimage
 import qmpy.utils as utils
 import itertools
 
+# offsets of a grid point and its 26 neighbors
+NEIGHBORS = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+
 
 class GridData:
     """
@@ -17,8 +21,8 @@ class GridData:
         """
         Arguments:
             data: M x N x O sequence of data.
-            mesh: 
-            spacing: 
+            mesh:
+            spacing:
         """
         self.data = np.array(data)
         self.grads = np.gradient(data)
@@ -28,6 +32,7 @@ class GridData:
             lattice = np.eye(3)
         self.lattice = lattice
         self.inv = la.inv(lattice)
+        self._coefficients = {}
 
     def ind_to_cart(self, ind):
         """
@@ -42,142 +47,189 @@ class GridData:
         return utils.wrap(self.spacing * ind)
 
     def cart_to_coord(self, cart):
-        return utils.wrap(np.dot(self.inv.T, cart))
+        return utils.wrap(np.dot(cart, self.inv))
 
-    def interpolate(self, point, cart=False):
+    def interpolate(self, point, cart=False, order=1):
         """
-        Calculates the value at `point` using trilinear interpolation.
+        Calculates the value at `point`, or at each of an array of points,
+        treating the data as periodic.
 
         Arguments:
-            point: point to evaluate the value at.
+            point: point, or (M, 3) array of points, to evaluate the value at.
 
         Keyword Arguments:
             cart: If True, the point is taken as a cartesian coordinate. If
-            not, it is assumed to be in fractional coordinates. default=False. 
+            not, it is assumed to be in fractional coordinates. default=False.
+
+            order: 1 for trilinear interpolation, 2 to 5 for a spline of that
+            order. default=1.
+
+        Returns:
+            The value at `point`, or an array of M values.
+
         """
+        points = np.asarray(point, dtype=float)
+        single = points.ndim == 1
+        points = points.reshape(-1, 3)
         if cart:
-            point = self.cart_to_coord(point)
-        point = utils.wrap(point)
-
-        x0, y0, z0 = (
-            int(np.floor(point[0] * self.mesh[0])),
-            int(np.floor(point[1] * self.mesh[1])),
-            int(np.floor(point[2] * self.mesh[2])),
-        )
-        x, y, z = (
-            (point[0] * self.mesh[0]) % 1,
-            (point[1] * self.mesh[1]) % 1,
-            (point[2] * self.mesh[2]) % 1,
-        )
-        x1, y1, z1 = (
-            (x0 + 1) % self.mesh[0],
-            (y0 + 1) % self.mesh[1],
-            (z0 + 1) % self.mesh[2],
-        )
-        interp_val = (
-            self.data[x0, y0, z0] * (1 - x) * (1 - y) * (1 - z)
-            + self.data[x1, y0, z0] * x * (1 - y) * (1 - z)
-            + self.data[x0, y1, z0] * (1 - x) * y * (1 - z)
-            + self.data[x0, y0, z1] * (1 - x) * (1 - y) * z
-            + self.data[x1, y1, z0] * x * y * (1 - z)
-            + self.data[x1, y0, z1] * x * (1 - y) * z
-            + self.data[x0, y1, z1] * (1 - x) * y * z
-            + self.data[x1, y1, z1] * x * y * z
+            points = points.dot(self.inv)
+        scaled = (points % 1.0) * self.mesh
+
+        coefficients = self.data
+        if order > 1:
+            if order not in self._coefficients:
+                self._coefficients[order] = ndimage.spline_filter(
+                    self.data, order=order, mode="grid-wrap"
+                )
+            coefficients = self._coefficients[order]
+        values = ndimage.map_coordinates(
+            coefficients, scaled.T, order=order, mode="grid-wrap", prefilter=False
         )
-        return interp_val
+
+        if single:
+            return values[0]
+        return values
 
     def local_min(self, index):
         """
-        Starting from `index` find the local value minimum.
+        Starting from `index` find the local value minimum, by moving to the
+        lowest of the 26 neighboring grid points until none is lower.
 
         Returns:
             index: shape (3,) index of local minimum.
             value: Value of grid at the local minimum.
 
         """
-        ## TODO: support inputs of 'coord' or 'cart'
+        index = np.array(index) % self.mesh
+        value = self.data[tuple(index)]
+        while True:
+            neighbors = (index + NEIGHBORS) % self.mesh
+            values = self.data[tuple(neighbors.T)]
+            lowest = np.argmin(values)
+            if values[lowest] >= value:
+                return index, value
+            index, value = neighbors[lowest], values[lowest]
 
-        neighbors = list(itertools.permutations([-1, 0, 1], r=3))
-        neighbors = [np.array(index) + n for n in neighbors]
-        neighbors = [n % self.mesh for n in neighbors]
-        values = [self.data[tuple(n)] for n in neighbors]
-        print(values)
+    def local_minima(self):
+        """
+        Finds every grid point whose value is no larger than that of any of
+        its 26 neighbors.
 
-        lowest = np.argsort(values)[0]
-        print(lowest)
-        if values[lowest] < self.data[tuple(index)]:
-            return self.local_min(neighbors[lowest])
-        return index, self.data[tuple(index)]
+        Returns:
+            (K, 3) array of indices.
+
+        """
+        minimum = np.ones(self.data.shape, dtype=bool)
+        for shift in NEIGHBORS:
+            if shift.any():
+                minimum &= self.data <= np.roll(self.data, shift, axis=(0, 1, 2))
+        return np.argwhere(minimum)
+
+    def refine_min(self, point, cart=False, order=1, tol=1e-4):
+        """
+        Starting from `point`, find the local minimum of the interpolated
+        values, by moving to the lowest of the 26 neighbors one step away,
+        and halving the step (initially the grid spacing) when none is lower,
+        until it is smaller than `tol` (fractional).
+
+        Returns:
+            coord: shape (3,) fractional coordinate of the minimum.
+            value: Interpolated value at the minimum.
+
+        """
+        point = np.array(point, dtype=float)
+        if cart:
+            point = self.cart_to_coord(point)
+        value = self.interpolate(point, order=order)
+        step = self.spacing.copy()
+        while step.max() > tol:
+            candidates = point + NEIGHBORS * step
+            values = self.interpolate(candidates, order=order)
+            lowest = np.argmin(values)
+            if values[lowest] < value:
+                point, value = candidates[lowest], values[lowest]
+            else:
+                step /= 2
+        return utils.wrap(point), value
 
     def find_min_coord(self, N=1):
         """
-        Find the `N` lowest valued indices.
-        """
-        coords = []
-        coord_vector = self.data.flatten()
-        sorted_inds = list(coord_vector.argsort())
-        count = 0
-        while N > 0:
-            min_ind = unravel_index(sorted_inds[count], self.mesh)
-            count += 1
-            if (
-                self.local_min(min_ind)
-                and self.data[min_ind[0], min_ind[1], min_ind[2]] > 0
-            ):
-                coords.append(np.array(min_ind) * self.spacing)
-                N -= 1
-        return coords
-
-    def path(self, origin, end):
+        Find the coordinates of the `N` lowest valued local minima with a
+        positive value.
+        """
+        minima = self.local_minima()
+        values = self.data[tuple(minima.T)]
+        minima, values = minima[values > 0], values[values > 0]
+        order = np.argsort(values, kind="stable")[:N]
+        return [ind * self.spacing for ind in minima[order]]
+
+    def integrate(self, center=None, radius=None, cart=False, density=2):
+        """
+        Integrates the data over the unit cell or, if `center` and `radius`
+        are given, over a sphere of `radius` (in Angstroms) around `center`.
+
+        The sphere is sampled by a cubic grid of points `density` times finer
+        than the data, at which the values are interpolated. Points within
+        half a step of the surface are weighted by the fraction of their
+        volume which is (roughly) inside the sphere.
+
+        Keyword Arguments:
+            cart: If True, `center` is taken as a cartesian coordinate.
+        """
+        if center is None:
+            return self.data.mean() * abs(la.det(self.lattice))
+
+        step = min(la.norm(self.lattice, axis=1) / self.mesh) / density
+        n = int(np.ceil(radius / step + 0.5))
+        offsets = np.arange(-n, n + 1) * step
+        offsets = np.stack(np.meshgrid(offsets, offsets, offsets), axis=-1)
+        offsets = offsets.reshape(-1, 3)
+        weights = np.clip((radius - la.norm(offsets, axis=1)) / step + 0.5, 0, 1)
+        offsets, weights = offsets[weights > 0], weights[weights > 0]
+        if not cart:
+            center = np.dot(center, self.lattice)
+        values = self.interpolate(center + offsets, cart=True)
+        return values.dot(weights) * step ** 3
+
+    def path(self, origin, end, npoints=50, cart=False):
         """
         Gets a 1D array of values for a line connecting `origin` and `end`.
+
+        Returns:
+            List of (fraction of the path, value) pairs.
+
         """
-        path_dens = []
-        origin = np.array([float(i) for i in origin])
-        end = np.array([float(i) for i in end])
-        result = []
-        for i in np.mgrid[0:1:50j]:
-            point = (1 - i) * origin + i * end
-            result.append((i, self.interpolate(point)))
-        return result
+        fractions = np.linspace(0, 1, npoints)
+        points = np.outer(1 - fractions, origin) + np.outer(fractions, end)
+        return list(zip(fractions, self.interpolate(points, cart=cart)))
 
-    def slice(self, point, orientation):
+    def slice(self, point, orientation, res=None):
         """
         Return a 2D array of values for a slice through the GridData passing
         through `point` with normal vector `orientation`.
+
+        The slice is sampled on a `res` x `res` grid of two fractional
+        coordinates, and `slice_coords` holds the third coordinate (the last
+        one along which `orientation` is nonzero) of each sample. By default,
+        `res` is a third of the largest mesh dimension.
+
         """
-        res = int(max(self.mesh) / 3.0)
-        orientation = [float(x) for x in orientation]
-        point = [float(x) for x in point]
-        slice_vals = np.zeros((res, res))
-        slice_coords = np.zeros((res, res))
-        a, b, c = orientation
-        x0, y0, z0 = point
+        if res is None:
+            res = int(max(self.mesh) / 3.0)
+        a, b, c = [float(x) for x in orientation]
+        x0, y0, z0 = [float(x) for x in point]
+        u, v = np.meshgrid(np.arange(res) / res, np.arange(res) / res, indexing="ij")
         if c != 0:
-            for i in range(res):
-                for j in range(res):
-                    x = float(i) / float(res)
-                    y = float(j) / float(res)
-                    slice_coords[i, j] = (-(a * (x - x0) + b * (y - y0)) / c + z0) % 1
-                    slice_vals[i, j] = self.interpolate(
-                        np.array([x, y, slice_coords[i, j]])
-                    )
+            slice_coords = (-(a * (u - x0) + b * (v - y0)) / c + z0) % 1
+            points = [u, v, slice_coords]
         elif b != 0:
-            for i in range(res):
-                for k in range(res):
-                    x = float(i) / float(res)
-                    z = float(k) / float(res)
-                    slice_coords[i, k] = (-(a * (x - x0) + c * (z - z0)) / b + y0) % 1
-                    slice_vals[i, k] = self.interpolate(
-                        np.array([x, slice_coords[i, k], z])
-                    )
+            slice_coords = (-(a * (u - x0) + c * (v - z0)) / b + y0) % 1
+            points = [u, slice_coords, v]
         elif a != 0:
-            for j in range(res):
-                for k in range(res):
-                    y = float(j) / float(res)
-                    z = float(k) / float(res)
-                    slice_coords[j, k] = (-(b * (y - y0) + c * (z - z0)) / a + x0) % 1
-                    slice_vals[j, k] = self.interpolate(
-                        np.array([slice_coords[j, k], y, z])
-                    )
+            slice_coords = (-(b * (u - y0) + c * (v - z0)) / a + x0) % 1
+            points = [slice_coords, u, v]
+        else:
+            return np.zeros((res, res)), np.zeros((res, res))
+        points = np.stack(points, axis=-1).reshape(-1, 3)
+        slice_vals = self.interpolate(points).reshape(res, res)
         return slice_vals, slice_coords
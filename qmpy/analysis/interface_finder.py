@@ -2,9 +2,161 @@
 
 import numpy as np
 import numpy.linalg as la
-import itertools
 
-__all__ = ["InterfaceFinder"]
+__all__ = ["InterfaceFinder", "SurfaceCells", "get_surface_cells"]
+
+
+def _gcd(array):
+    """Greatest common divisor of each row of an integer array."""
+    return np.gcd.reduce(np.abs(array), axis=1)
+
+
+class SurfaceCells(object):
+    """
+    Arrays describing the reduced 2D cells of the lattice planes of a
+    structure, see :func:`get_surface_cells`.
+
+    Attributes:
+        vectors: (N, 2, 3) cartesian vectors of each reduced cell.
+        hkl: (N, 3) Miller indices of the plane of each cell, with respect to
+        the cell of the structure.
+        a, b: (N,) lengths of the two vectors (a <= b).
+        cos: (N,) cosine of the angle between them (between -1/2 and 0).
+        area: (N,) area of each cell, in increasing order.
+        multiplicity: (N,) number of planes with a cell of the same shape.
+
+    """
+
+    def __init__(self, vectors, hkl, multiplicity=None):
+        if multiplicity is None:
+            multiplicity = np.ones(len(vectors), dtype=int)
+        u, v = vectors[:, 0], vectors[:, 1]
+        self.a = la.norm(u, axis=1)
+        self.b = la.norm(v, axis=1)
+        self.cos = np.einsum("ij,ij->i", u, v) / (self.a * self.b)
+        self.area = la.norm(np.cross(u, v), axis=1)
+        order = np.argsort(self.area, kind="stable")
+        self.vectors = vectors[order]
+        self.hkl = hkl[order]
+        self.multiplicity = multiplicity[order]
+        for attr in ["a", "b", "cos", "area"]:
+            setattr(self, attr, getattr(self, attr)[order])
+
+    def __len__(self):
+        return len(self.area)
+
+    @property
+    def planar(self):
+        """
+        (N, 2, 2) rows of each cell in its own plane: (a, 0) and
+        (b cos, b sin).
+        """
+        planar = np.zeros((len(self), 2, 2))
+        planar[:, 0, 0] = self.a
+        planar[:, 1, 0] = self.b * self.cos
+        planar[:, 1, 1] = self.b * np.sqrt(1 - self.cos ** 2)
+        return planar
+
+
+def _reduce(u, v, tol=1e-8):
+    """
+    Gauss-Lagrange reduction of each pair of rows of `u` and `v`, so that
+    |u| <= |v| and |u.v| <= |u|**2/2, with v chosen so that u.v <= 0.
+    """
+    u, v = u.copy(), v.copy()
+    while True:
+        swap = np.einsum("ij,ij->i", v, v) < np.einsum("ij,ij->i", u, u) - tol
+        u[swap], v[swap] = v[swap], u[swap].copy()
+        x = np.einsum("ij,ij->i", u, v) / np.einsum("ij,ij->i", u, u)
+        # leave ties alone, so rounding errors can not cycle
+        m = np.where(np.abs(x) > 0.5 + tol, np.rint(x), 0)
+        v -= m[:, None] * u
+        if not swap.any() and not m.any():
+            break
+    v[np.einsum("ij,ij->i", u, v) > 0] *= -1
+    return u, v
+
+
+def get_surface_cells(structure, max_dist=10, max_area=None, tol=1e-3):
+    """
+    Finds the 2D cells spanned by pairs of lattice vectors of `structure` no
+    longer than `max_dist`, in reduced form, keeping one cell of each shape.
+    Cells of the same shape, e.g. those of symmetry-equivalent planes, match
+    the same cells of another lattice, so only the one of the plane with the
+    smallest Miller indices is kept.
+
+    Keyword Arguments:
+        max_dist:
+            The longest allowed lattice vector in the plane of a cell.
+
+        max_area:
+            The largest allowed cell area. Default is no limit.
+
+    Returns:
+        :class:`SurfaceCells`
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> s.make_primitive()
+        >>> cells = get_surface_cells(s, max_dist=5)
+        >>> cells.hkl[0], cells.area[0]
+        (array([0, 0, 1]), 5.688...)
+
+    """
+    cell = structure.cell
+    # lattice points within max_dist, one of each +/- pair
+    limits = np.ceil(max_dist * la.norm(la.inv(cell), axis=0)).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in limits]
+    points = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+    first = points[np.arange(len(points)), np.argmax(points != 0, axis=1)]
+    points = points[first > 0]
+    carts = points.dot(cell)
+    lengths = la.norm(carts, axis=1)
+    points, carts = points[lengths <= max_dist + tol], carts[lengths <= max_dist + tol]
+
+    i, j = np.triu_indices(len(points), k=1)
+    areas = la.norm(np.cross(carts[i], carts[j]), axis=1)
+    keep = areas > tol
+    if max_area is not None:
+        keep &= areas <= max_area + tol
+    i, j = i[keep], j[keep]
+
+    # Miller indices of the plane, from the cross product of the integer
+    # coordinates, with the first nonzero index positive
+    hkl = np.cross(points[i], points[j])
+    hkl //= _gcd(hkl)[:, None]
+    first = hkl[np.arange(len(hkl)), np.argmax(hkl != 0, axis=1)]
+    hkl *= np.sign(first)[:, None]
+
+    u, v = _reduce(carts[i], carts[j])
+    a, b = la.norm(u, axis=1), la.norm(v, axis=1)
+    cos = np.einsum("ij,ij->i", u, v) / (a * b)
+    # one cell of each shape in each plane
+    shapes = np.round(np.column_stack([a, b, cos]) / tol)
+    unique = np.unique(np.column_stack([hkl, shapes]), axis=0, return_index=True)[1]
+    # then one of each shape, from the plane with the smallest indices
+    order = unique[np.argsort(np.abs(hkl[unique]).sum(axis=1), kind="stable")]
+    first, counts = np.unique(
+        shapes[order], axis=0, return_index=True, return_counts=True
+    )[1:]
+    unique = order[first]
+    cells = SurfaceCells(np.stack([u, v], axis=1)[unique], hkl[unique], counts)
+    return cells
+
+
+def get_strains(planar_A, planar_B):
+    """
+    Green-Lagrange strain of each of the planar cells `planar_B` when
+    deformed to match the corresponding cell of `planar_A`.
+
+    Returns:
+        (N, 3) array of the e_xx, e_yy and e_xy components.
+
+    """
+    T = la.solve(planar_B, planar_A)
+    E = (np.einsum("nij,nkj->nik", T, T) - np.eye(2)) / 2
+    return np.column_stack([E[:, 0, 0], E[:, 1, 1], E[:, 0, 1]])
 
 
 class InterfaceFinder(object):
@@ -14,18 +166,35 @@ class InterfaceFinder(object):
     Takes no consideration of the contained atoms or translations ON the
     surface -- only looks at the lattice and identifies low-strain planes.
 
+    The reduced 2D cells of both lattices (see :func:`get_surface_cells`) are
+    sorted by area, so each cell of A is only compared with the cells of B
+    whose area is close enough to allow a match, and all these pairs are
+    compared at once. As only reduced cells are compared, a pair of nearly
+    rectangular or nearly hexagonal cells whose reduced forms differ may be
+    missed.
+
+    To screen many pairs of structures, compute the cells of each (primitive)
+    structure once and pass them instead of the structures.
+
     Arguments:
-        A and B are Structures
+        A and B are Structures, or the :class:`SurfaceCells` of Structures.
 
     Keyword Arguments:
         max_dist:
             The longest allowed lattice vector in the plane of the interface.
 
+        max_area:
+            The largest allowed area of the interface cell.
+
         max_strain:
             Strain is calculated from the e_xx, e_yy and y_xy components of
             strain, and if the _total_ strain is less than "max_strain", an
             interface is considered acceptable.
 
+    Attributes:
+        interfaces: List of (Surface of A, Surface of B, strain), ordered by
+        strain and then by area.
+
     Examples::
 
         >>> s1 = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
@@ -35,71 +204,76 @@ class InterfaceFinder(object):
 
     """
 
-    def __init__(self, A, B, max_dist=10, max_strain=0.1, **kwargs):
-        assert isinstance(A, Structure)
-        assert isinstance(B, Structure)
-        self._A = A.make_primitive(in_place=False)
-        self._B = B.make_primitive(in_place=False)
-        self.tol = max_strain_energy
-
-        self._lp_A = self._A.find_lattice_points_within_distance(max_dist)
-        self._lp_B = self._B.find_lattice_points_within_distance(max_dist)
+    def __init__(self, A, B, max_dist=10, max_area=None, max_strain=0.1, **kwargs):
+        if not isinstance(A, SurfaceCells):
+            A = get_surface_cells(
+                A.make_primitive(in_place=False), max_dist=max_dist, max_area=max_area
+            )
+        if not isinstance(B, SurfaceCells):
+            B = get_surface_cells(
+                B.make_primitive(in_place=False), max_dist=max_dist, max_area=max_area
+            )
+        self.cells_A = A
+        self.cells_B = B
+        self.tol = max_strain
         self.find_interfaces()
 
-    @property
-    def surf_B(self):
-        saved = []
-        for element in itertools.combinations(self._lp_B, r=2):
-            if all([e == 0 for e in element[0]]):
-                continue
-            if all([e == 0 for e in element[1]]):
-                continue
-            v1 = np.dot(self._B.cell, element[0])
-            v2 = np.dot(self._B.cell, element[1])
-            element = Surface(v1, v2)
-            yield element
-            saved.append(element)
-        # while saved:
-        #    for element in saved:
-        #        yield element
+    def find_interfaces(self):
+        A, B = self.cells_A, self.cells_B
+        # a total strain below tol bounds the ratio of the areas
+        lower = np.sqrt(max(1 - 2 * self.tol, 0))
+        start = np.searchsorted(B.area, A.area / (1 + self.tol), side="left")
+        if lower > 0:
+            end = np.searchsorted(B.area, A.area / lower, side="right")
+        else:
+            end = np.full(len(A), len(B))
+        counts = end - start
 
-    @property
-    def surf_A(self):
-        saved = []
-        for element in itertools.combinations(self._lp_A, r=2):
-            if all([e == 0 for e in element[0]]):
-                continue
-            if all([e == 0 for e in element[1]]):
-                continue
-            v1 = np.dot(self._A.cell, element[0])
-            v2 = np.dot(self._A.cell, element[1])
-            element = Surface(v1, v2)
-            yield element
-            saved.append(element)
-        # while saved:
-        #    for element in saved:
-        #        yield element
+        ia = np.repeat(np.arange(len(A)), counts)
+        offsets = np.arange(len(ia)) - np.repeat(np.cumsum(counts) - counts, counts)
+        ib = np.repeat(start, counts) + offsets
 
-    def find_interfaces(self):
-        acceptable = []
-        for sa, sb in itertools.product(self.surf_A, self.surf_B):
-            e = sa * sb
-            if e < self.tol:
-                acceptable.append((sa, sb, e))
-        self.interfaces = sorted(acceptable, key=lambda x: x[2])
+        strains = np.abs(get_strains(A.planar[ia], B.planar[ib])).sum(axis=1)
+        ok = strains < self.tol
+        ia, ib, strains = ia[ok], ib[ok], strains[ok]
+        order = np.lexsort([A.area[ia], strains])
+        self.matches = np.column_stack([ia[order], ib[order]])
+        self.strains = strains[order]
+        self.interfaces = [
+            (Surface.from_cells(A, i), Surface.from_cells(B, j), e)
+            for (i, j), e in zip(self.matches, self.strains)
+        ]
 
 
 class Surface:
-    def __init__(self, v1, v2):
-        self.v1 = v1
-        self.v2 = v2
+    def __init__(self, v1, v2, hkl=None):
+        self.v1 = np.array(v1, dtype=float)
+        self.v2 = np.array(v2, dtype=float)
+        self.hkl = hkl
         self.a = la.norm(v1)
         self.b = la.norm(v2)
-        self.alpha = np.arcsin(np.dot(v1, v2) / (self.a * self.b))
-        self.area = self.v1.dot(self.v2)
+        self.alpha = np.arccos(np.dot(v1, v2) / (self.a * self.b))
+        self.area = la.norm(np.cross(self.v1, self.v2))
+
+    def __repr__(self):
+        return "<Surface %s: a=%0.3f, b=%0.3f, alpha=%0.1f>" % (
+            self.hkl,
+            self.a,
+            self.b,
+            np.degrees(self.alpha),
+        )
+
+    @classmethod
+    def from_cells(cls, cells, index):
+        v1, v2 = cells.vectors[index]
+        return cls(v1, v2, hkl=tuple(cells.hkl[index]))
+
+    @property
+    def planar(self):
+        return np.array(
+            [[self.a, 0], [self.b * np.cos(self.alpha), self.b * np.sin(self.alpha)]]
+        )
 
     def __mul__(self, other):
-        e1 = 2 * (self.a - other.a) / (self.a + other.a)
-        e2 = 2 * (self.b - other.b) / (self.b + other.b)
-        g = (self.b - other.b) / (self.b + other.b)
-        return abs(e1) + abs(e2) + abs(g)
+        strain = get_strains(self.planar[None], other.planar[None])[0]
+        return np.abs(strain).sum()
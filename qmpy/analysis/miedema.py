@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # miedema.py v1.6 12-13-2012 Jeff Doak jeff.w.doak@gmail.com
 # adapted by S. Kirklin 1/7/14
+import itertools
 import numpy as np
 import sys
 import yaml
@@ -11,10 +12,53 @@ from qmpy.utils import *
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["Miedema"]
+__all__ = [
+    "Miedema",
+    "get_miedema_table",
+    "miedema_binary_energies",
+    "miedema_energies",
+    "get_miedema_energies",
+]
 # data rows:
 # Element_name Phi Rho Vol Z Valence TM? RtoP Htrans
-params = yaml.safe_load(open(qmpy.INSTALL_PATH + "/data/miedema.yml").read())
+PARAMS_PATH = qmpy.INSTALL_PATH + "/data/miedema.yml"
+
+# Transition and non-transition metals (by atomic number) as given in Fig 2.28
+# of de Boer, et al., Cohesion in Metals (1988) (page 66).
+TM_NUMBERS = (
+    list(range(20, 30))
+    + list(range(38, 48))
+    + list(range(56, 58))
+    + list(range(72, 80))
+    + [90, 92, 94]
+)
+NON_TM_NUMBERS = (
+    list(range(3, 8))
+    + list(range(11, 16))
+    + [19]
+    + list(range(30, 34))
+    + [37]
+    + list(range(48, 52))
+    + [55]
+    + list(range(80, 84))
+)
+
+# conversion of the model energies from kJ/mol to eV/atom
+KJ_MOL_TO_EV = 0.01036427
+
+_params = None
+_table = None
+
+
+def load_params():
+    """Returns the dict of Miedema parameters of each element, read from
+    the data file on first use."""
+    global _params
+    if _params is None:
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(PARAMS_PATH) as f:
+            _params = yaml.load(f, Loader=loader)
+    return _params
 
 
 class Miedema(object):
@@ -53,6 +97,7 @@ class Miedema(object):
         if len(composition) != 2:
             return None
 
+        params = load_params()
         if not all(params[k] for k in composition):
             self.energy = None
             return
@@ -91,25 +136,8 @@ class Miedema(object):
         """Calculate and return the value of RtoP based on the transition metal
         status of elements A and B, and the elemental values of RtoP for elements A
         and B."""
-        # List of Transition Metals as given in Fig 2.28 of
-        # de Boer, et al., Cohesion in Metals (1988) (page 66).
-        tmrange = []
-        tmrange.extend(list(range(20, 30)))
-        tmrange.extend(list(range(38, 48)))
-        tmrange.extend(list(range(56, 58)))
-        tmrange.extend(list(range(72, 80)))
-        tmrange.extend([90, 92, 94])
-        # List of Non-Transition Metals as given in Fig 2.28 of
-        # de Boer, et al., Cohesion in Metals (1988) (page 66).
-        nontmrange = []
-        nontmrange.extend(list(range(3, 8)))
-        nontmrange.extend(list(range(11, 16)))
-        nontmrange.extend([19])
-        nontmrange.extend(list(range(30, 34)))
-        nontmrange.extend([37])
-        nontmrange.extend(list(range(48, 52)))
-        nontmrange.extend([55])
-        nontmrange.extend(list(range(80, 84)))
+        tmrange = TM_NUMBERS
+        nontmrange = NON_TM_NUMBERS
         # If one of A,B is in tmrange and the other is in nontmrange, set RtoP
         # to the product of elemental values, otherwise set RtoP to zero.
         if (self.A[3] in tmrange) and (self.B[3] in nontmrange):
@@ -195,8 +223,193 @@ class Miedema(object):
             / ((1 - self.x) * vol_A + self.x * vol_B)
             + D_htrans
         )
-        return round(H_ord * 0.01036427, 2)
+        return round(H_ord * KJ_MOL_TO_EV, 2)
 
     @staticmethod
     def get(composition):
         return Miedema(composition).energy
+
+
+class _MiedemaTable(object):
+    """Miedema parameters of all elements as arrays, see
+    `get_miedema_table`."""
+
+    def __init__(self, params):
+        self.symbols = sorted(params)
+        self.index = dict((e, i) for i, e in enumerate(self.symbols))
+        rows = [params[e] or [np.nan] * 8 for e in self.symbols]
+        columns = np.array(rows, dtype=float).T
+        self.phi, self.rho, self.vol, self.z = columns[:4]
+        self.valence, self.tm, self.rtop, self.htrans = columns[4:]
+        self.known = ~np.isnan(self.phi)
+        self.in_tmrange = np.isin(self.z, TM_NUMBERS)
+        self.in_nontmrange = np.isin(self.z, NON_TM_NUMBERS)
+        # volume scale parameter, see `Miedema.pick_a`
+        self.a = np.select(
+            [
+                self.valence == 1,
+                self.valence == 2,
+                self.valence == 3,
+                np.isin(self.symbols, ["Ag", "Au", "Cu"]),
+            ],
+            [0.14, 0.1, 0.07, 0.07],
+            0.04,
+        )
+
+    def indices(self, elements):
+        """Indices of `elements`, which may be symbols or indices."""
+        elements = np.asarray(elements)
+        if elements.dtype.kind in "US":
+            lookup = np.vectorize(self.index.__getitem__, otypes=[int])
+            return lookup(elements) if elements.size else elements.astype(int)
+        return elements.astype(int)
+
+
+def get_miedema_table():
+    """
+    Returns the Miedema parameters of all elements as arrays (one entry per
+    element, nan if unknown), built once. The `symbols` attribute lists the
+    elements, in the order of the element indices accepted by
+    `miedema_binary_energies` and `miedema_energies`.
+    """
+    global _table
+    if _table is None:
+        _table = _MiedemaTable(load_params())
+    return _table
+
+
+def _interaction(a, b, x):
+    """
+    Interaction part of the Miedema formation enthalpy (in kJ/mol) of the
+    ordered compounds A(1-x)B(x) of elements with indices `a` and `b`, see
+    `Miedema.H_form_ord`.
+    """
+    t = get_miedema_table()
+    phi_a, phi_b = t.phi[a], t.phi[b]
+    rho_a, rho_b = t.rho[a], t.rho[b]
+    vol0_a, vol0_b = t.vol[a], t.vol[b]
+
+    # nan for unknown elements, whose energies are set to nan through `known`
+    n_tm = np.nan_to_num(t.tm[a] + t.tm[b]).astype(int)
+    P = np.choose(n_tm, [10.7, 12.35, 14.2], mode="clip")
+    mixed = (t.in_tmrange[a] & t.in_nontmrange[b]) | (
+        t.in_nontmrange[a] & t.in_tmrange[b]
+    )
+    RtoP = np.where(mixed, t.rtop[a] * t.rtop[b], 0.0)
+    m_rho = (1 / rho_a + 1 / rho_b) / 2.0
+    QtoP = 9.4
+    gamma = P * (QtoP * (rho_a - rho_b) ** 2 - (phi_a - phi_b) ** 2 - RtoP) / m_rho
+    gamma = np.round(gamma)
+
+    def surface(vol_a, vol_b):
+        c_a = (1 - x) * vol_a / ((1 - x) * vol_a + x * vol_b)
+        c_b = x * vol_b / ((1 - x) * vol_a + x * vol_b)
+        return c_a, c_b, 1 + 8 * (c_a * c_b) ** 2
+
+    c_a, c_b, f = surface(vol0_a, vol0_b)
+    vol_a = vol0_a * (1 + t.a[a] * c_b * f * (phi_a - phi_b))
+    vol_b = vol0_b * (1 + t.a[b] * c_a * f * (phi_b - phi_a))
+    c_a, c_b, f = surface(vol_a, vol_b)
+    return gamma * (1 - x) * x * vol_a * vol_b * f / ((1 - x) * vol_a + x * vol_b)
+
+
+def miedema_binary_energies(a, b, x):
+    """
+    Computes the Miedema formation energies of many binary ordered
+    compounds A(1-x)B(x) at once.
+
+    Arguments:
+        a, b: Arrays of element symbols, or of indices into
+            `get_miedema_table().symbols`.
+        x: Array of the fractions of B.
+
+    Returns:
+        numpy.ndarray of formation energies (eV/atom), nan where there are
+        no parameters for an element. Unlike :mod:`Miedema`, the energies
+        are not rounded.
+
+    Examples::
+
+        >>> miedema_binary_energies(['Fe', 'Pt'], ['Ni', 'Ti'], [0.5, 0.75])
+        array([-0.0280112 , -0.75613089])
+
+    """
+    t = get_miedema_table()
+    a, b = t.indices(a), t.indices(b)
+    x = np.asarray(x, dtype=float)
+    D_htrans = x * t.htrans[b] + (1 - x) * t.htrans[a]
+    return (_interaction(a, b, x) + D_htrans) * KJ_MOL_TO_EV
+
+
+def miedema_energies(elements, fractions):
+    """
+    Computes the Miedema formation energies of many multicomponent
+    compositions at once.
+
+    The interaction energies of the binary subsystems are extrapolated
+    geometrically (Kohler): each pair of elements i, j contributes
+    (x_i + x_j)**2 times the binary interaction energy at the composition
+    x_j / (x_i + x_j). For binaries this is the same as
+    `miedema_binary_energies`.
+
+    Arguments:
+        elements: (N, K) array of element symbols or indices (see
+            `get_miedema_table`). Unused entries of compositions with fewer
+            than K elements may hold any element, with zero fraction.
+        fractions: (N, K) array of amounts of the elements.
+
+    Returns:
+        numpy.ndarray of shape (N,) of formation energies (eV/atom), nan
+        for compositions with an element without parameters.
+
+    Examples::
+
+        >>> miedema_energies([['Fe', 'Ni', 'Pt']], [[1, 1, 2]])
+        array([-0.12528731])
+
+    """
+    t = get_miedema_table()
+    elements = t.indices(elements)
+    fractions = np.array(fractions, dtype=float)
+    fractions /= fractions.sum(axis=1, keepdims=True)
+    present = fractions > 0
+
+    energy = np.where(present, fractions * t.htrans[elements], 0).sum(axis=1)
+    energy[(present & ~t.known[elements]).any(axis=1)] = np.nan
+    for p, q in itertools.combinations(range(elements.shape[1]), 2):
+        pair = present[:, p] & present[:, q] & (elements[:, p] != elements[:, q])
+        x_p, x_q = fractions[pair, p], fractions[pair, q]
+        total = x_p + x_q
+        interaction = _interaction(elements[pair, p], elements[pair, q], x_q / total)
+        energy[pair] += total ** 2 * interaction
+    return energy * KJ_MOL_TO_EV
+
+
+def get_miedema_energies(compositions):
+    """
+    Computes the Miedema formation energies (eV/atom) of a list of
+    compositions, which may be Compositions, formulas or composition dicts,
+    with `miedema_energies`.
+
+    Examples::
+
+        >>> get_miedema_energies(['FeNi', 'Ti3Pt', 'Fe2O3'])
+        array([-0.0280112 , -0.75613089,         nan])
+
+    """
+    comps = []
+    for comp in compositions:
+        if isinstance(comp, str):
+            comp = parse_comp(comp)
+        elif isinstance(comp, qmpy.Composition):
+            comp = comp.comp
+        comps.append(comp)
+    width = max([len(comp) for comp in comps] + [1])
+    t = get_miedema_table()
+    elements = np.zeros((len(comps), width), dtype=int)
+    fractions = np.zeros((len(comps), width))
+    for n, comp in enumerate(comps):
+        for k, (elt, amt) in enumerate(comp.items()):
+            elements[n, k] = t.index[elt]
+            fractions[n, k] = amt
+    return miedema_energies(elements, fractions)
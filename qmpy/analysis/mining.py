@@ -2,14 +2,43 @@
 
 import pickle
 import os.path
+import logging
 
 import numpy as np
 
 import qmpy
 from qmpy.utils import unit_comp, format_comp, parse_comp
 
+logger = logging.getLogger(__name__)
+
 elts = qmpy.data.elements
 
+# element properties used as composition features, see `get_element_table`
+ELEMENT_PROPERTIES = [
+    "z",
+    "mass",
+    "period",
+    "group",
+    "electronegativity",
+    "atomic_radii",
+    "covalent_radii",
+    "first_ionization_energy",
+    "melt",
+    "boil",
+    "density",
+    "volume",
+    "specific_heat",
+    "s_elec",
+    "p_elec",
+    "d_elec",
+    "f_elec",
+]
+
+# orders of the stoichiometry norms (the 0-norm is the number of elements)
+NORMS = [0, 2, 3, 5, 7, 10]
+
+_element_tables = {}
+
 
 def max_diff(data):
     """max_diff"""
@@ -72,6 +101,247 @@ def get_rich_composition_descriptors(comp):
     return desc
 
 
+def get_structure_descriptors(structure):
+    """
+    Coordination descriptors of a :mod:`~qmpy.Structure`, from its cached
+    Voronoi analysis (see :meth:`~qmpy.Structure.get_voronoi`).
+    """
+    voronoi = structure.get_voronoi()
+    cns = voronoi.coordination_numbers
+    nfaces = np.bincount(voronoi.atoms, minlength=len(cns))
+    desc = {}
+    for name, data in [("cn", cns), ("faces", nfaces), ("volume", voronoi.volumes)]:
+        for func in [max_diff, average]:
+            desc["%s_%s" % (func.__doc__, name)] = func(data)
+    return desc
+
+
+STRUCTURE_DESCRIPTORS = [
+    "%s_%s" % (func.__doc__, name)
+    for name in ["cn", "faces", "volume"]
+    for func in [max_diff, average]
+]
+
+
+def get_element_table(properties=ELEMENT_PROPERTIES):
+    """
+    Returns the element symbols, ordered by atomic number, and an array of
+    shape (elements, properties) of their `properties` from
+    :mod:`qmpy.data`, with nan for unknown (negative) values. Each table is
+    built once and must not be modified.
+
+    Examples::
+
+        >>> symbols, table = get_element_table(['z', 'mass'])
+        >>> symbols[:2], table[:2]
+        (['H', 'He'], array([[1.        , 1.00794   ],
+                [2.        , 4.00260162]]))
+
+    """
+    key = tuple(properties)
+    if key not in _element_tables:
+        symbols = sorted(elts, key=lambda e: elts[e]["z"])
+        table = np.full((len(symbols), len(key)), np.nan)
+        for i, elt in enumerate(symbols):
+            for j, prop in enumerate(key):
+                value = elts[elt].get(prop)
+                if value is not None and value >= 0:
+                    table[i, j] = value
+        table.flags.writeable = False
+        _element_tables[key] = (symbols, table)
+    return _element_tables[key]
+
+
+class CompositionFeaturizer(object):
+    """
+    Dense feature matrices of many compositions at once.
+
+    For each element property, the features of a composition are the
+    fraction weighted mean and variance and the minimum and maximum over its
+    elements (ignoring elements for which the property is unknown), followed
+    by the stoichiometry norms (sum of x**p)**(1/p) of the fractions for p in
+    `NORMS`. All compositions are turned into one (compositions, elements)
+    matrix of fractions, so the statistics are a few matrix operations.
+
+    If `structural` is set, the featurized items must be Structures, and the
+    coordination descriptors of each one (see `get_structure_descriptors`)
+    and its volume per atom are appended.
+
+    Composition features are kept in memory by composition, and if `cache`
+    is a path, also in that .npz file, so that they are only computed once
+    across runs.
+
+    Attributes:
+        properties: List of element properties.
+        structural: Whether structure features are included.
+        cache: Path of the .npz cache file, or None.
+
+    Examples::
+
+        >>> featurizer = CompositionFeaturizer(cache='/tmp/features.npz')
+        >>> X = featurizer.featurize(['Fe2O3', 'NaCl', {'Fe':3, 'O':4}])
+        >>> X.shape
+        (3, 74)
+        >>> featurizer.feature_names[:3]
+        ['mean_z', 'var_z', 'min_z']
+
+    """
+
+    stats = ["mean", "var", "min", "max"]
+
+    def __init__(self, properties=ELEMENT_PROPERTIES, structural=False, cache=None):
+        self.properties = list(properties)
+        self.structural = structural
+        self.cache = cache
+        self.symbols, self.table = get_element_table(self.properties)
+        self._index = dict((e, i) for i, e in enumerate(self.symbols))
+        self._rows = None
+
+    @property
+    def composition_feature_names(self):
+        names = ["%s_%s" % (s, p) for p in self.properties for s in self.stats]
+        return names + ["norm_%d" % p for p in NORMS]
+
+    @property
+    def feature_names(self):
+        names = self.composition_feature_names
+        if self.structural:
+            names += STRUCTURE_DESCRIPTORS + ["volume_pa"]
+        return names
+
+    @staticmethod
+    def key(comp):
+        """Cache key of a composition dict: its normalized formula."""
+        total = float(sum(comp.values()))
+        return "".join("%s%.6g" % (e, comp[e] / total) for e in sorted(comp))
+
+    def featurize(self, items):
+        """
+        Computes the features of `items`, which may be Structures,
+        Compositions, formulas or composition dicts.
+
+        Returns:
+            numpy.ndarray of shape (len(items), len(feature_names)).
+
+        """
+        items = list(items)
+        comps = []
+        for item in items:
+            if isinstance(item, qmpy.Structure):
+                comps.append(item.comp)
+            elif self.structural:
+                raise ValueError("Structural features need Structures")
+            elif isinstance(item, qmpy.Composition):
+                comps.append(item.comp)
+            elif isinstance(item, str):
+                comps.append(parse_comp(item))
+            else:
+                comps.append(item)
+
+        rows = self._load()
+        keys = [self.key(c) for c in comps]
+        missing = dict((k, c) for k, c in zip(keys, comps) if k not in rows)
+        if missing:
+            features = self.get_composition_features(list(missing.values()))
+            rows.update(zip(missing, features))
+            if self.cache:
+                self.save()
+        X = np.zeros((len(items), len(self.composition_feature_names)))
+        for n, key in enumerate(keys):
+            X[n] = rows[key]
+        if self.structural:
+            X = np.hstack([X, [self.get_structure_features(s) for s in items]])
+        return X
+
+    def get_composition_features(self, comps):
+        """Computes the composition features of a list of composition dicts."""
+        counts = np.array([len(comp) for comp in comps])
+        cols = np.array([self._index[e] for comp in comps for e in comp], dtype=int)
+        amts = np.array([x for comp in comps for x in comp.values()], dtype=float)
+        starts = np.cumsum(counts) - counts
+        fracs = amts / np.repeat(np.add.reduceat(amts, starts), counts)
+
+        # one row per element of each composition, grouped by composition
+        values = self.table[cols]
+        known = ~np.isnan(values)
+        weights = np.add.reduceat(fracs[:, None] * known, starts)
+        moments = [
+            np.add.reduceat(fracs[:, None] * np.where(known, values ** k, 0), starts)
+            for k in [1, 2]
+        ]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = moments[0] / weights
+            var = np.maximum(moments[1] / weights - mean ** 2, 0)
+        lowest = np.minimum.reduceat(np.where(known, values, np.inf), starts)
+        highest = np.maximum.reduceat(np.where(known, values, -np.inf), starts)
+        lowest[np.isinf(lowest)] = np.nan
+        highest[np.isinf(highest)] = np.nan
+        stats = np.stack([mean, var, lowest, highest], axis=2).reshape(len(comps), -1)
+
+        norms = [
+            counts if p == 0 else np.add.reduceat(fracs ** p, starts) ** (1.0 / p)
+            for p in NORMS
+        ]
+        return np.column_stack([stats] + norms)
+
+    def get_structure_features(self, structure):
+        """Computes the structure features of a Structure."""
+        desc = get_structure_descriptors(structure)
+        volume_pa = structure.get_volume() / len(structure)
+        return [desc[name] for name in STRUCTURE_DESCRIPTORS] + [volume_pa]
+
+    def _load(self):
+        """Returns the dict of composition features, read from the cache file
+        on first use."""
+        if self._rows is None:
+            self._rows = {}
+            if self.cache and os.path.exists(self.cache):
+                data = np.load(self.cache)
+                if list(data["names"]) == self.composition_feature_names:
+                    self._rows = dict(zip(data["keys"].tolist(), data["features"]))
+                else:
+                    logger.info("Ignoring cached features with other names")
+        return self._rows
+
+    def save(self):
+        """Writes all composition features computed so far to `cache`."""
+        keys = sorted(self._load())
+        features = np.array([self._rows[k] for k in keys]).reshape(len(keys), -1)
+        names = np.array(self.composition_feature_names)
+        # through a file, so np.savez does not append .npz to the path
+        with open(self.cache, "wb") as f:
+            np.savez(f, keys=np.array(keys), names=names, features=features)
+
+
+def get_formation_energy_data(featurizer=None, formations=None, fit="standard"):
+    """
+    Features and formation energies for training models of formation
+    energies.
+
+    Keyword Arguments:
+        featurizer:
+            :class:`CompositionFeaturizer` used, by default one without a
+            cache file.
+        formations:
+            QuerySet of :mod:`~qmpy.FormationEnergy` objects, by default all
+            of the `fit`.
+
+    Returns:
+        (features, formation energies), arrays with one row per formation
+        energy.
+
+    """
+    if featurizer is None:
+        featurizer = CompositionFeaturizer()
+    if formations is None:
+        formations = qmpy.FormationEnergy.objects.filter(fit_id=fit)
+    rows = formations.exclude(delta_e=None).values_list("composition_id", "delta_e")
+    rows = list(rows)
+    formulas = [formula for formula, delta_e in rows]
+    energies = np.array([delta_e for formula, delta_e in rows], dtype=float)
+    return featurizer.featurize(formulas), energies
+
+
 def get_calculation_descriptors(calc):
     raise NotImplementedError
 
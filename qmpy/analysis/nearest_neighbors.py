@@ -1,16 +1,87 @@
 #!/usr/bin/env python
 
+import hashlib
 import numpy as np
 import numpy.linalg as linalg
-from scipy.spatial import Voronoi
+from scipy.spatial import Voronoi, cKDTree
 import itertools
 import logging
 
 import qmpy
 from qmpy.utils import *
+from qmpy.utils.cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# neighbor lists, keyed by a hash of (cell, coordinates, cutoff)
+NEIGHBOR_LIST_CACHE = LRUCache(maxsize=256)
+
+
+def get_neighbor_list(structure, cutoff, sites=False):
+    """
+    Finds every pair of atoms (or sites) of `structure` closer than `cutoff`,
+    including pairs of an atom with periodic images of itself or of others.
+
+    All images within `cutoff` of the unit cell are put in a single KD-tree,
+    so the cost grows linearly with the number of atoms. Results are cached
+    by geometry and shared between callers, and must not be modified.
+
+    Arguments:
+        structure: :mod:`~qmpy.Structure` to find neighbors in.
+        cutoff: Largest distance (in Angstroms) between neighbors.
+
+    Keyword Arguments:
+        sites: If True, finds neighboring sites instead of atoms.
+
+    Returns:
+        Tuple of arrays (i, j, images, distances), with one entry per pair:
+        atom (or site) j, translated by the lattice vector `images`, is
+        `distances` away from atom i. Every pair is listed in both
+        directions, sorted by i and then by distance. An atom is never its
+        own neighbor without a translation.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+        >>> i, j, images, distances = get_neighbor_list(s, 3)
+        >>> np.bincount(i)
+        array([12, 12, 12, 12])
+
+    """
+    cell = np.array(structure.cell, dtype="float64")
+    if sites:
+        coords = structure.site_coords
+    else:
+        coords = structure.coords
+    coords = np.array(coords, dtype="float64").reshape(-1, 3) % 1.0
+    digest = hashlib.sha1(cell.tobytes() + coords.tobytes()).hexdigest()
+    key = (digest, float(cutoff))
+    return NEIGHBOR_LIST_CACHE.get_or_set(key, _neighbor_list, cell, coords, cutoff)
+
+
+def _neighbor_list(cell, coords, cutoff):
+    """Builds the neighbor list of `get_neighbor_list`."""
+    # images needed along each lattice vector, from the interplanar spacings
+    volume = abs(linalg.det(cell))
+    areas = linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+    limits = np.ceil(cutoff * areas / volume).astype(int)
+    images = np.array(
+        list(itertools.product(*[list(range(-n, n + 1)) for n in limits]))
+    )
+
+    cart = coords.dot(cell)
+    points = (images.dot(cell)[:, None, :] + cart[None, :, :]).reshape(-1, 3)
+    pairs = cKDTree(cart).sparse_distance_matrix(
+        cKDTree(points), cutoff, output_type="ndarray"
+    )
+    i, k, distances = pairs["i"], pairs["j"], pairs["v"]
+    j = k % len(coords)
+    images = images[k // len(coords)]
+    itself = (i == j) & ~images.any(axis=1)
+    order = np.lexsort((distances, i))
+    order = order[~itself[order]]
+    return i[order], j[order], images[order], distances[order]
+
 
 def find_nearest_neighbors(structure, method="closest", limit=5, tol=2e-1, **kwargs):
     """
@@ -79,37 +150,26 @@ def _get_facet_area(vertices):
 
 
 def _heuristic(structure, limit=5, tol=2e-1):
-    lat_params = structure.lat_params
-
-    # Create a new cell large enough to find neighbors at least `limit` away.
-    limits = [int(np.ceil(limit / lat_params[i])) for i in range(3)]
-    new_struct = structure.transform(limits, in_place=False)
-
-    # construct a distance matrix between the original structure and supercell
-    # structure.
-    distances = np.zeros((len(structure.sites), structure.natoms * np.product(limits)))
-    for i, site in enumerate(structure.sites):
-        for j, atom in enumerate(new_struct.sites):
-            dist = new_struct.get_distance(i, j, limit=limit, wrap_self=True)
-            if dist is None or dist < 1e-4:
-                dist = min(structure.lat_params[:3])
-            distances[i, j] = dist
+    sites = structure.sites
+    i, j, images, distances = get_neighbor_list(structure, limit, sites=True)
+
+    # get neighbors within `tol` % of the shortest bond length of each site
+    bonds = distances > 1e-4
+    i, j, distances = i[bonds], j[bonds], distances[bonds]
+    shortest = np.full(len(sites), np.inf)
+    np.minimum.at(shortest, i, distances)
+    close = distances < (1 + tol) * shortest[i]
 
     nns = {}
-    for i, site in enumerate(structure.sites):
+    for site in sites:
         site.neighbors = []
-        dists = np.array(distances[i])
-        dists /= min([d for d in dists])
-        # get neighbors within `tol` % of the shortest bond length
-        inds = np.ravel(np.argwhere((dists - 1) < tol))
-        inds = np.array([ii for ii in inds if ii != i])
-        # map index back into the original cell
-        inds %= structure.natoms
-        site.neighbors = [structure.sites[j] for j in inds]
+    for ii, jj in zip(i[close], j[close]):
+        sites[ii].neighbors.append(sites[jj])
+    for ii, site in enumerate(sites):
         ## nns[site] = site.neighbors
         ## `qmpy.Site` objects that are not saved are not hashable, and hence
         ## cannot be used as dictionary keys. Unit tests will fail.
-        nns[i] = site.neighbors
+        nns[ii] = site.neighbors
         for atom in site:
             atom.neighbors = []
             for n in site.neighbors:
@@ -118,34 +178,18 @@ def _heuristic(structure, limit=5, tol=2e-1):
 
 
 def _voronoi(structure, limit=5, tol=1e-2):
-    lps = structure.lat_params
-    limits = np.array([int(np.ceil(limit / lps[i])) for i in range(3)])
-
-    # Create a new cell large enough to find neighbors at least `limit` away.
-    new_struct = structure.transform(limits + 1, in_place=False)
-    nns = defaultdict(list)
+    atoms = structure.atoms
+    voronoi = structure.get_voronoi(limit=limit)
+    nns = {}
 
     # look for neighbors for each atom in the structure
-    for i, atom in enumerate(structure.atoms):
+    for i, atom in enumerate(atoms):
         atom.neighbors = []
-
-        # center on the atom so that its voronoi cell is fully described
-        new_struct.recenter(atom, middle=True)
-        tess = Voronoi(new_struct.cartesian_coords)
-        for j, r in enumerate(tess.ridge_points):
-            if not i in r:  # only ridges involving the specified atom matter
-                continue
-            inds = tess.ridge_vertices[j]
-            verts = tess.vertices[inds]
-
+        for face in voronoi.faces(i):
             # check that the area of the facet is large enough
-            if _get_facet_area(verts) < tol:
+            if _get_facet_area(voronoi.vertices[face]) < tol:
                 continue
-
-            # Get the indices of all points which this atom shares a ridge with
-            ind = [k for k in tess.ridge_points[j] if k != i][0]
-            # map the atom index back into the original cell.
-            atom.neighbors.append(atom)
+            atom.neighbors.append(atoms[voronoi.neighbors[face]])
         ## nns[atom] = atom.neighbors
         ## `qmpy.Atom` objects that are not saved are not hashable, and hence
         ## cannot be used as dictionary keys. Unit tests will fail.
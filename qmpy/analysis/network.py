@@ -1,6 +1,7 @@
 import networkx as nx
 import itertools
 import numpy as np
+from scipy import sparse
 import random
 import logging
 
@@ -10,7 +11,7 @@ from qmpy.utils import *
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["LatticePoint", "LatticeNetwork"]
+__all__ = ["LatticePoint", "LatticeNetwork", "LatticeMC"]
 
 
 class LatticePoint:
@@ -31,16 +32,29 @@ class LatticePoint:
 
 
 class LatticeNetwork:
+    """
+    Network of lattice points, with an Ising model of spins on the points
+    which interact with their neighbors.
+
+    Attributes:
+        temperature: Temperature (k_B * T, in the units of `interaction`)
+            used by `run_MC` and `run_GCMC`.
+        steps: Number of Monte Carlo sweeps done by `run_MC` and `run_GCMC`.
+        interaction: Coupling, J, between neighboring spins.
+        field: External field, h, coupled to every spin.
+
+    """
+
     spin_states = 2
-    temperature = 20
+    temperature = 1.0
     steps = 100
 
     def __init__(self, pairs):
         ##self.graph = nx.MultiGraph()
         self.graph = nx.Graph()
         self.graph.add_edges_from(pairs)
-        self.lattice_points = self.graph.nodes()
-        self.pairs = self.graph.edges()
+        self.lattice_points = list(self.graph.nodes())
+        self.pairs = list(self.graph.edges())
 
         self.interaction = -1
         self.field = 0
@@ -115,7 +129,9 @@ class LatticeNetwork:
         Compute the total energy of the lattice using the Ising model
         hamiltonian:
 
-        H(s) = -J * sum_{i, j}( s_i * s_j )
+        H(s) = -J * sum_{i, j}( s_i * s_j ) - h * sum_i( s_i )
+
+        where the first sum runs over every pair of neighbors once.
 
         So, for a positive interaction, J, the energy is minimized when all
         pairs are alike. Likewise, when J is negative, the enegy is minimized
@@ -128,7 +144,8 @@ class LatticeNetwork:
                 energy -= self.interaction
             else:
                 energy += self.interaction
-        self.energy = energy / 2.0
+        energy -= self.field * sum(lp.spin for lp in self.lattice_points)
+        self.energy = energy
         return self.energy
 
     def randomize_spins(self):
@@ -142,15 +159,16 @@ class LatticeNetwork:
         """
         Randomly selects a lattice point, and attempts to flip it.
 
-        dE = 2*J*sum(neighboring spins)
+        dE = 2*s*(J*sum(neighboring spins) + h)
         """
         lp1 = random.choice(self.lattice_points)
-        de = 2 * self.interaction * sum([lp2.spin for lp2 in self.graph[lp1]])
-        if de > 0 and np.exp(-self.temperature * de) < random.random():
+        local = sum([lp2.spin for lp2 in self.graph[lp1]])
+        de = 2 * lp1.spin * (self.interaction * local + self.field)
+        if de > 0 and np.exp(-de / self.temperature) < random.random():
             return
         else:
             self.energy += de
-            lp.spin *= -1
+            lp1.spin *= -1
 
     def attempt_swap(self, accept=True):
         lp1 = random.choice(self.lattice_points)
@@ -162,43 +180,48 @@ class LatticeNetwork:
         de = (
             2
             * self.interaction
+            * lp1.spin
             * sum([lp3.spin for lp3 in self.graph[lp1] if not lp3 == lp2])
         )
         de += (
             2
             * self.interaction
+            * lp2.spin
             * sum([lp3.spin for lp3 in self.graph[lp2] if not lp3 == lp1])
         )
-        if de > 0 and np.exp(-self.temperature * de) < random.random():
+        if de > 0 and np.exp(-de / self.temperature) < random.random():
             return
         else:
             self.energy += de
             lp1.spin *= -1
             lp2.spin *= -1
 
-    def run_GCMC(self, mu=0):
+    def run_GCMC(self, mu=0, seed=None):
         """
-        Run Monte Carlo in the Grand Canonical Ensemble. 
+        Run Monte Carlo in the Grand Canonical Ensemble, with a chemical
+        potential `mu` for up spins, using :mod:`~qmpy.LatticeMC`. The final
+        spins are written back onto the lattice points.
 
-        Examples:
-        >>> sl = LatticeNetwork.create_2d(10)
-        >>> sl.run_GCMC()
-        >>> sl.run_GCMC(-1)
-        >>> sl.run_GCMC(1)
-        """
-
-        steps = self.steps * len(self.lattice_points)
-
-        self.randomize_spins()
-        self.energies = np.zeros(steps)
-        for i in range(steps):
-            self.attemp_flip()
-            self.energies[i] = self.energy
+        Examples::
 
-    def run_MC(self, x=None):
+            >>> sl = LatticeNetwork.create_2d(10)
+            >>> sl.run_GCMC()
+            >>> sl.run_GCMC(-1)
+            >>> sl.run_GCMC(1)
+        """
+        mc = LatticeMC(self, seed=seed)
+        mc.run(self.temperature, sweeps=self.steps, equilibration=0, mu=mu)
+        mc.write_spins()
+        self.energies = mc.energies[:, 0] * len(self)
+        self.energy = self.energies[-1]
+        return mc
+
+    def run_MC(self, x=None, seed=None):
         """
-        Run Monte Carlo in the Canonical Ensemble
-        
+        Run Monte Carlo in the Canonical Ensemble, using
+        :mod:`~qmpy.LatticeMC`. The final spins are written back onto the
+        lattice points.
+
         Examples::
 
             >>> sl = LatticeNetwork.create_2d(10)
@@ -207,15 +230,238 @@ class LatticeNetwork:
             >>> sl.run_MC(0.25)
 
         """
-        steps = self.steps * len(self.lattice_points)
-
         if not x is None:
             self.set_fraction(x)
         elif self.fraction is None:
             raise ValueError("Must specify a fraction to run MC")
 
-        self.energy = self.compute_total_lattice_energy()
-        self.energies = np.zeros(steps)
-        for i in range(steps):
-            self.attempt_swap()
-            self.energies[i] = self.energy
+        mc = LatticeMC(self, seed=seed)
+        mc.run(self.temperature, sweeps=self.steps, equilibration=0)
+        mc.write_spins()
+        self.energies = mc.energies[:, 0] * len(self)
+        self.energy = self.energies[-1]
+        return mc
+
+
+class LatticeMC(object):
+    """
+    Array based Metropolis Monte Carlo of the Ising model of a
+    :mod:`~qmpy.LatticeNetwork`, run for several independent replicas at
+    once.
+
+    The energy of spins s_i = +/-1 is
+
+    E(s) = -J * sum_{i, j}( s_i * s_j ) - h * sum_i( s_i )
+
+    where the first sum runs over every pair of neighbors once. In the grand
+    canonical ensemble every up spin also costs a chemical potential, mu, so
+    that the sampled energy is E(s) - mu * N_up. Temperatures are k_B * T, in
+    the units of J.
+
+    Grand canonical sweeps flip every spin of one sublattice (a set of
+    points no two of which are neighbors) at a time. Canonical sweeps swap
+    unlike spins within random sets of points no two of which are neighbors,
+    so that all the swaps in a set are independent.
+
+    Attributes:
+        nodes: LatticePoints of the network, in the order of the arrays.
+        adjacency: (N, N) scipy.sparse.csr_matrix of neighbors. Its `indptr`
+            and `indices` list the neighbors of each point.
+        sublattices: List of arrays of point indices which are updated
+            together (a greedy coloring of the network).
+        spins: (N, replicas) int8 array of spins.
+        energies: (sweeps, replicas) energy per point after each sweep of
+            the last run.
+        averages: Dictionary of the averages (over the sweeps of the last
+            run) of each replica: "energy" and "energy2" (per point),
+            "composition" (fraction of up spins) and "heat_capacity" (per
+            point).
+
+    Examples::
+
+        >>> sl = LatticeNetwork.create_2d(16)
+        >>> mc = LatticeMC(sl, replicas=4, seed=0)
+        >>> results = mc.temperature_scan([4, 3, 2.5, 2, 1.5], mu=0)
+        >>> results['energy'].mean(axis=1).round(3)
+        array([-0.559, -0.819, -1.135, -1.745, -1.951])
+
+    """
+
+    def __init__(self, network, interaction=None, field=None, replicas=1, seed=None):
+        self.network = network
+        self.interaction = network.interaction if interaction is None else interaction
+        self.field = network.field if field is None else field
+        self.rng = np.random.default_rng(seed)
+
+        self.nodes = list(network.graph.nodes())
+        index = dict((node, i) for i, node in enumerate(self.nodes))
+        pairs = np.array(
+            [(index[a], index[b]) for a, b in network.graph.edges() if a is not b]
+        ).reshape(-1, 2)
+        n = len(self.nodes)
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        ones = np.ones(len(rows), dtype="int32")
+        self.adjacency = sparse.csr_matrix((ones, (rows, cols)), shape=(n, n))
+        self.indptr = self.adjacency.indptr
+        self.indices = self.adjacency.indices
+
+        coloring = nx.greedy_color(network.graph, strategy="largest_first")
+        colors = np.array([coloring[node] for node in self.nodes])
+        self.sublattices = [np.flatnonzero(colors == c) for c in np.unique(colors)]
+        self._rows = [self.adjacency[sub] for sub in self.sublattices]
+        # rounds of random independent sets per canonical sweep, so that
+        # each point is picked about once
+        self._rounds = int(np.diff(self.indptr).max(initial=0)) + 1
+
+        spins = np.array([node.spin for node in self.nodes])
+        if all(s in (-1, 1) for s in spins):
+            self.spins = np.repeat(spins[:, None], replicas, axis=1).astype("int8")
+        else:
+            self.spins = self.rng.choice(np.array([-1, 1], dtype="int8"), (n, replicas))
+        self.energies = np.zeros((0, replicas))
+        self.averages = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def set_composition(self, x):
+        """
+        Sets a random arrangement of spins with a fraction `x` of up spins in
+        every replica.
+        """
+        n, replicas = self.spins.shape
+        order = np.argsort(self.rng.random((n, replicas)), axis=0)
+        spins = np.where(order < int(round(x * n)), 1, -1)
+        self.spins = spins.astype("int8")
+
+    def write_spins(self, replica=0):
+        """Sets the spins of the lattice points to those of `replica`."""
+        for node, spin in zip(self.nodes, self.spins[:, replica]):
+            node.spin = int(spin)
+
+    def get_energies(self):
+        """Energy per point of each replica."""
+        local = self.adjacency.dot(self.spins)
+        energy = -self.interaction * (self.spins * local).sum(axis=0) / 2.0
+        energy -= self.field * self.spins.sum(axis=0)
+        return energy / len(self)
+
+    def get_compositions(self):
+        """Fraction of up spins of each replica."""
+        return (self.spins > 0).mean(axis=0)
+
+    def flip_sweep(self, temperature, mu=0):
+        """Attempts to flip every spin once, one sublattice at a time."""
+        for sub, rows in zip(self.sublattices, self._rows):
+            spins = self.spins[sub]
+            local = rows.dot(self.spins)
+            de = spins * (2 * (self.interaction * local + self.field) + mu)
+            accept = self.rng.random(spins.shape) < np.exp(
+                -np.maximum(de, 0) / temperature
+            )
+            self.spins[sub] = np.where(accept, -spins, spins)
+
+    def swap_sweep(self, temperature):
+        """
+        Attempts swaps of unlike spins, about one per point.
+
+        In each round, the points whose random priority is higher than those
+        of all their neighbors form an independent set. In each replica, the
+        up and the down spins of the set are paired at random, and each pair
+        is swapped with the Metropolis probability.
+        """
+        n, replicas = self.spins.shape
+        columns = np.arange(replicas)
+        for _ in range(self._rounds):
+            priority = self.rng.random(n)
+            highest = np.maximum.reduceat(priority[self.indices], self.indptr[:-1])
+            chosen = np.flatnonzero(priority > highest)
+            if not len(chosen):
+                continue
+
+            # up spins first then down spins, each in random order
+            spins = self.spins[chosen]
+            keys = -spins + self.rng.random(spins.shape)
+            order = np.argsort(keys, axis=0)
+            ups = (spins > 0).sum(axis=0)
+            pairs = np.minimum(ups, len(chosen) - ups)
+            rank = np.arange(len(chosen))[:, None]
+            valid = rank < pairs
+            up = np.take_along_axis(order, np.where(valid, rank, 0), axis=0)
+            down = np.take_along_axis(
+                order, np.where(valid, rank + ups, 0) % len(chosen), axis=0
+            )
+            up, down = chosen[up], chosen[down]
+
+            local = self.adjacency.dot(self.spins)
+            de = 2 * self.interaction * (local[up, columns] - local[down, columns])
+            accept = valid & (
+                self.rng.random(valid.shape) < np.exp(-np.maximum(de, 0) / temperature)
+            )
+            self.spins[up[accept], np.broadcast_to(columns, up.shape)[accept]] = -1
+            self.spins[down[accept], np.broadcast_to(columns, up.shape)[accept]] = 1
+
+    def run(self, temperature, sweeps=1000, equilibration=100, mu=None):
+        """
+        Runs `equilibration` sweeps, then `sweeps` sweeps over which the
+        energies and compositions of the replicas are averaged.
+
+        The run is canonical (the composition of each replica is fixed) if
+        `mu` is None, and grand canonical at a chemical potential `mu`
+        otherwise.
+
+        Returns:
+            `averages`
+
+        """
+        if mu is None:
+            sweep = lambda: self.swap_sweep(temperature)
+        else:
+            sweep = lambda: self.flip_sweep(temperature, mu)
+        for _ in range(equilibration):
+            sweep()
+
+        replicas = self.spins.shape[1]
+        self.energies = np.zeros((sweeps, replicas))
+        composition = np.zeros(replicas)
+        for i in range(sweeps):
+            sweep()
+            self.energies[i] = self.get_energies()
+            composition += self.get_compositions()
+
+        energy = self.energies.mean(axis=0)
+        energy2 = (self.energies ** 2).mean(axis=0)
+        self.averages = {
+            "energy": energy,
+            "energy2": energy2,
+            "composition": composition / max(sweeps, 1),
+            "heat_capacity": len(self) * (energy2 - energy ** 2) / temperature ** 2,
+        }
+        return self.averages
+
+    def temperature_scan(self, temperatures, mu=None, **kwargs):
+        """
+        Runs at each of `temperatures` in turn (see `run`), each run starting
+        from the final spins of the previous one.
+
+        Returns:
+            Dictionary of `averages`, each an array of shape
+            (len(temperatures), replicas).
+
+        """
+        return self._scan([(t, mu) for t in temperatures], **kwargs)
+
+    def mu_scan(self, mus, temperature, **kwargs):
+        """
+        Runs grand canonically at each of the chemical potentials `mus` in
+        turn, at a fixed `temperature` (see `temperature_scan`).
+        """
+        return self._scan([(temperature, mu) for mu in mus], **kwargs)
+
+    def _scan(self, conditions, **kwargs):
+        """Runs at each (temperature, mu) and stacks the averages."""
+        results = []
+        for temperature, mu in conditions:
+            results.append(self.run(temperature, mu=mu, **kwargs))
+        return dict((key, np.array([r[key] for r in results])) for key in results[0])
@@ -2,10 +2,12 @@ import numpy as np
 import numpy.linalg as linalg
 import itertools
 from collections import defaultdict
+from multiprocessing import Pool
 import logging
 
 import qmpy
 from qmpy.utils import *
+from qmpy.analysis.nearest_neighbors import get_neighbor_list
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +18,9 @@ class PDF(object):
 
     Attributes:
         structure: :mod:`~qmpy.Structure`
-        pairs: dict of (atom1, atom2):[distances]
+        pairs: list of (element1, element2) pairs
+        distances: dict of (element1, element2):array of distances
+        weights: dict of (element1, element2):array of weights
         limit: maximum distance
     """
 
@@ -24,72 +28,249 @@ class PDF(object):
         elements = list(structure.comp.keys())
         pairs = itertools.combinations_with_replacement(elements, r=2)
         self.pairs = [self.get_pair(pair) for pair in pairs]
-        self.distances = dict((p, []) for p in self.pairs)
-        self.weights = dict((p, []) for p in self.pairs)
+        self.distances = dict((p, np.zeros(0)) for p in self.pairs)
+        self.weights = dict((p, np.zeros(0)) for p in self.pairs)
 
-        structure = structure.copy()
-        # `get_symmetry_dataset` cannot handle the reduced output?
-        structure.reduce()
-        structure.symmetrize()
         self.structure = structure
         self.cell = self.structure.cell
-        self.uniq = self.structure.uniq_sites
-        self.sites = self.structure.sites
         self.limit = limit
         self.limit2 = limit ** 2
-        lp = structure.find_lattice_points_within_distance(limit)
-        self.lattice_points = np.array([np.dot(p, self.cell) for p in lp])
+
+    @property
+    def sites(self):
+        return self.structure.sites
+
+    @property
+    def uniq(self):
+        return self.structure.uniq_sites
 
     def get_pair(self, pair):
         return tuple(sorted(pair))
 
     def get_pair_distances(self):
         """
-        Loops over pairs of atoms that are within radius max_dist of one another.
-        Returns a dict of (atom1, atom2):[list of distances].
+        Finds all pairs of atoms that are within `limit` of one another, and
+        sorts their distances by the pair of elements. Each pair is weighted
+        by the product of the occupancies of the two atoms.
+
+        """
+        structure = self.structure
+        i, j, images, distances = get_neighbor_list(structure, self.limit)
+        bonds = distances > 1e-3
+        i, j, distances = i[bonds], j[bonds], distances[bonds]
+        weights = structure.arrays.occupancies
+        weights = weights[i] * weights[j]
 
+        # index of the (sorted) pair of elements of each bond
+        types = structure.atom_types
+        elements = sorted(set(types))
+        codes = np.searchsorted(elements, types)
+        n = len(elements)
+        keys = np.minimum(codes[i], codes[j]) * n + np.maximum(codes[i], codes[j])
+        for pair in self.pairs:
+            e1, e2 = [elements.index(e) for e in pair]
+            mask = keys == e1 * n + e2
+            self.distances[pair] = distances[mask]
+            self.weights[pair] = weights[mask]
+
+    def get_rdf(self, smearing=0.1, npoints=1000):
         """
-        for s1 in self.uniq:
-            for s2 in self.sites:
-                _dist = s1.cart_coord - s2.cart_coord
-                for lp in self.lattice_points:
-                    dist = _dist + lp
-                    if any([abs(p) > self.limit for p in dist]):
-                        continue
-                    dist2 = np.dot(dist, dist)
-                    if dist2 < 1e-6:
-                        continue
-                    if dist2 > self.limit2:
-                        continue
-                    distance = dist2 ** 0.5
-
-                    for a1, a2 in itertools.product(s1, s2):
-                        pair = self.get_pair([a1.element_id, a2.element_id])
-                        w = s1.multiplicity * a1.occupancy * a2.occupancy
-                        self.distances[pair].append(float(distance))
-                        self.weights[pair].append(float(w))
+        Computes the Gaussian broadened, shell volume normalized distribution
+        of distances for each pair of elements.
+
+        Distances are histogrammed on a fixed grid from 0.5 to `limit`
+        Angstroms, splitting each weight linearly between the two nearest
+        grid points, and then convolved with a Gaussian of width `smearing`.
+
+        Returns:
+            (grid, dict of (element1, element2):array of values on grid)
+
+        """
+        xs = np.linspace(0.5, self.limit, npoints)
+        dr = xs[1] - xs[0]
+        pad = int(np.ceil(5 * smearing / dr))
+        kernel = np.exp(-((np.arange(-pad, pad + 1) * dr) ** 2) / (2 * smearing ** 2))
+        norms = (xs + dr / 2) ** 3 - (xs - dr / 2) ** 3
+        prefactor = 1.0 / (smearing * np.sqrt(2 * np.pi))
+        size = npoints + 2 * pad + 1
+
+        rdf = {}
+        for pair in self.pairs:
+            x = (self.distances[pair] - xs[0]) / dr + pad
+            weights = self.weights[pair]
+            inside = (x >= 0) & (x < size - 1)
+            x, weights = x[inside], weights[inside]
+            lower = np.floor(x).astype(int)
+            frac = x - lower
+            hist = np.bincount(lower, weights=weights * (1 - frac), minlength=size)
+            hist += np.bincount(lower + 1, weights=weights * frac, minlength=size)
+            vals = np.convolve(hist[:-1], kernel, mode="valid")
+            vals = prefactor * vals / norms
+            vals[vals <= 1e-4] = 0.0
+            rdf[pair] = vals
+        return xs, rdf
 
     def plot(self, smearing=0.1):
         renderer = Renderer()
-        N = len(self.structure)
-        V = self.structure.get_volume()
-        xs = np.mgrid[0.5 : self.limit : 1000j]
-        dr = xs[1] - xs[0]
-        norms = [((x + dr / 2) ** 3 - (x - dr / 2) ** 3) for x in xs]
+        xs, rdf = self.get_rdf(smearing=smearing)
         for pair in self.pairs:
             e1, e2 = pair
-            vals = np.zeros(xs.shape)
-            nanb = self.structure.comp[e1] * self.structure.comp[e2]
-            prefactor = 1.0 / (smearing * np.sqrt(2 * np.pi))
-            # prefactor = V**2 * (N-1)/N
-            for w, d in zip(self.weights[pair], self.distances[pair]):
-                if not d:
-                    continue
-                vals += np.exp(-((d - xs) ** 2) / (2 * smearing ** 2)) * w
-            vals = prefactor * vals / norms
-            vals = [v if v > 1e-4 else 0.0 for v in vals]
-            line = Line(list(zip(xs, vals)), label="%s-%s" % (e1, e2))
+            line = Line(list(zip(xs, rdf[pair])), label="%s-%s" % (e1, e2))
             renderer.add(line)
 
         renderer.xaxis.label = "interatomic distance [&#8491;]"
         return renderer
+
+
+def get_pdf_fingerprint(structure, limit=4.0, npoints=64, smearing=0.1):
+    """
+    Fixed length, composition independent fingerprint of `structure`: the
+    total distance distribution (see :meth:`PDF.get_rdf`) of the structure
+    rescaled to one cubic Angstrom per atom, up to `limit` in these reduced
+    units, normalized to unit length.
+
+    Structures with the same arrangement of atoms but different lattice
+    parameters or elements have the same fingerprint, and the dot product of
+    two fingerprints measures how similar the structures are.
+
+    Returns:
+        numpy.ndarray of shape (`npoints`,), dtype float32.
+
+    """
+    s = structure.copy()
+    s.set_volume(len(s))
+    pdf = PDF(s, limit=limit)
+    pdf.get_pair_distances()
+    rdf = pdf.get_rdf(smearing=smearing, npoints=npoints)[1]
+    vector = np.sum(list(rdf.values()), axis=0)
+    return np.array(vector / max(linalg.norm(vector), 1e-12), dtype="float32")
+
+
+class PDFIndex(object):
+    """
+    In-memory index of structure PDF fingerprints (see
+    :func:`get_pdf_fingerprint`), to find the stored structures most similar
+    to a given one without comparing them all.
+
+    Similarities are cosine similarities, between 0 (no common distances)
+    and 1 (identical fingerprints), found with one matrix product.
+
+    Attributes:
+        ids: Structure ids, numpy.ndarray of shape (N,).
+        vectors: Fingerprints, numpy.ndarray of shape (N, npoints).
+
+    Examples::
+
+        >>> index = PDFIndex.from_database()
+        >>> index.save('/tmp/pdf_index.npz')
+        >>> index = PDFIndex.load('/tmp/pdf_index.npz')
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_NaCl')
+        >>> index.query(s, k=3)
+        [(1204, 0.99998), (1377, 0.99997), (98, 0.99012)]
+
+    """
+
+    def __init__(self, ids=None, vectors=None):
+        self.ids = np.zeros(0, dtype="int64")
+        self.vectors = np.zeros((0, 0), dtype="float32")
+        if ids is not None:
+            self.add(ids, vectors)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, vectors):
+        """Adds fingerprints `vectors` of the structures with ids `ids`."""
+        vectors = np.array(vectors, dtype="float32").reshape(len(ids), -1)
+        if not len(self):
+            self.vectors = vectors
+        else:
+            self.vectors = np.vstack([self.vectors, vectors])
+        self.ids = np.append(self.ids, np.array(ids, dtype="int64"))
+
+    def query(self, structure, k=10):
+        """
+        Finds the `k` indexed structures most similar to `structure`, which
+        may be a :mod:`~qmpy.Structure` or a fingerprint.
+
+        Returns:
+            List of (structure id, similarity), most similar first.
+
+        """
+        if isinstance(structure, qmpy.Structure):
+            vector = structure.get_pdf_fingerprint()
+        else:
+            vector = np.array(structure, dtype="float32")
+        if not len(self):
+            return []
+        scores = self.vectors.dot(vector)
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(int(self.ids[i]), float(scores[i])) for i in best]
+
+    def save(self, path):
+        """Writes the index to the .npz file `path`."""
+        # through a file, so np.savez does not append .npz to the path
+        with open(path, "wb") as f:
+            np.savez(f, ids=self.ids, vectors=self.vectors)
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by `save`."""
+        data = np.load(path)
+        return cls(data["ids"], data["vectors"])
+
+    @classmethod
+    def from_database(cls, structures=None, batch_size=500):
+        """
+        Builds an index of `structures` (a Structure QuerySet, by default all
+        structures), first computing and storing any missing fingerprints.
+        """
+        if structures is None:
+            structures = qmpy.Structure.objects.all()
+        structures.update_pdf_fingerprints(batch_size=batch_size)
+        ids, vectors = [], []
+        rows = structures.values_list("id", "pdf_fingerprint")
+        for id, vector in rows.iterator(chunk_size=batch_size):
+            ids.append(id)
+            vectors.append(np.frombuffer(vector, dtype="<f4"))
+        return cls(ids, vectors)
+
+
+def get_rdfs(structures, limit=10, smearing=0.1, npoints=1000, processes=1):
+    """
+    Computes the distance distributions (see :meth:`PDF.get_rdf`) of many
+    structures, on a common grid.
+
+    Keyword Arguments:
+        processes:
+            Number of worker processes. If None, uses all available cpus.
+            Default=1
+
+    Returns:
+        (grid, list of dicts of (element1, element2):array of values)
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_NaCl')
+        >>> grid, rdfs = get_rdfs([s, s.copy()], processes=2)
+        >>> sorted(rdfs[0].keys())
+        [('Cl', 'Cl'), ('Cl', 'Na'), ('Na', 'Na')]
+
+    """
+    tasks = [(s, limit, smearing, npoints) for s in structures]
+    if processes != 1 and len(tasks) > 1:
+        with Pool(processes) as pool:
+            rdfs = pool.map(_get_rdf, tasks, chunksize=max(1, len(tasks) // 64))
+    else:
+        rdfs = list(map(_get_rdf, tasks))
+    return np.linspace(0.5, limit, npoints), rdfs
+
+
+def _get_rdf(args):
+    """Computes the distance distributions of a structure, see `get_rdfs`."""
+    structure, limit, smearing, npoints = args
+    pdf = PDF(structure, limit=limit)
+    pdf.get_pair_distances()
+    return pdf.get_rdf(smearing=smearing, npoints=npoints)[1]
@@ -1,5 +1,7 @@
 # wrappers for spglib functions | https://atztogo.github.io/spglib/
+import copy
 import fractions as frac
+import hashlib
 import numpy as np
 import logging
 
@@ -7,6 +9,7 @@ import qmpy
 
 import qmpy.data as data
 from qmpy.utils import *
+from qmpy.utils.cache import LRUCache
 
 try:
     import spglib
@@ -17,6 +20,9 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# spglib results, keyed by (function, hash of the spglib cell, arguments)
+SPGLIB_CACHE = LRUCache(maxsize=1024)
+
 
 def _check_spglib_install():
     """Imports `spglib`, raises :exc:`ImportError` if unsuccessful."""
@@ -84,6 +90,37 @@ def _structure_to_cell(structure):
         return (lattice, positions, numbers, magmoms)
 
 
+def _cell_key(cell):
+    """
+    Returns a hash of the lattice, positions, atom types and magmoms of a
+    `spglib` cell (see `_structure_to_cell()`).
+    """
+    digest = hashlib.sha1()
+    for array in cell:
+        array = np.ascontiguousarray(array, dtype="float64")
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _cached_spglib(func, structure, **kwargs):
+    """
+    Calls `spglib.<func>` on the cell of `structure` with `kwargs`, or
+    returns the stored result of an earlier call with the same arguments
+    and an identical cell.
+
+    Since the key is built from the cell itself, changing the cell, the
+    coordinates, the species or the magnetic moments of a structure never
+    returns a stale result. Each caller gets its own copy of the result, so
+    it may be modified freely.
+    """
+    _check_spglib_install()
+    cell = _structure_to_cell(structure)
+    key = (func, _cell_key(cell), tuple(sorted(kwargs.items())))
+    result = SPGLIB_CACHE.get_or_set(key, getattr(spglib, func), cell, **kwargs)
+    return copy.deepcopy(result)
+
+
 def _cell_to_structure(cell, structure, rev_lookup):
     """
     Assign crystal structure info in `cell` onto `structure`.
@@ -100,10 +137,11 @@ def _cell_to_structure(cell, structure, rev_lookup):
     """
     if not isinstance(structure, qmpy.Structure):
         raise qmpy.StructureError("Input is not of type `qmpy.Structure`")
-    structure.cell = cell[0]
+    # `cell` may be a cached result, so only copies of it are assigned
+    structure.cell = np.array(cell[0])
     nsites = len(cell[1])
     structure.set_nsites(nsites)
-    structure.site_coords = cell[1]
+    structure.site_coords = np.array(cell[1])
     site_comps = [rev_lookup[k] for k in cell[2]]
     structure.site_compositions = site_comps
 
@@ -127,8 +165,7 @@ def get_structure_symmetry(structure, symprec=1e-3):
         ImportError: If `spglib` cannot be imported.
 
     """
-    _check_spglib_install()
-    return spglib.get_symmetry(_structure_to_cell(structure), symprec=symprec)
+    return _cached_spglib("get_symmetry", structure, symprec=symprec)
 
 
 def get_symmetry_dataset(structure, symprec=1e-3):
@@ -175,8 +212,7 @@ def get_symmetry_dataset(structure, symprec=1e-3):
         ImportError: If `spglib` cannot be imported.
 
     """
-    _check_spglib_install()
-    return spglib.get_symmetry_dataset(_structure_to_cell(structure), symprec=symprec)
+    return _cached_spglib("get_symmetry_dataset", structure, symprec=symprec)
 
 
 def get_spacegroup(structure, symprec=1e-3, symbol_type=0):
@@ -197,9 +233,8 @@ def get_spacegroup(structure, symprec=1e-3, symbol_type=0):
         ImportError: If `spglib` cannot be imported.
 
     """
-    _check_spglib_install()
-    return spglib.get_spacegroup(
-        _structure_to_cell(structure), symprec=symprec, symbol_type=symbol_type
+    return _cached_spglib(
+        "get_spacegroup", structure, symprec=symprec, symbol_type=symbol_type
     )
 
 
@@ -282,8 +317,9 @@ def standardize_cell(
     rev_lookup = dict(
         list(zip(structure.site_comp_indices, structure.site_compositions))
     )
-    cell = spglib.standardize_cell(
-        _structure_to_cell(structure),
+    cell = _cached_spglib(
+        "standardize_cell",
+        structure,
         to_primitive=to_primitive,
         no_idealize=no_idealize,
         symprec=symprec,
@@ -311,7 +347,7 @@ def refine_cell(structure, symprec=1e-3, verbosity=0):
     rev_lookup = dict(
         list(zip(structure.site_comp_indices, structure.site_compositions))
     )
-    cell = spglib.refine_cell(_structure_to_cell(structure), symprec=symprec)
+    cell = _cached_spglib("refine_cell", structure, symprec=symprec)
     if not _check_spglib_success(cell, func="refine_cell", verbosity=verbosity):
         return structure
     _cell_to_structure(cell, structure, rev_lookup)
@@ -335,7 +371,7 @@ def find_primitive(structure, symprec=1e-3, verbosity=0):
     rev_lookup = dict(
         list(zip(structure.site_comp_indices, structure.site_compositions))
     )
-    cell = spglib.find_primitive(_structure_to_cell(structure), symprec=symprec)
+    cell = _cached_spglib("find_primitive", structure, symprec=symprec)
     if not _check_spglib_success(cell, func="find_primitive", verbosity=verbosity):
         return structure
     _cell_to_structure(cell, structure, rev_lookup)
@@ -60,3 +60,36 @@ class SpacegroupTestCase(TestCase):
 
         # a simple application of symmetry operations
         self.assertEqual(len(sg.equivalent_sites([0.25, 0.25, 0.25])), 8)
+
+
+class SpglibCacheTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        read_spacegroups([225, 139])
+        self.fcc = io.read(INSTALL_PATH + "/io/files/POSCAR_FCC")
+
+    def test_cache(self):
+        from qmpy.analysis.symmetry.routines import SPGLIB_CACHE
+
+        SPGLIB_CACHE.clear()
+        self.fcc.symmetrize()
+        self.fcc.symmetrize()
+        get_symmetry_dataset(self.fcc.copy())
+        self.assertEqual((SPGLIB_CACHE.misses, SPGLIB_CACHE.hits), (1, 2))
+
+        # changing the lattice changes the key
+        self.fcc.cell = self.fcc.cell.dot(np.diag([1, 1, 1.1]))
+        self.fcc.symmetrize()
+        self.assertEqual(SPGLIB_CACHE.misses, 2)
+        self.assertEqual(self.fcc.spacegroup.number, 139)
+
+        # results shared through the cache are not modified
+        fcc = io.read(INSTALL_PATH + "/io/files/POSCAR_FCC")
+        fcc.make_primitive()
+        fcc2 = io.read(INSTALL_PATH + "/io/files/POSCAR_FCC")
+        fcc2.make_primitive()
+        self.assertTrue(np.allclose(fcc.cell, fcc2.cell))
+        self.assertEqual(len(fcc2), 1)
+        dataset = get_symmetry_dataset(fcc)
+        dataset["rotations"][:] = 0
+        self.assertTrue(get_symmetry_dataset(fcc)["rotations"].any())
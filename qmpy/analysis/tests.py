@@ -1,6 +1,9 @@
 import os
+import tempfile
+import warnings
 
 from qmpy import *
+from qmpy.analysis.vasp.potential import POTENTIAL_SET_CACHE
 from django.test import TestCase
 
 peak_locations = []
@@ -24,11 +27,341 @@ class MiedemaTestCase(TestCase):
         ## test that it is quantity invariant
         self.assertEqual(Miedema("Fe5Ni5").energy, -0.03)
 
+    def test_batch(self):
+        comps = ["FeNi", "LiBe", "PtTi3", "Fe2O3", "Fe"]
+        energies = get_miedema_energies(comps)
+        expected = [Miedema(c).energy for c in comps[:3]]
+        self.assertTrue(np.allclose(energies[:3], expected, atol=0.005))
+        self.assertTrue(np.isnan(energies[3]))
+        self.assertEqual(energies[4], 0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            self.assertTrue(np.isnan(get_miedema_energies(["Fe2O3"])[0]))
+
+        binary = miedema_binary_energies(["Pt"], ["Ti"], [0.75])
+        self.assertAlmostEqual(binary[0], energies[2])
+        # a third element with no amount changes nothing
+        ternary = miedema_energies(
+            [["Fe", "Ni", "O"], ["Fe", "Ni", "Pt"]], [[1, 1, 0], [1, 1, 2]]
+        )
+        self.assertAlmostEqual(ternary[0], energies[0])
+        # each pair contributes its binary energy, weighted by the square of
+        # its total fraction
+        pairs = miedema_binary_energies(
+            ["Fe", "Fe", "Ni"], ["Ni", "Pt", "Pt"], [0.5, 2 / 3.0, 2 / 3.0]
+        )
+        self.assertAlmostEqual(ternary[1], pairs.dot([0.25, 0.5625, 0.5625]))
+
+
+class FeaturizerTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+
+    def test_features(self):
+        path = os.path.join(tempfile.mkdtemp(), "features.npz")
+        featurizer = CompositionFeaturizer(cache=path)
+        X = featurizer.featurize(["Fe2O3", {"Fe": 4, "O": 6}, "Na"])
+        names = featurizer.feature_names
+        self.assertEqual(X.shape, (3, len(names)))
+        self.assertTrue(np.allclose(X[0], X[1]))
+        z = [X[0, names.index("%s_z" % stat)] for stat in ["mean", "var", "min", "max"]]
+        self.assertTrue(np.allclose(z, [15.2, 77.76, 8, 26]))
+        self.assertEqual(X[0, names.index("norm_0")], 2)
+        self.assertAlmostEqual(X[2, names.index("norm_5")], 1)
+
+        cached = CompositionFeaturizer(cache=path)
+        self.assertEqual(len(cached._load()), 2)
+        self.assertTrue(np.allclose(cached.featurize(["O3Fe2"]), X[0]))
+
+        # the cache is written to the given path, with or without a suffix
+        path = os.path.join(tempfile.mkdtemp(), "features")
+        CompositionFeaturizer(cache=path).featurize(["Fe2O3"])
+        self.assertEqual(len(CompositionFeaturizer(cache=path)._load()), 1)
+
+        s = io.read(os.path.join(INSTALL_PATH, "io", "files", "POSCAR_FCC"))
+        structural = CompositionFeaturizer(structural=True)
+        X = structural.featurize([s])
+        self.assertEqual(X.shape, (1, len(structural.feature_names)))
+        self.assertAlmostEqual(X[0, -1], s.get_volume() / 4)
+
 
 class PDFTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        self.fcc = io.read(os.path.join(INSTALL_PATH, "io", "files", "POSCAR_FCC"))
+
     def test_distances(self):
         pass
 
+    def test_rdf(self):
+        pdf = self.fcc.get_pdf(limit=4)
+        # 12 nearest and 6 second nearest neighbors of each of the 4 atoms
+        self.assertEqual(len(pdf.distances[("Fe", "Fe")]), 4 * 18)
+
+        xs, rdf = pdf.get_rdf()
+        self.assertAlmostEqual(xs[np.argmax(rdf[("Fe", "Fe")])], 2.563, delta=0.02)
+        grid, rdfs = get_rdfs([self.fcc, self.fcc.copy()], limit=4, processes=2)
+        self.assertTrue(np.allclose(grid, xs))
+        self.assertTrue(np.allclose(rdfs[1][("Fe", "Fe")], rdf[("Fe", "Fe")]))
+
+    def test_pdf_index(self):
+        bcc = io.read(os.path.join(INSTALL_PATH, "io", "files", "POSCAR_BCC"))
+        big = self.fcc.copy()
+        big.set_volume(big.get_volume() * 1.3)
+        read_spacegroups([225, 229])
+        for s in [self.fcc, bcc, big]:
+            s.save()
+
+        index = PDFIndex.from_database(Structure.objects.all())
+        self.assertEqual(len(index), 3)
+        self.assertIsNotNone(Structure.objects.get(id=bcc.id).pdf_fingerprint)
+        # written to the given path, even without the .npz suffix
+        path = os.path.join(tempfile.mkdtemp(), "index")
+        index.save(path)
+        results = PDFIndex.load(path).query(self.fcc.copy(), k=2)
+        self.assertEqual(sorted(r[0] for r in results), [self.fcc.id, big.id])
+        self.assertAlmostEqual(results[0][1], 1.0, places=4)
+        self.assertAlmostEqual(results[1][1], 1.0, places=4)
+        self.assertLess(index.query(bcc, k=3)[-1][1], 0.9)
+
+
+class BondValenceTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        path = os.path.join(INSTALL_PATH, "io", "files")
+        self.fe3o4 = io.read(os.path.join(path, "fe3o4.cif"))
+        self.fcc = io.read(os.path.join(path, "POSCAR_FCC"))
+
+    def test_assign(self):
+        s = self.fe3o4
+        ox = assign_oxidation_states(s)
+        self.assertAlmostEqual(ox.dot(s.occupancies), 0)
+        self.assertEqual(sorted(set(ox)), [-2, 2, 3])
+        self.assertEqual(list(ox[s.atom_types == "Fe"]).count(3), 8)
+        self.assertLess(get_global_instability_index(s, ox), 0.2)
+        # mismatched valences are much less stable
+        self.assertGreater(get_global_instability_index(s, -ox), 1)
+        self.assertIsNone(assign_oxidation_states(self.fcc))
+
+    def test_queryset(self):
+        for s in [self.fe3o4, self.fcc]:
+            s.save(symmetrize=False)
+        self.assertEqual(Structure.objects.all().assign_oxidation_states(), 1)
+        s = Structure.objects.get(species_set="Fe3+")
+        self.assertEqual(s.id, self.fe3o4.id)
+        self.assertEqual(s.atoms[-1].ox, -2)
+        fcc = Structure.objects.get(id=self.fcc.id)
+        self.assertTrue(np.isnan(fcc.oxidation_states).all())
+
+
+class ElasticTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        path = os.path.join(INSTALL_PATH, "io", "files")
+        self.fcc = io.read(os.path.join(path, "POSCAR_FCC"))
+        self.hcp = io.read(os.path.join(path, "POSCAR_HCP"))
+
+    def test_strain_set(self):
+        self.assertEqual(get_laue_class(self.fcc), "m-3m")
+        self.assertEqual(get_laue_class(self.hcp), "6/mmm")
+        self.assertEqual(get_strain_set(self.fcc).tolist(), [[1, 0, 0, 1, 0, 0]])
+        self.assertEqual(len(get_strain_set(self.hcp)), 2)
+        deformations = get_deformations(self.hcp, magnitudes=[-0.01, 0.01])
+        self.assertEqual(len(deformations), 4)
+        strain, deformed = deformations[0]
+        self.assertTrue(np.allclose(deformed.coords, self.hcp.coords))
+        self.assertFalse(np.allclose(deformed.cell, self.hcp.cell))
+
+    def test_fit(self):
+        C = np.zeros((6, 6))
+        C[:3, :3] = 120
+        C[[0, 1, 2], [0, 1, 2]] = 170
+        C[[3, 4, 5], [3, 4, 5]] = 75
+        calcs = []
+        for strain, deformed in get_deformations(self.fcc):
+            calc = Calculation(converged=True)
+            calc.input = deformed
+            calc.output = deformed.copy()
+            stress = C.dot(strain) + 0.5
+            # as written by VASP, in kB with xy, yz, zx shear components
+            calc.output.stresses = -10 * stress[[0, 1, 2, 5, 3, 4]]
+            calcs.append(calc)
+        et = ElasticTensor.from_calculations(self.fcc, calcs)
+        self.assertTrue(np.allclose(et.voigt, C, atol=0.5))
+        self.assertTrue(np.allclose(et.residual_stress, 0.5, atol=0.1))
+        self.assertAlmostEqual(et.bulk_modulus, 136.7, places=0)
+        self.assertGreater(et.universal_anisotropy, 0)
+        self.assertTrue(et.is_stable)
+
+        C[[3, 4, 5], [3, 4, 5]] = 25
+        isotropic = ElasticTensor(C)
+        self.assertAlmostEqual(isotropic.universal_anisotropy, 0)
+        self.assertAlmostEqual(isotropic.shear_modulus, 25)
+        self.assertAlmostEqual(isotropic.poisson_ratio, 120 / 290.0)
+
+
+class InterfaceFinderTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        path = os.path.join(INSTALL_PATH, "io", "files")
+        self.fcc = io.read(os.path.join(path, "POSCAR_FCC"))
+        self.bcc = io.read(os.path.join(path, "POSCAR_BCC"))
+
+    def test_surface_cells(self):
+        cells = get_surface_cells(self.fcc.make_primitive(in_place=False), 5)
+        self.assertTrue(np.all(np.diff(cells.area) >= 0))
+        self.assertTrue(np.all(cells.a <= cells.b + 1e-8))
+        self.assertTrue(np.all((cells.cos <= 1e-8) & (cells.cos >= -0.5 - 1e-8)))
+        # the close packed plane: 4 equivalent {111} planes of the fcc cell
+        nn = 3.62465 / np.sqrt(2)
+        self.assertAlmostEqual(cells.area[0], np.sqrt(3) / 2 * nn ** 2)
+        self.assertAlmostEqual(cells.cos[0], -0.5)
+        self.assertEqual(cells.multiplicity[0], 4)
+
+    def test_interfaces(self):
+        finder = InterfaceFinder(self.fcc, self.fcc, max_dist=6, max_strain=0.01)
+        sa, sb, strain = finder.interfaces[0]
+        self.assertAlmostEqual(strain, 0)
+        self.assertAlmostEqual(sa.area, sb.area)
+
+        finder = InterfaceFinder(self.fcc, self.bcc, max_dist=8, max_strain=0.05)
+        strains = [strain for sa, sb, strain in finder.interfaces]
+        self.assertTrue(strains)
+        self.assertEqual(strains, sorted(strains))
+        self.assertLess(max(strains), 0.05)
+        sa, sb, strain = finder.interfaces[0]
+        self.assertAlmostEqual(sa * sb, strain)
+
+
+class XRDTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+
+    def test_peaks(self):
+        path = os.path.join(INSTALL_PATH, "io", "files")
+        s = io.read(os.path.join(path, "POSCAR_FCC"))
+        fcc = s.get_xrd()
+        s.make_primitive()
+        prim = s.get_xrd()
+        peaks = [p for p in fcc.peaks if p.intensity > 1e-8]
+        self.assertEqual([p.multiplicity for p in peaks], [8, 6])
+        self.assertEqual([list(p.hkl[0]) for p in peaks], [[1, 1, 1], [2, 0, 0]])
+        self.assertAlmostEqual(peaks[0].two_theta, 43.23, places=2)
+        # the primitive cell has the same pattern, without extinct reflections
+        self.assertEqual(len(prim.peaks), 2)
+        for p1, p2 in zip(peaks, prim.peaks):
+            self.assertAlmostEqual(p1.two_theta, p2.two_theta)
+            self.assertAlmostEqual(p1.intensity, p2.intensity)
+
+        hcp = io.read(os.path.join(path, "POSCAR_HCP")).get_xrd()
+        mults = dict((tuple(p.hkl[0]), p.multiplicity) for p in hcp.peaks)
+        self.assertEqual(mults[(0, 0, 2)], 2)
+        self.assertEqual(mults[(1, 0, 1)], 12)
+
+    def test_xrd_index(self):
+        read_spacegroups([225, 229, 194, 221])
+        path = os.path.join(INSTALL_PATH, "io", "files")
+        structures = []
+        for name in ["POSCAR_FCC", "POSCAR_BCC", "POSCAR_NaCl", "POSCAR_HCP"]:
+            structures.append(io.read(os.path.join(path, name)))
+            structures[-1].save()
+        index = XRDIndex.from_database(Structure.objects.all(), processes=2)
+        self.assertEqual(len(index), 4)
+        # written to the given path, even without the .npz suffix
+        path = os.path.join(tempfile.mkdtemp(), "index")
+        index.save(path)
+        index = XRDIndex.load(path)
+
+        # a "measurement" of bcc Fe with a 1% larger lattice
+        bcc = structures[1].copy()
+        bcc.set_volume(bcc.get_volume() * 1.01 ** 3)
+        peaks = bcc.get_xrd().peaks
+        two_theta = [p.two_theta for p in peaks]
+        intensities = [p.intensity for p in peaks]
+        results = index.search(two_theta, intensities, k=2)
+        self.assertEqual(results[0][0], structures[1].id)
+        self.assertGreater(results[0][1], 0.99)
+        self.assertAlmostEqual(results[0][2], 0.01, delta=0.003)
+        # without searching over strains, the match is poor
+        results = index.search(two_theta, intensities, max_strain=0, nstrains=1)
+        self.assertLess(results[0][1], 0.9)
+
+
+class GridDataTestCase(TestCase):
+    def setUp(self):
+        x, y, z = np.meshgrid(*[np.arange(20) / 20.0] * 3, indexing="ij")
+        data = np.cos(2 * np.pi * x) + np.cos(2 * np.pi * y) + np.cos(2 * np.pi * z)
+        self.grid = GridData(data, lattice=np.eye(3) * 4)
+
+    def test_interpolate(self):
+        grid = self.grid
+        points = np.array([[0.1, 0.2, 0.3], [0.55, 0.95, 1.3], [-0.25, 0, 0]])
+        exact = np.cos(2 * np.pi * points).sum(axis=1)
+        values = grid.interpolate(points)
+        self.assertTrue(np.allclose(values, exact, atol=0.05))
+        self.assertAlmostEqual(grid.interpolate(points[1]), values[1])
+        self.assertAlmostEqual(grid.interpolate(points[1] * 4, cart=True), values[1])
+        # splines are exact on the grid, and more accurate between
+        self.assertAlmostEqual(grid.interpolate([0.1, 0.2, 0.3], order=3), exact[0])
+        spline = grid.interpolate(points + 0.01, order=3)
+        exact = np.cos(2 * np.pi * (points + 0.01)).sum(axis=1)
+        self.assertTrue(np.allclose(spline, exact, atol=1e-3))
+
+        path = grid.path([0, 0, 0], [1, 0, 0], npoints=5)
+        self.assertEqual([round(v, 6) for x, v in path], [3, 2, 1, 2, 3])
+        vals, coords = grid.slice([0.5, 0.5, 0.5], [0, 0, 1], res=10)
+        self.assertTrue(np.allclose(coords, 0.5))
+        self.assertTrue(np.allclose(vals[0, 0], 1.0))
+
+    def test_minima(self):
+        grid = self.grid
+        self.assertEqual(grid.local_minima().tolist(), [[10, 10, 10]])
+        index, value = grid.local_min([2, 3, 18])
+        self.assertEqual(list(index), [10, 10, 10])
+        self.assertAlmostEqual(value, -3)
+        coord, value = grid.refine_min([0.43, 0.6, 0.52], order=3)
+        self.assertTrue(np.allclose(coord, 0.5, atol=1e-3))
+
+    def test_integrate(self):
+        grid = GridData(np.ones((10, 10, 10)), lattice=np.eye(3) * 4)
+        self.assertAlmostEqual(grid.integrate(), 64)
+        volume = grid.integrate([0.9, 0.5, 0.5], radius=1.0)
+        self.assertAlmostEqual(volume, 4 * np.pi / 3, delta=0.06)
+
+
+class LatticeMCTestCase(TestCase):
+    def test_grand_canonical(self):
+        sl = LatticeNetwork.create_2d(8)
+        sl.interaction = 1
+        mc = LatticeMC(sl, replicas=4, seed=0)
+        self.assertEqual(len(mc.sublattices), 2)
+        results = mc.mu_scan([-4, 4], temperature=1.5, sweeps=100)
+        self.assertTrue(np.all(results["composition"][0] < 0.05))
+        self.assertTrue(np.all(results["composition"][1] > 0.95))
+        self.assertTrue(np.all(results["energy"] < -1.8))
+
+        mc.write_spins(replica=2)
+        energy = sl.compute_total_lattice_energy()
+        self.assertAlmostEqual(energy / len(sl), mc.get_energies()[2])
+
+    def test_canonical(self):
+        sl = LatticeNetwork.create_2d(8)
+        mc = LatticeMC(sl, replicas=2, seed=0)
+        mc.set_composition(0.5)
+        results = mc.temperature_scan([3, 2, 1], sweeps=200)
+        self.assertTrue(np.all(results["composition"] == 0.5))
+        # unlike neighbors order into a checkerboard
+        self.assertTrue(np.all(results["energy"][-1] < -1.8))
+        self.assertTrue(np.all(results["energy"][0] > -1.5))
+
+        # the same seed gives the same samples
+        runs = []
+        for i in range(2):
+            mc = LatticeMC(LatticeNetwork.create_2d(8), replicas=2, seed=1)
+            mc.run(2.0, sweeps=20)
+            runs.append(mc.energies)
+        self.assertTrue(np.array_equal(runs[0], runs[1]))
+
 
 class NearestNeighborTestCase(TestCase):
     def setUp(self):
@@ -39,6 +372,17 @@ class NearestNeighborTestCase(TestCase):
         self.bcc = io.poscar.read(os.path.join(sample_files_loc, "POSCAR_BCC"))
         self.sc = io.poscar.read(os.path.join(sample_files_loc, "POSCAR_SC"))
 
+    def test_neighbor_list(self):
+        i, j, images, distances = get_neighbor_list(self.fcc, 3)
+        self.assertEqual(list(np.bincount(i)), [12] * 4)
+        self.assertTrue(np.allclose(distances, self.fcc.lat_params[0] / 2 ** 0.5))
+
+        # the cell is smaller than the cutoff, so atoms neighbor their images
+        i, j, images, distances = get_neighbor_list(self.sc, 3)
+        self.assertEqual(len(i), 18)
+        self.assertTrue((i == j).all())
+        self.assertEqual(sorted(abs(images).sum(axis=1)), [1] * 6 + [2] * 12)
+
     def test_heuristic(self):
         self.fcc.find_nearest_neighbors()
         self.assertEqual(len(self.fcc[0].neighbors), 12)
@@ -49,6 +393,19 @@ class NearestNeighborTestCase(TestCase):
         self.sc.find_nearest_neighbors()
         self.assertEqual(len(self.sc[0].neighbors), 6)
 
+    def test_voronoi_analysis(self):
+        voronoi = self.bcc.get_voronoi()
+        self.assertIs(self.bcc.get_voronoi(), voronoi)
+        self.assertEqual(len(voronoi.faces(0)), 14)
+        solid_angles = np.bincount(voronoi.atoms, weights=voronoi.solid_angles)
+        self.assertTrue(np.allclose(solid_angles, 4 * np.pi))
+        self.assertAlmostEqual(voronoi.volumes.sum(), self.bcc.get_volume())
+        self.assertEqual(len(voronoi.get_neighbors(0, min_area=2)), 8)
+
+        self.assertTrue(np.allclose(self.fcc.get_voronoi().coordination_numbers, 12))
+        self.bcc.cell = self.bcc.cell * 1.1
+        self.assertIsNot(self.bcc.get_voronoi(), voronoi)
+
     def test_voronoi(self):
         self.fcc.find_nearest_neighbors(method="voronoi")
         self.assertEqual(len(self.fcc[0].neighbors), 12)
@@ -60,3 +417,82 @@ class NearestNeighborTestCase(TestCase):
 
         self.sc.find_nearest_neighbors(method="voronoi")
         self.assertEqual(len(self.sc[0].neighbors), 6)
+
+
+class FingerprintTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+
+        sample_files_loc = os.path.join(INSTALL_PATH, "io", "files")
+        self.fcc = io.poscar.read(os.path.join(sample_files_loc, "POSCAR_FCC"))
+        self.fcc2 = io.poscar.read(os.path.join(sample_files_loc, "POSCAR_FCC2"))
+        self.nacl = io.poscar.read(os.path.join(sample_files_loc, "POSCAR_NaCl"))
+
+    def test_fingerprint(self):
+        self.assertEqual(get_fingerprint(self.fcc), get_fingerprint(self.fcc2))
+        self.assertFalse(
+            fingerprints_match(get_fingerprint(self.fcc), get_fingerprint(self.nacl))
+        )
+
+        supercell = self.nacl.copy()
+        supercell.transform([[2, 0, 0], [0, 1, 0], [0, 0, 1]])
+        supercell.set_volume(supercell.get_volume() * 1.1)
+        self.assertTrue(
+            fingerprints_match(get_fingerprint(self.nacl), get_fingerprint(supercell))
+        )
+
+    def test_distorted(self):
+        hcp = io.poscar.read(os.path.join(INSTALL_PATH, "io", "files", "POSCAR_HCP"))
+        distorted = hcp.copy()
+        strain = [
+            [1.001, -0.004, 0.003],
+            [0.002, 1.004, -0.003],
+            [-0.003, 0.003, 1.002],
+        ]
+        distorted.cell = hcp.cell.dot(strain)
+        shifts = [[-0.003, 0.002, 0.002], [0.003, 0.002, -0.003]]
+        for atom, shift in zip(distorted.atoms, shifts):
+            atom.coord = np.array(atom.coord) + shift
+        # spglib puts the distorted copy in Cmcm even at symprec=0.1
+        self.assertTrue(hcp.compare(distorted, tol=1e-2))
+        self.assertTrue(
+            fingerprints_match(get_fingerprint(hcp), get_fingerprint(distorted))
+        )
+        self.assertEqual(cluster_structures([hcp, distorted]), [[0, 1]])
+
+    def test_cluster(self):
+        supercell = self.nacl.copy()
+        supercell.transform([[2, 0, 0], [0, 1, 0], [0, 0, 1]])
+        structures = [self.fcc, self.nacl, self.fcc2, supercell]
+        self.assertEqual(cluster_structures(structures), [[0, 2], [1, 3]])
+        for s in structures:
+            s.fingerprint = None
+        clusters = cluster_structures(structures, processes=2)
+        self.assertEqual(clusters, [[0, 2], [1, 3]])
+
+    def test_reset(self):
+        fingerprint = self.nacl.get_fingerprint()
+        self.assertEqual(self.nacl.fingerprint, fingerprint)
+        self.nacl.atoms[0].x += 0.05
+        self.assertIsNone(self.nacl.fingerprint)
+
+
+class PotentialTestCase(TestCase):
+    def setUp(self):
+        read_elements()
+        POTENTIAL_SET_CACHE.clear()
+
+    def _potential(self, name, element):
+        return Potential.objects.create(
+            name=name, element_id=element, xc="PBE", paw=True, enmax=400, enmin=300
+        )
+
+    def test_get_set(self):
+        fe = self._potential("Fe_pv", "Fe")
+        pots = Potential.get_set("PBE", False, False, True, ["Fe_pv", "O"])
+        self.assertEqual(pots, [fe])
+        # incomplete sets are not cached, so a later import is found
+        o = self._potential("O", "O")
+        pots = Potential.get_set("PBE", False, False, True, ["Fe_pv", "O"])
+        self.assertEqual(set(pots), set([fe, o]))
+        self.assertEqual(len(POTENTIAL_SET_CACHE), 1)
@@ -2,3 +2,4 @@ from .phase import *
 from .space import *
 from .reaction import *
 from .equilibrium import *
+from .debye import *
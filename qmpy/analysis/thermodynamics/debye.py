@@ -0,0 +1,334 @@
+# qmpy/analysis/thermodynamics/debye.py
+
+"""
+Vibrational thermodynamics in the Debye model, and its quasi-harmonic
+extension, evaluated on whole temperature grids.
+
+All functions broadcast over their arguments, so many materials can be
+evaluated at many temperatures at once, e.g. with Debye temperatures of
+shape (N, 1) and temperatures of shape (M,). Energies are in eV/atom,
+entropies and heat capacities in eV/atom/K and volumes in cubic Angstroms
+per atom.
+
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "debye_function",
+    "debye_energy",
+    "debye_entropy",
+    "debye_free_energy",
+    "debye_heat_capacity",
+    "debye_temperature",
+    "QuasiHarmonic",
+]
+
+BOLTZMANN = 8.617333262e-5  # eV/K
+HBAR = 6.582119569e-16  # eV s
+AMU = 1.66053906660e-27  # kg
+EV_PER_A3_TO_GPA = 160.21766208
+
+# The Debye function is interpolated from a table of the integral of
+# z**3/(exp(z) - 1) from 0 to x, for x up to `DEBYE_XMAX`, beyond which the
+# integral is pi**4/15 to machine precision.
+DEBYE_XMAX = 50.0
+DEBYE_STEP = 0.01
+
+_debye_table = None
+
+
+def _debye_integrand(z):
+    """z**3/(exp(z) - 1) and its derivative."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        em1 = np.expm1(z)
+        f = np.where(z > 0, z ** 3 / em1, 0.0)
+        df = np.where(z > 0, 3 * z ** 2 / em1 - z ** 3 * (em1 + 1) / em1 ** 2, 0.0)
+    return f, df
+
+
+def _debye_integral(x):
+    """
+    Integral of z**3/(exp(z) - 1) from 0 to `x`, by cubic Hermite
+    interpolation of a table built on first use.
+    """
+    global _debye_table
+    if _debye_table is None:
+        z = np.arange(0, DEBYE_XMAX + DEBYE_STEP / 2, DEBYE_STEP)
+        f, df = _debye_integrand(z)
+        # trapezoid rule with the end point correction, exact to O(h**4)
+        h = DEBYE_STEP
+        steps = h / 2 * (f[1:] + f[:-1]) - h ** 2 / 12 * (df[1:] - df[:-1])
+        _debye_table = (np.concatenate([[0], np.cumsum(steps)]), f)
+    table, f = _debye_table
+
+    x = np.clip(x, 0, DEBYE_XMAX)
+    k = np.minimum((x / DEBYE_STEP).astype(int), len(table) - 2)
+    t = x / DEBYE_STEP - k
+    h00 = (1 + 2 * t) * (1 - t) ** 2
+    h10 = t * (1 - t) ** 2
+    h01 = t ** 2 * (3 - 2 * t)
+    h11 = t ** 2 * (t - 1)
+    return (
+        h00 * table[k]
+        + h10 * DEBYE_STEP * f[k]
+        + h01 * table[k + 1]
+        + h11 * DEBYE_STEP * f[k + 1]
+    )
+
+
+def debye_function(x):
+    """
+    Computes the Debye function D(x) = 3/x**3 * Integral(z**3/(exp(z) - 1),
+    0, x) of an array of `x`.
+
+    Examples::
+
+        >>> debye_function([0, 1, 10, np.inf])
+        array([1.        , 0.67441556, 0.01929577, 0.        ])
+
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        large = 3 * (np.pi ** 4 / 15) / x ** 3
+        D = np.where(x > DEBYE_XMAX, large, 3 * _debye_integral(x) / x ** 3)
+    small = 1 - 3 * x / 8 + x ** 2 / 20 - x ** 4 / 1680 + x ** 6 / 90720
+    return np.where(x < 0.5, small, D)
+
+
+def _reduced(T, theta):
+    """theta/T, infinite at T=0."""
+    T, theta = np.broadcast_arrays(
+        np.asarray(T, dtype=float), np.asarray(theta, dtype=float)
+    )
+    with np.errstate(divide="ignore"):
+        return np.where(T > 0, theta / np.where(T > 0, T, 1), np.inf)
+
+
+def _log_term(x):
+    """log(1 - exp(-x)), 0 for infinite x."""
+    with np.errstate(divide="ignore"):
+        return np.log(-np.expm1(-x))
+
+
+def debye_energy(T, theta):
+    """
+    Vibrational energy, including the zero point energy, at temperatures `T`
+    of solids with Debye temperatures `theta`.
+    """
+    T = np.asarray(T, dtype=float)
+    x = _reduced(T, theta)
+    return BOLTZMANN * (9 * np.asarray(theta) / 8.0 + 3 * T * debye_function(x))
+
+
+def debye_entropy(T, theta):
+    """
+    Vibrational entropy at temperatures `T` of solids with Debye
+    temperatures `theta`.
+    """
+    T = np.asarray(T, dtype=float)
+    x = _reduced(T, theta)
+    return BOLTZMANN * (4 * debye_function(x) - 3 * _log_term(x))
+
+
+def debye_free_energy(T, theta):
+    """
+    Vibrational (Helmholtz) free energy, including the zero point energy, at
+    temperatures `T` of solids with Debye temperatures `theta`.
+
+    Examples::
+
+        >>> T = np.linspace(0, 1000, 5)
+        >>> debye_free_energy(T, [[300], [500]]).shape
+        (2, 5)
+
+    """
+    T = np.asarray(T, dtype=float)
+    x = _reduced(T, theta)
+    thermal = np.where(np.isinf(x), 0, T * (3 * _log_term(x) - debye_function(x)))
+    return BOLTZMANN * (9 * np.asarray(theta) / 8.0 + thermal)
+
+
+def debye_heat_capacity(T, theta):
+    """
+    Heat capacity at constant volume at temperatures `T` of solids with
+    Debye temperatures `theta`. It approaches the Dulong-Petit value 3k at
+    high temperature.
+    """
+    T = np.asarray(T, dtype=float)
+    x = _reduced(T, theta)
+    with np.errstate(over="ignore", invalid="ignore"):
+        tail = np.where(x < 700, x / np.expm1(np.minimum(x, 700)), 0)
+    return 3 * BOLTZMANN * (4 * debye_function(x) - 3 * tail)
+
+
+def debye_temperature(volume, mass, bulk_modulus, shear_modulus):
+    """
+    Estimates the Debye temperature of an isotropic solid from its average
+    sound velocity.
+
+    Arguments:
+        volume: Volume per atom (cubic Angstroms).
+        mass: Average atomic mass (amu).
+        bulk_modulus, shear_modulus: Moduli (GPa), e.g. the Hill averages of
+            an elastic tensor.
+
+    Returns:
+        Debye temperature (K).
+
+    """
+    volume = np.asarray(volume, dtype=float) * 1e-30
+    density = np.asarray(mass, dtype=float) * AMU / volume
+    shear = np.asarray(shear_modulus) * 1e9
+    v_s = np.sqrt(shear / density)
+    v_l = np.sqrt((np.asarray(bulk_modulus) * 1e9 + 4 / 3.0 * shear) / density)
+    v_m = ((1 / v_l ** 3 + 2 / v_s ** 3) / 3.0) ** (-1 / 3.0)
+    return HBAR * v_m / BOLTZMANN * (6 * np.pi ** 2 / volume) ** (1 / 3.0)
+
+
+class QuasiHarmonic(object):
+    """
+    Quasi-harmonic Debye model of a solid: the free energy F(T, V) is the
+    static energy E(V) plus the Debye free energy with a volume dependent
+    Debye temperature, and its minimum over V gives the equilibrium volume
+    and the Gibbs free energy at zero pressure.
+
+    The static energies are fit with a third order Birch-Murnaghan equation
+    of state, a cubic polynomial in V**(-2/3). The Debye temperature is
+    theta(V) = theta0 * (v0/V)**gruneisen, either fit to Debye temperatures
+    given at each volume, or from `theta0` and the Gruneisen parameter
+    (by default the Slater estimate -1/6 + B'/2).
+
+    Attributes:
+        volumes, energies: Static E(V) data, per atom.
+        v0, e0, b0, b0p: Static equilibrium volume and energy, bulk modulus
+            (GPa) and its pressure derivative.
+        theta0: Debye temperature at `v0`.
+        gruneisen: Gruneisen parameter.
+
+    Examples::
+
+        >>> qh = QuasiHarmonic(volumes, energies, theta0=350)
+        >>> T = np.linspace(0, 1500, 151)
+        >>> V, G, B = qh.equilibrium(T)
+        >>> alpha = qh.thermal_expansion(T)
+        >>> corrections = qh.gibbs_correction(T)
+
+    """
+
+    def __init__(
+        self,
+        volumes,
+        energies,
+        thetas=None,
+        theta0=None,
+        gruneisen=None,
+        npoints=500,
+    ):
+        self.volumes = np.array(volumes, dtype=float)
+        self.energies = np.array(energies, dtype=float)
+        if len(self.volumes) < 4:
+            raise ValueError("At least 4 volumes are needed to fit E(V)")
+        x = self.volumes ** (-2 / 3.0)
+        self.coefficients = np.polyfit(x, self.energies, 3)
+
+        grid = np.linspace(self.volumes.min(), self.volumes.max(), npoints)
+        v0, e0, b0 = self._minimize(grid, self.static_energy(grid)[None])
+        self.v0, self.e0, self.b0 = v0[0], e0[0], b0[0]
+        if np.isnan(self.v0):
+            raise ValueError("The E(V) data has no minimum inside its range")
+        dv = 1e-3 * self.v0
+        db = self.bulk_modulus(self.v0 + dv) - self.bulk_modulus(self.v0 - dv)
+        self.b0p = -self.v0 / self.b0 * db / (2 * dv)
+
+        if thetas is not None:
+            slope, intercept = np.polyfit(np.log(self.volumes), np.log(thetas), 1)
+            self.gruneisen = -slope
+            self.theta0 = np.exp(intercept + slope * np.log(self.v0))
+        else:
+            if theta0 is None:
+                raise ValueError("Either thetas or theta0 is needed")
+            self.theta0 = float(theta0)
+            if gruneisen is None:
+                gruneisen = -1 / 6.0 + self.b0p / 2.0
+            self.gruneisen = float(gruneisen)
+        self._grid = grid
+
+    def static_energy(self, volume):
+        """Fitted static energy at `volume`."""
+        return np.polyval(self.coefficients, np.asarray(volume) ** (-2 / 3.0))
+
+    def bulk_modulus(self, volume):
+        """Static bulk modulus V d2E/dV2 (GPa) at `volume`."""
+        V = np.asarray(volume, dtype=float)
+        x = V ** (-2 / 3.0)
+        d1 = np.polyval(np.polyder(self.coefficients, 1), x)
+        d2 = np.polyval(np.polyder(self.coefficients, 2), x)
+        dx = -2 / 3.0 * V ** (-5 / 3.0)
+        d2x = 10 / 9.0 * V ** (-8 / 3.0)
+        return V * (d2 * dx ** 2 + d1 * d2x) * EV_PER_A3_TO_GPA
+
+    def debye_temperature(self, volume):
+        """Debye temperature at `volume`."""
+        return self.theta0 * (self.v0 / np.asarray(volume)) ** self.gruneisen
+
+    def free_energy(self, T, volume):
+        """
+        Free energy F(T, V), of shape (len(T), len(volume)).
+        """
+        T = np.atleast_1d(np.asarray(T, dtype=float))[:, None]
+        volume = np.atleast_1d(volume)
+        theta = self.debye_temperature(volume)[None]
+        return self.static_energy(volume)[None] + debye_free_energy(T, theta)
+
+    def _minimize(self, grid, F):
+        """
+        Minimum of each row of `F`, sampled on the volume `grid`, refined by
+        a parabola through the lowest point and its neighbors. Minima at the
+        edge of the grid are nan.
+
+        Returns:
+            (volumes, free energies, bulk moduli) of the minima.
+
+        """
+        rows = np.arange(len(F))
+        k = np.clip(np.argmin(F, axis=1), 1, len(grid) - 2)
+        edge = (np.argmin(F, axis=1) == 0) | (np.argmin(F, axis=1) == len(grid) - 1)
+        h = grid[1] - grid[0]
+        f0, f1, f2 = F[rows, k - 1], F[rows, k], F[rows, k + 1]
+        curvature = (f0 - 2 * f1 + f2) / h ** 2
+        shift = -(f2 - f0) / (2 * h) / curvature
+        volumes = grid[k] + shift
+        energies = f1 - curvature * shift ** 2 / 2
+        moduli = volumes * curvature * EV_PER_A3_TO_GPA
+        for values in [volumes, energies, moduli]:
+            values[edge] = np.nan
+        return volumes, energies, moduli
+
+    def equilibrium(self, T):
+        """
+        Equilibrium volume, Gibbs free energy (at zero pressure) and
+        isothermal bulk modulus (GPa) at each temperature of `T`. They are
+        nan where the equilibrium volume leaves the range of the E(V) data.
+        """
+        return self._minimize(self._grid, self.free_energy(T, self._grid))
+
+    def gibbs_correction(self, T):
+        """
+        Gibbs free energy at each temperature of `T` relative to the static
+        energy minimum, i.e. the correction to add to a 0 K energy.
+        """
+        return self.equilibrium(T)[1] - self.e0
+
+    def thermal_expansion(self, T):
+        """
+        Volumetric thermal expansion coefficient (1/K) at each temperature
+        of the (sorted) grid `T`.
+        """
+        T = np.asarray(T, dtype=float)
+        volumes = self.equilibrium(T)[0]
+        return np.gradient(np.log(volumes), T)
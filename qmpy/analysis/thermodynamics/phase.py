@@ -373,6 +373,56 @@ class PhaseData(object):
         pd.phases = phases
         return pd
 
+    def with_free_energies(self, free_energies, formation=True):
+        """
+        Returns a new PhaseData in which the energy of each phase includes a
+        free energy correction, e.g. the vibrational free energy at some
+        temperature from
+        :meth:`~qmpy.analysis.thermodynamics.QuasiHarmonic.gibbs_correction`.
+
+        Arguments:
+            free_energies: dict of phase name:free energy correction (eV/atom)
+            at a single temperature. Phases without a correction keep their
+            energy.
+
+        Keyword Arguments:
+            formation: If True, the phase energies are formation energies, so
+            the correction of a phase is shifted by the composition weighted
+            corrections of its elements, and applied only if all of them are
+            given. Default=True.
+
+        Examples::
+
+            >>> corrections = {'Fe':-0.05, 'O':-0.12, 'Fe2O3':-0.11}
+            >>> pd = PhaseData()
+            >>> pd.load_library('legacy.dat')
+            >>> space = PhaseSpace('Fe-O', data=pd.with_free_energies(corrections))
+
+        """
+        pd = PhaseData()
+        for phase in self.phases:
+            energy = phase.energy
+            correction = free_energies.get(phase.name)
+            if correction is not None and formation:
+                elements = [free_energies.get(elt) for elt in phase.unit_comp]
+                if None in elements:
+                    correction = None
+                else:
+                    fractions = list(phase.unit_comp.values())
+                    correction -= np.dot(fractions, elements)
+            if correction is not None:
+                energy += correction
+            new = Phase(
+                composition=phase.comp,
+                energy=energy,
+                description=phase.description,
+                stability=phase.stability,
+                name=phase.custom_name,
+            )
+            new.id = phase.id
+            pd.add_phase(new)
+        return pd
+
 
 class Phase(object):
     """
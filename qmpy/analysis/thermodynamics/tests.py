@@ -1,5 +1,7 @@
+import numpy as np
 from django.test import TestCase
 from qmpy.analysis.thermodynamics import *
+from qmpy.analysis.thermodynamics.debye import BOLTZMANN
 
 
 class PhaseTestCase(TestCase):
@@ -19,3 +21,80 @@ class PhaseTestCase(TestCase):
 class PhaseSpaceTestCase(TestCase):
     def test_create(self):
         test = PhaseSpace("Li-Fe-O", load="legacy.dat")
+
+    def test_free_energies(self):
+        pd = PhaseData()
+        pd.add_phases(
+            [
+                Phase("Fe", 0),
+                Phase("O", 0),
+                Phase("FeO", -1.0),
+                Phase("Fe3O4", -0.9),
+                Phase("Fe2O3", -1.0),
+            ]
+        )
+        stable = PhaseSpace("Fe-O", data=pd).stable
+        self.assertEqual(sorted(p.name for p in stable), ["Fe", "Fe2O3", "FeO", "O"])
+        corrections = {"Fe": -0.1, "O": -0.1, "FeO": 0.1, "Fe3O4": -0.2}
+        pd_T = pd.with_free_energies(corrections)
+        energies = dict((p.name, p.energy) for p in pd_T.phases)
+        self.assertAlmostEqual(energies["FeO"], -0.8)
+        self.assertAlmostEqual(energies["Fe3O4"], -1.0)
+        self.assertAlmostEqual(energies["Fe2O3"], -1.0)
+        self.assertAlmostEqual(energies["Fe"], 0)
+        stable = PhaseSpace("Fe-O", data=pd_T).stable
+        self.assertEqual(sorted(p.name for p in stable), ["Fe", "Fe2O3", "Fe3O4", "O"])
+
+
+class DebyeTestCase(TestCase):
+    def test_debye_function(self):
+        from scipy.integrate import quad
+
+        xs = np.array([0, 0.01, 0.3, 1, 4.2, 17, 49.99, 80])
+        integrals = [quad(lambda z: z ** 3 / np.expm1(z), 0, x)[0] for x in xs[1:]]
+        expected = np.concatenate([[1], 3 * np.array(integrals) / xs[1:] ** 3])
+        self.assertTrue(np.allclose(debye_function(xs), expected, rtol=1e-8))
+
+    def test_limits(self):
+        T = np.array([0, 1, 5000])
+        theta = np.array([[300], [600]])
+        cv = debye_heat_capacity(T, theta) / (3 * BOLTZMANN)
+        self.assertEqual(cv.shape, (2, 3))
+        self.assertTrue(np.allclose(cv[:, 0], 0))
+        self.assertTrue(np.all(cv[:, 1] < 1e-5))
+        self.assertTrue(np.allclose(cv[:, 2], 1, atol=1e-3))
+        F, E, S = [
+            f(T, theta) for f in [debye_free_energy, debye_energy, debye_entropy]
+        ]
+        self.assertTrue(np.allclose(F, E - T * S))
+        self.assertTrue(np.allclose(F[:, 0], 9 / 8.0 * BOLTZMANN * theta[:, 0]))
+
+    def test_list_input(self):
+        T = [300, 600]
+        for f in [debye_energy, debye_entropy, debye_free_energy, debye_heat_capacity]:
+            self.assertEqual(f(T, 400).shape, (2,))
+            self.assertTrue(np.allclose(f(T, 400), f(np.array(T), 400)))
+        self.assertTrue(np.allclose(debye_energy([300.0], 400), debye_energy(300, 400)))
+
+    def test_quasi_harmonic(self):
+        v0, e0, b0, b0p = 11.8, -3.7, 140 / 160.21766208, 4.5
+        volumes = np.linspace(10.5, 13.5, 11)
+        eta = (v0 / volumes) ** (2 / 3.0)
+        energies = e0 + 9 * v0 * b0 / 16 * (
+            (eta - 1) ** 3 * b0p + (eta - 1) ** 2 * (6 - 4 * eta)
+        )
+        qh = QuasiHarmonic(volumes, energies, theta0=340)
+        self.assertAlmostEqual(qh.v0, v0, places=3)
+        self.assertAlmostEqual(qh.b0, 140, places=0)
+        self.assertAlmostEqual(qh.b0p, b0p, places=1)
+
+        T = np.linspace(0, 1000, 11)
+        V, G, B = qh.equilibrium(T)
+        self.assertTrue(np.all(np.diff(V) > 0))
+        self.assertTrue(np.all(np.diff(G) < 0))
+        self.assertTrue(np.all(qh.thermal_expansion(T) > 0))
+        self.assertGreater(qh.gibbs_correction(T)[0], 0)
+
+        fit = QuasiHarmonic(volumes, energies, thetas=qh.debye_temperature(volumes))
+        self.assertAlmostEqual(fit.theta0, 340)
+        self.assertAlmostEqual(fit.gruneisen, qh.gruneisen)
@@ -187,16 +187,17 @@ class Calculation(models.Model):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
+        symmetrize = kwargs.pop("symmetrize", True)
         if self.output is not None:
             if self.entry:
                 self.output.entry = self.entry
-            self.output.save()
+            self.output.save(symmetrize=symmetrize)
             self.output = self.output
             self.composition = self.output.composition
         if self.input is not None:
             if self.entry:
                 self.input.entry = self.entry
-            self.input.save()
+            self.input.save(symmetrize=symmetrize)
             self.input = self.input
             self.composition = self.input.composition
         if self.dos is not None:
@@ -478,18 +479,16 @@ class Calculation(models.Model):
         raise NotImplementedError
 
     def get_potcar(self, distinct_by_ox=False):
-        potstr = ""
         if not distinct_by_ox:
             elts = sorted(self.input.comp.keys())
         else:
             e_o_pairs = set([(a.element_id, a.ox) for a in self.input])
             elts = sorted([p[0] for p in e_o_pairs])
 
+        pots = []
         for elt in elts:
-            pot = [p for p in self.potentials if p.element_id == elt][0]
-            potstr += pot.potcar
-            potstr += " End of Dataset\n"
-        return potstr
+            pots.append([p for p in self.potentials if p.element_id == elt][0])
+        return pot.Potential.assemble_potcar(pots)
 
     @POTCAR.setter
     def POTCAR(self, potcar):
@@ -1553,19 +1552,17 @@ class Calculation(models.Model):
         """
         Write calculation to disk
         """
-        os.system("mkdir %s 2> /dev/null" % self.path)
-        poscar = open(self.path + "/POSCAR", "w")
-        potcar = open(self.path + "/POTCAR", "w")
-        incar = open(self.path + "/INCAR", "w")
-        kpoints = open(self.path + "/KPOINTS", "w")
-        poscar.write(self.POSCAR)
-        potcar.write(self.POTCAR)
-        incar.write(self.INCAR)
-        kpoints.write(self.KPOINTS)
-        poscar.close()
-        potcar.close()
-        incar.close()
-        kpoints.close()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        files = {
+            "POSCAR": self.POSCAR,
+            "POTCAR": self.POTCAR,
+            "INCAR": self.INCAR,
+            "KPOINTS": self.KPOINTS,
+        }
+        for name, contents in list(files.items()):
+            with open(os.path.join(self.path, name), "w") as fw:
+                fw.write(contents)
 
     @property
     def estimate(self):
@@ -1655,9 +1652,6 @@ class Calculation(models.Model):
             if len(self.potentials) == len(choice):
                 return
         pot_set = POTENTIALS[choice]
-        potentials = pot.Potential.objects.filter(
-            xc=pot_set["xc"], gw=pot_set["gw"], us=pot_set["us"], paw=pot_set["paw"]
-        )
 
         for e in self.elements:
             if not e.symbol in pot_set["elements"]:
@@ -1667,7 +1661,9 @@ class Calculation(models.Model):
                 )
 
         pnames = [pot_set["elements"][e.symbol] for e in self.elements]
-        self.potentials = list(potentials.filter(name__in=pnames))
+        self.potentials = pot.Potential.get_set(
+            pot_set["xc"], pot_set["gw"], pot_set["us"], pot_set["paw"], pnames
+        )
 
     def set_magmoms(self, ordering="ferro"):
         self.input.set_magnetism(ordering)
@@ -1805,6 +1801,7 @@ class Calculation(models.Model):
         settings={},
         chgcar=None,
         wavecar=None,
+        primitive=True,
         **kwargs,
     ):
         """
@@ -1851,6 +1848,11 @@ class Calculation(models.Model):
             chgcar/wavecar:
                 Calculation, or path, indicating where to obtain an initial
                 CHGCAR/WAVECAR file for the calculation.
+
+            primitive:
+                If True, the input is converted to its primitive cell, which
+                spglib may also rotate. Set to False when the orientation of
+                the cell matters, e.g. for strained cells. Default=True.
         """
 
         if isinstance(structure, str):
@@ -1895,7 +1897,8 @@ class Calculation(models.Model):
             raise ValueError("%s configuration does not exist!" % configuration)
 
         # Convert input to primitive cell, symmetrize it
-        calc.input.make_primitive()
+        if primitive:
+            calc.input.make_primitive()
         #        calc.input.refine()
         calc.input.symmetrize()
 
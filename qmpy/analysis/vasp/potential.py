@@ -3,9 +3,16 @@ import logging
 
 import qmpy
 import qmpy.materials.element as elt
+from qmpy.utils.cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# Assembled POTCAR blobs, keyed by the ordered tuple of Potential keys
+POTCAR_CACHE = LRUCache(maxsize=512)
+
+# Potential querysets, keyed by (potential set, ordered names)
+POTENTIAL_SET_CACHE = LRUCache(maxsize=512)
+
 
 class Potential(models.Model):
     """
@@ -58,6 +65,64 @@ class Potential(models.Model):
             ident += " GW"
         return ident
 
+    @property
+    def key(self):
+        """Hashable identifier, stable across processes."""
+        if self.id is not None:
+            return self.id
+        return (self.name, self.xc, self.paw, self.us, self.gw)
+
+    @staticmethod
+    def assemble_potcar(potentials):
+        """
+        Concatenate the POTCAR contents of an ordered list of Potentials.
+
+        Assembled blobs are kept in an in-process LRU cache keyed by the
+        ordered potential list, so repeated element/potential combinations
+        only pay for the string assembly once.
+
+        Arguments:
+            potentials: ordered iterable of Potential objects.
+
+        Returns:
+            POTCAR file contents as a string.
+
+        Examples::
+
+            >>> pots = Potential.objects.filter(name__in=['Fe_pv', 'O'])
+            >>> Potential.assemble_potcar(pots)
+
+        """
+        potentials = list(potentials)
+        key = tuple(p.key for p in potentials)
+
+        def _assemble():
+            return "".join("%s End of Dataset\n" % p.potcar for p in potentials)
+
+        return POTCAR_CACHE.get_or_set(key, _assemble)
+
+    @classmethod
+    def get_set(cls, xc, gw, us, paw, names):
+        """
+        Retrieve the Potentials named `names` for a given functional and
+        potential type. Results are cached in-process, keyed by the potential
+        set and the names requested, once every name has been found, so that
+        potentials imported later are still picked up.
+
+        Returns:
+            List of Potential objects.
+
+        """
+        key = (xc, gw, us, paw, tuple(sorted(names)))
+        potentials = POTENTIAL_SET_CACHE.get(key)
+        if potentials is None:
+            potentials = list(
+                cls.objects.filter(xc=xc, gw=gw, us=us, paw=paw, name__in=names)
+            )
+            if set(names) <= set(p.name for p in potentials):
+                POTENTIAL_SET_CACHE[key] = potentials
+        return list(potentials)
+
     @classmethod
     def read_potcar(cls, potfile):
         """
@@ -0,0 +1,189 @@
+# qmpy/analysis/voronoi.py
+
+"""
+Voronoi analysis of the coordination environment of every atom in a
+structure, from a single tessellation of the structure and its periodic
+images.
+
+"""
+
+import logging
+
+import numpy as np
+import numpy.linalg as la
+from scipy.spatial import Voronoi
+
+from qmpy.analysis.nearest_neighbors import get_neighbor_list
+
+logger = logging.getLogger(__name__)
+
+
+class VoronoiAnalysis(object):
+    """
+    Voronoi cells of all atoms in a structure.
+
+    The atoms of the structure and all of their periodic images within
+    `limit` of the unit cell are tessellated once. Each face of the Voronoi
+    cell of an atom is shared with one neighbor, and is described by the
+    arrays below, which have one entry per face, sorted by atom and then by
+    distance.
+
+    Attributes:
+        structure: The :mod:`~qmpy.Structure` analyzed.
+        limit: Distance from the unit cell up to which images are included.
+        atoms: Index of the atom whose cell the face belongs to.
+        neighbors: Index of the atom on the other side of the face.
+        images: Lattice vector (in fractional coordinates) which translates
+            the neighbor into position.
+        distances: Distance from the atom to the neighbor.
+        areas: Area of the face.
+        solid_angles: Solid angle subtended by the face at the atom. The
+            solid angles of the faces of each cell add up to 4*pi.
+        vertices: List of the (ordered) vertices of each face.
+
+    Examples::
+
+        >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_BCC')
+        >>> voronoi = s.get_voronoi()
+        >>> len(voronoi.faces(0))
+        14
+        >>> voronoi.coordination_numbers
+        array([10.16060969, 10.16060969])
+
+    """
+
+    def __init__(self, structure, limit=5.0):
+        self.structure = structure
+        self.limit = limit
+        self._cell = structure.cell.copy()
+        self._coords = structure.coords.copy()
+        self._types = list(structure.atom_types)
+
+        cart = structure.cartesian_coords
+        natoms = len(cart)
+        i, j, images, distances = get_neighbor_list(structure, limit)
+        outside = images.any(axis=1)
+        extra = np.unique(np.column_stack([j[outside], images[outside]]), axis=0)
+        home = np.column_stack([np.arange(natoms), np.zeros((natoms, 3))])
+        index = np.vstack([home, extra]).astype(int)
+        points = cart[index[:, 0]] + index[:, 1:].dot(structure.cell)
+        tess = Voronoi(points)
+
+        faces = []
+        inside = np.flatnonzero((tess.ridge_points < natoms).any(axis=1))
+        for r in inside:
+            p, q = tess.ridge_points[r]
+            verts = tess.ridge_vertices[r]
+            for a, b in [(p, q), (q, p)]:
+                if a >= natoms:
+                    continue
+                if -1 in verts:
+                    logger.warning("Unbounded Voronoi cell, increase `limit`")
+                    continue
+                faces.append((a, b, verts))
+
+        self.atoms = np.array([a for a, b, verts in faces], dtype=int)
+        self.neighbors = index[[b for a, b, verts in faces], 0]
+        self.images = index[[b for a, b, verts in faces], 1:]
+        self.images -= index[self.atoms, 1:]
+        vectors = points[[b for a, b, verts in faces]] - points[self.atoms]
+        self.distances = la.norm(vectors, axis=1)
+
+        self.vertices = []
+        self.areas = np.zeros(len(faces))
+        self.solid_angles = np.zeros(len(faces))
+        for k, (a, b, verts) in enumerate(faces):
+            normal = vectors[k] / self.distances[k]
+            verts = _order_polygon(tess.vertices[verts], normal)
+            self.vertices.append(verts)
+            self.areas[k] = _polygon_area(verts, normal)
+            self.solid_angles[k] = _solid_angle(verts - points[a])
+
+        order = np.lexsort((self.distances, self.atoms))
+        for attr in ["atoms", "neighbors", "images", "distances"]:
+            setattr(self, attr, getattr(self, attr)[order])
+        self.areas = self.areas[order]
+        self.solid_angles = self.solid_angles[order]
+        self.vertices = [self.vertices[k] for k in order]
+        self._starts = np.searchsorted(self.atoms, np.arange(natoms + 1))
+
+    def is_current(self, limit=5.0):
+        """
+        Tests whether the analysis still describes its structure, with the
+        same `limit`.
+        """
+        s = self.structure
+        return (
+            limit == self.limit
+            and np.array_equal(s.cell, self._cell)
+            and np.array_equal(s.coords, self._coords)
+            and list(s.atom_types) == self._types
+        )
+
+    def faces(self, index):
+        """Indices of the faces of the Voronoi cell of atom `index`."""
+        return np.arange(self._starts[index], self._starts[index + 1])
+
+    @property
+    def volumes(self):
+        """Volume of the Voronoi cell of each atom."""
+        heights = self.distances / 2
+        volumes = np.zeros(len(self._starts) - 1)
+        np.add.at(volumes, self.atoms, self.areas * heights / 3)
+        return volumes
+
+    @property
+    def coordination_numbers(self):
+        """
+        Solid angle weighted coordination number of each atom: the sum over
+        the faces of its cell of the solid angle of the face divided by the
+        largest solid angle of any of its faces.
+        """
+        largest = np.zeros(len(self._starts) - 1)
+        np.maximum.at(largest, self.atoms, self.solid_angles)
+        weights = self.solid_angles / largest[self.atoms]
+        return np.bincount(self.atoms, weights=weights, minlength=len(largest))
+
+    def get_neighbors(self, index, min_area=0, min_solid_angle=0):
+        """
+        Returns the atoms which share a face with atom `index`, with an area
+        of at least `min_area` and a solid angle of at least
+        `min_solid_angle`. Atoms appear once for each face they share.
+        """
+        faces = self.faces(index)
+        keep = (self.areas[faces] >= min_area) & (
+            self.solid_angles[faces] >= min_solid_angle
+        )
+        atoms = self.structure.atoms
+        return [atoms[j] for j in self.neighbors[faces[keep]]]
+
+
+def _order_polygon(vertices, normal):
+    """Sorts the vertices of a planar convex polygon around its centroid."""
+    center = vertices.mean(axis=0)
+    u = vertices[0] - center
+    u /= la.norm(u)
+    v = np.cross(normal, u)
+    rel = vertices - center
+    return vertices[np.argsort(np.arctan2(rel.dot(v), rel.dot(u)))]
+
+
+def _polygon_area(vertices, normal):
+    """Area of a planar polygon with ordered `vertices`."""
+    rel = vertices - vertices.mean(axis=0)
+    crosses = np.cross(rel, np.roll(rel, -1, axis=0))
+    return abs(crosses.dot(normal).sum()) / 2
+
+
+def _solid_angle(vertices):
+    """
+    Solid angle subtended at the origin by a convex polygon with ordered
+    `vertices`, summed over a fan of triangles (Van Oosterom and Strackee).
+    """
+    a = vertices[0]
+    b, c = vertices[1:-1], vertices[2:]
+    na, nb, nc = la.norm(a), la.norm(b, axis=1), la.norm(c, axis=1)
+    numerator = abs(np.cross(b, c).dot(a))
+    denominator = na * nb * nc + b.dot(a) * nc + c.dot(a) * nb
+    denominator += (b * c).sum(axis=1) * na
+    return (2 * np.arctan2(numerator, denominator)).sum()
@@ -1,24 +1,61 @@
 #!/usr/env/bin python
 
-import itertools
+import bisect
 import numpy as np
+import numpy.linalg as la
 import logging
+from multiprocessing import Pool
 
+import qmpy
 from qmpy.data import elements
 from qmpy.utils import *
+from qmpy.analysis.symmetry.routines import get_symmetry_dataset
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# largest number of (atom, reflection) pairs whose structure factor terms are
+# held in memory at once
+MAX_TERMS = 2 ** 20
+
+
+def atomic_scattering_factors(symbols, stol):
+    """
+    Computes the atomic scattering factors of several elements at several
+    values of sin(theta)/wavelength, from the four Gaussian (Cromer-Mann)
+    fits stored with the elements.
+
+    Arguments:
+        symbols: List of E element symbols.
+        stol: Array of M values of sin(theta)/wavelength.
+
+    Returns:
+        numpy.ndarray of shape (E, M).
+
+    """
+    stol = np.asarray(stol, dtype=float)
+    if np.any(stol > 2):
+        msg = "Atomic scattering factors are not optimized for"
+        msg += " s greater than 2"
+        logger.warn(msg)
+
+    params = [elements[e]["scattering_factors"] for e in symbols]
+    a = np.array([[p["a%d" % i] for i in range(1, 5)] for p in params])
+    b = np.array([[p["b%d" % i] for i in range(1, 5)] for p in params])
+    c = np.array([p["c"] for p in params])
+    gauss = np.exp(-b[:, :, None] * stol ** 2)
+    return (a[:, :, None] * gauss).sum(axis=1) + c[:, None]
+
 
 class Peak(object):
     """
     Attributes:
-      angle (float): 
+      angle (float):
         Peak 2*theta angle in radians.
-      hkl (list): 
-        HKL indices of the peak.
-      multiplicity (int): 
+      hkl (list):
+        HKL indices of the peak, one for each family of symmetry equivalent
+        reflections which contribute to it.
+      multiplicity (int):
         Number of HKL indices which generate the peak.
 
     """
@@ -48,12 +85,10 @@ class Peak(object):
     def lp_factor(self):
         """
         Calculates the Lorentz-polarization factor.
-        
+
         http://reference.iucr.org/dictionary/Lorentz%E2%80%93polarization_correction
         """
-        num = 1 + np.cos(2 * self.angle) ** 2
-        den = np.cos(self.angle) * np.sin(self.angle) ** 2
-        return num / den
+        return lp_factor(self.angle)
 
     def calculate_intensity(self, bfactors=None, scale=None):
         intensity = self.structure_factor_squared(bfactors)
@@ -71,39 +106,19 @@ class Peak(object):
         return np.exp(-bfactor * (np.sin(self.angle) / self.xrd.wavelength) ** 2)
 
     def atomic_scattering_factor(self, element):
-        asfp = elements[element]["scattering_factors"]
         s = np.sin(self.angle) / self.xrd.wavelength
-        s2 = s * s
-        if s > 2:
-            msg = "Atomic scattering factors are not optimized for"
-            msg += " s greater than 2"
-            logger.warn(msg)
-
-        factors = [
-            asfp["a" + str(i)] * np.exp(-asfp["b" + str(i)] * s2) for i in range(1, 5)
-        ]
-        return sum(factors) + asfp["c"]
+        return atomic_scattering_factors([element], [s])[0, 0]
 
     def structure_factor_squared(self, bfactors=None):
-        if bfactors is None:
-            bfactors = [1.0 for o in self.xrd.structure.orbits]
-
-        real = 0.0
-        imag = 0.0
+        factor = self.xrd.get_structure_factors([self.hkl[0]], bfactors)[0]
+        self.real = factor.real
+        self.imag = factor.imag
+        return self.real * self.real + self.imag * self.imag
 
-        for bfactor, orbit in zip(bfactors, self.xrd.structure.orbits):
-            tf = self.thermal_factor(bfactor)
-            for site in orbit:
-                for atom in site:
-                    sf = self.atomic_scattering_factor(atom.element_id)
-                    dot = 2 * np.pi * np.dot(self.hkl[0], atom.coord)
-                    pre = sf * tf * atom.occupancy
-                    real += pre * np.cos(dot)
-                    imag += pre * np.sin(dot)
 
-        self.real = real
-        self.imag = imag
-        return real * real + imag * imag
+def lp_factor(angle):
+    """Lorentz-polarization factor at Bragg angle(s) `angle` (radians)."""
+    return (1 + np.cos(2 * angle) ** 2) / (np.cos(angle) * np.sin(angle) ** 2)
 
 
 class XRD(object):
@@ -111,18 +126,25 @@ class XRD(object):
     Container for an X-ray diffraction pattern.
 
     Attributes:
-      peaks (List): 
-        List of :mod:`~qmpy.Peak` instances.
-      measured (bool): 
+      peaks (List):
+        List of :mod:`~qmpy.Peak` instances, sorted by angle.
+      measured (bool):
         True if the XRD is a measured pattern, otherwise False.
-      min_2th (float): 
-        Minimum 2theta angle allowed. Defaults to 60 degrees.
-      max_2th (float): 
-        Maximum 2theta angle allowed. Defaults to 10 degrees.
-      wavelength (float): 
+      min_2th (float):
+        Minimum 2theta angle allowed. Defaults to 10 degrees.
+      max_2th (float):
+        Maximum 2theta angle allowed. Defaults to 60 degrees.
+      wavelength (float):
         X-ray wavelength. Defaults to 1.5418 Ang.
-      resolution (float): 
+      resolution (float):
         Minimum 2theta angle the XRD will distinguish between.
+      hkls (numpy.ndarray):
+        (F, 3) representative indices of each family of symmetry equivalent
+        reflections found by `get_peaks`.
+      multiplicities (numpy.ndarray):
+        (F,) number of reflections in each family.
+      angles (numpy.ndarray):
+        (F,) Bragg angle (theta, radians) of each family.
 
     """
 
@@ -143,21 +165,33 @@ class XRD(object):
         self.max_2th = max_2th
         self.resolution = resolution
 
+        self.hkls = np.zeros((0, 3), dtype=int)
+        self.multiplicities = np.zeros(0, dtype=int)
+        self.angles = np.zeros(0)
+        # index into `peaks` of the peak each family contributes to
+        self._peak_index = np.zeros(0, dtype=int)
+
     def add_peak(self, peak):
-        for p in self.peaks:
+        """
+        Adds `peak`, or merges it into an existing peak less than
+        `resolution` away.
+        """
+        angles = [p.two_theta for p in self.peaks]
+        i = bisect.bisect_left(angles, peak.two_theta)
+        for p in self.peaks[max(i - 1, 0) : i + 1]:
             if abs(peak.two_theta - p.two_theta) < self.resolution:
                 p.multiplicity += peak.multiplicity
-                p.hkl.append(peak.hkl)
+                p.hkl.extend(peak.hkl)
                 return
         peak.xrd = self
-        self.peaks.append(peak)
+        self.peaks.insert(i, peak)
 
     def d_thermal_factor(self, angle, bfactor):
         temp = (np.sin(angle) / self.wavelength) ** 2
         return -temp * np.exp(-bfactor * temp)
 
     def bragg_angle(self, hkl):
-        ratio = np.linalg.norm(self.structure.inv.dot(hkl)) / 2
+        ratio = la.norm(self.structure.inv.dot(hkl)) / 2
         ratio *= self.wavelength
         if ratio >= -1 and ratio <= 1:
             return np.arcsin(ratio)
@@ -166,9 +200,58 @@ class XRD(object):
         else:
             return np.pi / 2
 
+    def _atom_bfactors(self, bfactors=None):
+        """B factor of each atom, from a list of B factors for each orbit."""
+        structure = self.structure
+        values = np.ones(len(structure))
+        if bfactors is None:
+            return values
+        if getattr(structure, "orbits", None) is None:
+            structure.symmetrize()
+        index = dict((id(atom), i) for i, atom in enumerate(structure.atoms))
+        for bfactor, orbit in zip(bfactors, structure.orbits):
+            for site in orbit:
+                for atom in site:
+                    values[index[id(atom)]] = bfactor
+        return values
+
+    def get_structure_factors(self, hkls, bfactors=None):
+        """
+        Computes the structure factors of reflections `hkls`, including the
+        thermal (Debye-Waller) factor and the occupancy of each atom.
+
+        Arguments:
+          hkls (array) : (M, 3) Miller indices.
+
+        Keyword Arguments:
+          bfactors (list) : list of B factors for each atomic site, in the
+            order of the atomic orbits (see `get_intensities`).
+
+        Returns:
+          (M,) complex numpy.ndarray
+
+        """
+        structure = self.structure
+        arrays = structure.arrays
+        hkls = np.array(hkls, dtype=float).reshape(-1, 3)
+        stol = la.norm(hkls.dot(structure.inv.T), axis=1) / 2
+        form = atomic_scattering_factors(arrays.elements, stol)
+        weights = arrays.occupancies[:, None] * form[arrays.species]
+        weights *= np.exp(-np.outer(self._atom_bfactors(bfactors), stol ** 2))
+
+        factors = np.zeros(len(hkls), dtype=complex)
+        step = max(1, MAX_TERMS // max(len(arrays.coords), 1))
+        for i in range(0, len(hkls), step):
+            phases = 2 * np.pi * arrays.coords.dot(hkls[i : i + step].T)
+            terms = weights[:, i : i + step] * np.exp(1j * phases)
+            factors[i : i + step] = terms.sum(axis=0)
+        return factors
+
     def get_intensities(self, bfactors=None, scale=None):
         """
-        Loops over all peaks calculating intensity.
+        Calculates the intensity of every peak: the sum over the families of
+        reflections contributing to the peak of the squared structure factor
+        times the multiplicity, times the Lorentz-polarization factor.
 
         Keyword Arguments:
           bfactors (list) : list of B factors for each atomic site. Care must
@@ -182,62 +265,86 @@ class XRD(object):
         if not scale:
             rescale = True
             scale = 1.0
-
-        for peak in self.peaks:
-            peak.calculate_intensity(bfactors=bfactors, scale=scale)
-
+        if not self.peaks:
+            return
+
+        factors = self.get_structure_factors(self.hkls, bfactors)
+        values = abs(factors) ** 2 * self.multiplicities * lp_factor(self.angles)
+        intensities = scale * np.bincount(
+            self._peak_index, weights=values, minlength=len(self.peaks)
+        )
         if rescale:
-            m = max([p.intensity for p in self.peaks])
-            for p in self.peaks:
-                p.intensity /= m
+            intensities /= intensities.max()
+
+        first = np.searchsorted(self._peak_index, np.arange(len(self.peaks)))
+        for peak, intensity, factor in zip(self.peaks, intensities, factors[first]):
+            peak.intensity = intensity
+            peak.real = factor.real
+            peak.imag = factor.imag
 
     def get_peaks(self):
-        max_mag = 2 * np.sin(self.max_2th * np.pi / 90) / self.wavelength
-        self.structure.symmetrize()
-        rots = []
-        for r in self.structure.rotations:
-            if np.allclose(r, np.eye(3)):
-                continue
-            if not any([np.allclose(r, rr) for rr in rots]):
-                rots.append(r)
-
-        im, jm, km = [int(np.ceil(max_mag * x)) for x in self.structure.lat_params[:3]]
-
-        for h, k, l in itertools.product(
-            list(range(-im, im + 1)), list(range(-jm, jm + 1)), list(range(-km, km + 1))
-        ):
-            if [h, k, l] == [0, 0, 0]:
-                continue
-
-            mult = 1
-            hkl = np.array([h, k, l])
-            equiv = [hkl]
-            repeat = False
-            for rot in rots:
-                thkl = np.dot(rot, hkl)
-                if thkl[0] < hkl[0] - 1e-4:
-                    repeat = True
-                elif abs(thkl[0] - hkl[0]) < 1e-4:
-                    if thkl[1] < hkl[1] - 1e-4:
-                        repeat = True
-                    elif abs(thkl[1] - hkl[1]) < 1e-4:
-                        if thkl[2] < hkl[2] - 1e-4:
-                            repeat = True
-                if repeat:
-                    break
-
-                if not any([np.allclose(thkl, shkl) for shkl in equiv]):
-                    equiv.append(thkl)
-                    mult += 1
-
-            angle = self.bragg_angle(hkl)
-            two_theta = angle * 360 / np.pi
-
-            if two_theta > self.max_2th or two_theta < self.min_2th:
-                continue
-
-            peak = Peak(angle, multiplicity=mult, hkl=equiv)
-            self.add_peak(peak)
+        """
+        Finds every reflection of the structure between `min_2th` and
+        `max_2th`, groups symmetry equivalent reflections into families and
+        merges families less than `resolution` apart into peaks.
+
+        Reflections h and h' are equivalent if h' = R^T h for one of the
+        rotations R of the spacegroup (in fractional coordinates), and each
+        family is represented by its lexicographically largest member.
+
+        """
+        structure = self.structure
+        max_mag = 2 * np.sin(self.max_2th * np.pi / 360) / self.wavelength
+        bounds = np.ceil(max_mag * np.array(structure.lat_params[:3])).astype(int)
+        ranges = [np.arange(-b, b + 1) for b in bounds]
+        hkls = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        ratios = la.norm(hkls.dot(structure.inv.T), axis=1) * self.wavelength / 2
+        angles = np.arcsin(np.minimum(ratios, 1))
+        two_theta = angles * 360 / np.pi
+        keep = (ratios > 0) & (two_theta >= self.min_2th) & (two_theta <= self.max_2th)
+        hkls, angles, two_theta = hkls[keep], angles[keep], two_theta[keep]
+
+        # encode every index as one integer which orders them
+        # lexicographically, then label each reflection by the largest code of
+        # its images under the rotations
+        dataset = get_symmetry_dataset(structure)
+        if dataset:
+            rots = np.unique(np.round(dataset["rotations"]).astype(int), axis=0)
+        else:
+            rots = np.eye(3, dtype=int)[None]
+        # (with a margin for rotations found with a finite tolerance)
+        sizes = 2 * bounds + 3
+        radix = np.array([sizes[1] * sizes[2], sizes[2], 1])
+        offset = (bounds + 1).dot(radix)
+        codes = hkls.dot(rots.dot(radix).T) + offset
+        codes, first, counts = np.unique(
+            codes.max(axis=1), return_index=True, return_counts=True
+        )
+        hkls = np.column_stack(
+            [codes // radix[0], codes // radix[1] % sizes[1], codes % sizes[2]]
+        )
+        hkls -= bounds + 1
+        angles, two_theta = angles[first], two_theta[first]
+
+        order = np.lexsort((-codes, two_theta))
+        self.hkls = hkls[order]
+        self.multiplicities = counts[order]
+        self.angles = angles[order]
+        two_theta = two_theta[order]
+
+        starts = np.concatenate([[True], np.diff(two_theta) >= self.resolution])
+        self._peak_index = np.cumsum(starts) - 1
+        self.peaks = []
+        first = np.flatnonzero(starts)
+        for i, members in zip(first, np.split(np.arange(len(starts)), first[1:])):
+            peak = Peak(
+                self.angles[i],
+                multiplicity=int(self.multiplicities[members].sum()),
+                hkl=list(self.hkls[members]),
+                xrd=self,
+            )
+            self.peaks.append(peak)
 
     def plot(self):
         renderer = Renderer()
@@ -251,3 +358,260 @@ class XRD(object):
         renderer.xaxis.min = self.min_2th
         renderer.xaxis.max = self.max_2th
         return renderer
+
+
+def bin_pattern(
+    two_theta, intensities=None, min_2th=10, max_2th=60, nbins=500, width=0.3
+):
+    """
+    Converts a list of peaks (or the points of a measured, background
+    subtracted profile) into a fixed length pattern: the intensities are
+    binned linearly onto `nbins` evenly spaced 2theta values between
+    `min_2th` and `max_2th`, broadened with a Gaussian of standard deviation
+    `width` degrees and normalized to unit length.
+
+    The broadening makes the dot product of two patterns tolerant of small
+    shifts of the peaks.
+
+    Returns:
+        numpy.ndarray of shape (`nbins`,), dtype float32.
+
+    """
+    two_theta = np.asarray(two_theta, dtype=float)
+    if intensities is None:
+        intensities = np.ones(len(two_theta))
+    intensities = np.asarray(intensities, dtype=float)
+    step = (max_2th - min_2th) / (nbins - 1)
+    pad = int(np.ceil(4 * width / step))
+    size = nbins + 2 * pad + 1
+
+    x = (two_theta - min_2th) / step + pad
+    inside = (x >= 0) & (x < size - 1)
+    x, weights = x[inside], intensities[inside]
+    lower = np.floor(x).astype(int)
+    frac = x - lower
+    hist = np.bincount(lower, weights=weights * (1 - frac), minlength=size)
+    hist += np.bincount(lower + 1, weights=weights * frac, minlength=size)
+    kernel = np.exp(-((np.arange(-pad, pad + 1) * step) ** 2) / (2 * width ** 2))
+    pattern = np.convolve(hist[:-1], kernel, mode="valid")
+    return np.array(pattern / max(la.norm(pattern), 1e-12), dtype="float32")
+
+
+def get_xrd_pattern(
+    structure, min_2th=10, max_2th=60, nbins=500, width=0.3, wavelength=1.5418
+):
+    """
+    Computes the diffraction pattern of `structure` and bins it with
+    `bin_pattern`.
+    """
+    xrd = XRD(structure, wavelength=wavelength, min_2th=min_2th, max_2th=max_2th)
+    xrd.get_peaks()
+    xrd.get_intensities()
+    return bin_pattern(
+        [p.two_theta for p in xrd.peaks],
+        [p.intensity for p in xrd.peaks],
+        min_2th=min_2th,
+        max_2th=max_2th,
+        nbins=nbins,
+        width=width,
+    )
+
+
+def _get_xrd_pattern(args):
+    """Computes one pattern for `XRDIndex.from_structures`, or None."""
+    structure, kwargs = args
+    try:
+        return get_xrd_pattern(structure, **kwargs)
+    except Exception as err:
+        logger.warning("No XRD pattern for structure %s: %s", structure.id, err)
+        return None
+
+
+class XRDIndex(object):
+    """
+    Store of the binned diffraction patterns (see `get_xrd_pattern`) of many
+    structures, searched with measured peak lists or profiles for phase
+    identification.
+
+    The patterns are held as one float16 matrix, and a search is a few
+    matrix products, so the index can be built once, saved to disk and
+    queried without the database.
+
+    Attributes:
+        ids: Structure ids, numpy.ndarray of shape (N,).
+        patterns: Patterns, numpy.ndarray of shape (N, nbins).
+        settings: Dictionary of the `get_xrd_pattern` keyword arguments used
+            for every pattern.
+
+    Examples::
+
+        >>> index = XRDIndex.from_database(processes=None)
+        >>> index.save('/tmp/xrd_index.npz')
+        >>> index = XRDIndex.load('/tmp/xrd_index.npz')
+        >>> index.search([38.2, 44.4, 64.6, 77.5, 81.7], k=2)
+        [(4062, 0.8342, 0.005), (61, 0.7710, 0.0)]
+
+    """
+
+    # patterns multiplied at once during a search
+    chunk_size = 2 ** 16
+
+    def __init__(self, ids=None, patterns=None, **settings):
+        self.settings = {
+            "min_2th": 10,
+            "max_2th": 60,
+            "nbins": 500,
+            "width": 0.3,
+            "wavelength": 1.5418,
+        }
+        self.settings.update(settings)
+        self.ids = np.zeros(0, dtype="int64")
+        self.patterns = np.zeros((0, self.settings["nbins"]), dtype="float16")
+        if ids is not None:
+            self.add(ids, patterns)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, patterns):
+        """Adds the `patterns` of the structures with ids `ids`."""
+        patterns = np.array(patterns, dtype="float16").reshape(len(ids), -1)
+        self.patterns = np.vstack([self.patterns, patterns])
+        self.ids = np.append(self.ids, np.array(ids, dtype="int64"))
+
+    def search(
+        self,
+        two_theta,
+        intensities=None,
+        k=10,
+        wavelength=None,
+        max_strain=0.02,
+        nstrains=9,
+    ):
+        """
+        Finds the `k` indexed structures whose patterns best match a measured
+        list of peaks, or a measured (background subtracted) profile.
+
+        To tolerate lattice strain, the measured d-spacings are rescaled by
+        `nstrains` factors (1 + strain) for strains between -`max_strain` and
+        `max_strain`, and each structure is scored with its best match.
+
+        Arguments:
+            two_theta: Measured peak positions (or profile points), in
+                degrees.
+
+        Keyword Arguments:
+            intensities: Intensity of each peak. Default is equal intensities.
+            wavelength: Wavelength of the measurement, if different from the
+                wavelength of the index.
+
+        Returns:
+            List of (structure id, similarity, strain), most similar first,
+            where similarity is between 0 and 1 and strain is the lattice
+            strain of the measured sample relative to the structure.
+
+        """
+        settings = self.settings
+        wavelength = wavelength or settings["wavelength"]
+        d = wavelength / (2 * np.sin(np.asarray(two_theta) * np.pi / 360))
+        strains = np.linspace(-max_strain, max_strain, nstrains)
+        queries = []
+        for strain in strains:
+            ratio = settings["wavelength"] / (2 * d / (1 + strain))
+            angles = np.arcsin(np.minimum(ratio, 1)) * 360 / np.pi
+            queries.append(
+                bin_pattern(
+                    angles,
+                    intensities,
+                    min_2th=settings["min_2th"],
+                    max_2th=settings["max_2th"],
+                    nbins=settings["nbins"],
+                    width=settings["width"],
+                )
+            )
+        queries = np.array(queries).T
+
+        scores = np.zeros(len(self))
+        best = np.zeros(len(self), dtype=int)
+        for i in range(0, len(self), self.chunk_size):
+            block = self.patterns[i : i + self.chunk_size].astype("float32")
+            values = block.dot(queries)
+            best[i : i + self.chunk_size] = values.argmax(axis=1)
+            scores[i : i + self.chunk_size] = values.max(axis=1)
+
+        k = min(k, len(scores))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            (int(self.ids[i]), float(scores[i]), float(strains[best[i]])) for i in top
+        ]
+
+    def save(self, path):
+        """Writes the index to the compressed .npz file `path`."""
+        # through a file, so np.savez_compressed does not append .npz to the path
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f, ids=self.ids, patterns=self.patterns, **self.settings
+            )
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by `save`."""
+        data = np.load(path)
+        keys = set(data.files) - set(["ids", "patterns"])
+        settings = dict((key, data[key].item()) for key in keys)
+        return cls(data["ids"], data["patterns"], **settings)
+
+    @classmethod
+    def from_structures(cls, structures, processes=1, **settings):
+        """
+        Builds an index of a list of structures, using their ids.
+
+        Keyword Arguments:
+            processes:
+                Number of worker processes. If None, uses all available cpus.
+                Default=1
+            **settings: `get_xrd_pattern` keyword arguments.
+
+        """
+        index = cls(**settings)
+        structures = list(structures)
+        if processes != 1 and len(structures) > 1:
+            with Pool(processes) as pool:
+                index._extend(structures, pool)
+        else:
+            index._extend(structures)
+        return index
+
+    @classmethod
+    def from_database(cls, structures=None, processes=1, batch_size=500, **settings):
+        """
+        Builds an index of `structures` (a Structure QuerySet, by default all
+        structures). Structures are loaded `batch_size` at a time, and their
+        patterns are computed in parallel worker processes, which never
+        query the database. Structures whose pattern can't be computed are
+        skipped.
+        """
+        if structures is None:
+            structures = qmpy.Structure.objects.all()
+        index = cls(**settings)
+        ids = list(structures.values_list("id", flat=True))
+        pool = Pool(processes) if processes != 1 else None
+        try:
+            for i in range(0, len(ids), batch_size):
+                batch = structures.model.objects.load_many(ids[i : i + batch_size])
+                index._extend(batch, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return index
+
+    def _extend(self, structures, pool=None):
+        """Computes and adds the patterns of `structures`, in `pool` if given."""
+        tasks = [(s, self.settings) for s in structures]
+        patterns = list((pool.map if pool else map)(_get_xrd_pattern, tasks))
+        found = [i for i, p in enumerate(patterns) if p is not None]
+        self.add([structures[i].id for i in found], [patterns[i] for i in found])
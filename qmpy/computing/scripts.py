@@ -552,3 +552,54 @@ def hybrid(entry, **kwargs):
         )
         calcs.append(calc)
     return calcs
+
+
+def elastic(entry, magnitudes=(-0.01, -0.005, 0.005, 0.01), **kwargs):
+    """
+    Start fixed cell calculations of the symmetry-inequivalent deformations
+    of the relaxed structure (see :func:`qmpy.analysis.elastic.get_deformations`),
+    and fit the elastic tensor once they have all converged.
+
+    Arguments:
+        entry:
+            Entry, structure to be strained
+
+    Keyword Arguments:
+        magnitudes:
+            Sequence of strain magnitudes applied to each strain state.
+        kwargs:
+            Settings passed to calculation object
+
+    Output:
+        ElasticTensor, or list of the unconverged Calculations
+    """
+    from qmpy.analysis.elastic import ElasticTensor, get_deformations
+
+    calc = relaxation(entry, **kwargs)
+    if not calc.converged:
+        return calc
+
+    reference = calc.output
+    calcs = []
+    deformations = get_deformations(reference, magnitudes=magnitudes)
+    for i, (strain, deformed) in enumerate(deformations):
+        label = "elastic_%d" % i
+        if entry.calculations.get(label, Calculation()).converged:
+            calcs.append(entry.calculations[label])
+            continue
+        calc = Calculation.setup(
+            deformed,
+            entry=entry,
+            configuration="relax_fix_vol",
+            path=os.path.join(entry.path, label),
+            primitive=False,
+            **kwargs,
+        )
+        entry.calculations[label] = calc
+        if not calc.converged:
+            calc.write()
+        calcs.append(calc)
+
+    if not all(c.converged for c in calcs):
+        return [c for c in calcs if not c.converged]
+    return ElasticTensor.from_calculations(reference, calcs)
@@ -152,6 +152,40 @@ class DictModel(models.Model):
         return list(self.data.items())
 
 
+def bulk_insert(model, objs, **filters):
+    """
+    Inserts unsaved instances of `model` with a single `bulk_create` and
+    assigns their primary keys.
+
+    Backends which cannot return ids from a bulk insert (MySQL, sqlite) get
+    them with one additional query: the newest len(`objs`) rows matching
+    `filters`, which must select the inserted rows and otherwise only rows
+    created before them.
+
+    Examples::
+
+        >>> sites = [Site(x=0, y=0, z=0, structure=s)]
+        >>> bulk_insert(Site, sites, structure=s)
+        >>> sites[0].id
+        1
+
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    model.objects.bulk_create(objs)
+    if objs[0].pk is None:
+        ids = model.objects.filter(**filters).order_by("-pk")
+        ids = list(ids.values_list("pk", flat=True)[: len(objs)])
+        if len(ids) != len(objs):
+            raise RuntimeError("Could not find the rows inserted for %s" % model)
+        for obj, pk in zip(objs, reversed(ids)):
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = model.objects.db
+    return objs
+
+
 def sync_database():
     print("This will download a *very* large database.")
     ans = input("  Are you sure you want to proceed? (y/n) [n]: ")
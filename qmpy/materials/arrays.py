@@ -0,0 +1,432 @@
+# qmpy/materials/arrays.py
+
+"""
+Contiguous array representation of the atoms in a Structure.
+
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+import qmpy
+from .atom import Atom
+
+# Layout of packed geometries: (format version, number of atoms, length of
+# the element list), followed by the space separated element symbols and the
+# zlib compressed arrays in `PACKED_FIELDS` order.
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<BIH")
+PACKED_FIELDS = [
+    ("coords", "<f8", 3),
+    ("species", "<i2", 1),
+    ("ox", "<f8", 1),
+    ("occupancies", "<f8", 1),
+    ("magmoms", "<f8", 1),
+    ("forces", "<f8", 3),
+    ("charges", "<f8", 1),
+    ("ids", "<i8", 1),
+    ("site_ids", "<i8", 1),
+]
+
+
+class AtomArrays(object):
+    """
+    Per-atom data of a structure held as contiguous NumPy arrays.
+
+    A Structure builds one of these in a single pass over its Atoms and
+    returns views of it from `coords`, `magmoms`, `forces`, etc. until an
+    atom is modified. It can also be created directly (e.g. by a bulk loader)
+    and turned into Atoms only when they are needed for ORM persistence.
+
+    Attributes:
+        | coords: (N, 3) fractional coordinates.
+        | elements: List of element symbols; `species` indexes into it.
+        | species: (N,) integer indices into `elements`.
+        | ox: (N,) oxidation states (nan if unset).
+        | occupancies: (N,) site occupation fractions.
+        | magmoms: (N,) magnetic moments (nan if unset).
+        | forces: (N, 3) forces (nan if unset).
+        | charges: (N,) charges (nan if unset).
+        | ids: (N,) primary keys of the Atoms (-1 if unsaved).
+        | site_ids: (N,) primary keys of the Atoms' Sites (-1 if unsaved).
+
+    Examples::
+
+        >>> arr = AtomArrays([[0,0,0], [0.5,0.5,0.5]], ['Cs', 'Cl'], [0, 1])
+        >>> arr.symbols
+        array(['Cs', 'Cl'], dtype='<U2')
+
+    """
+
+    fields = [
+        "coords",
+        "species",
+        "ox",
+        "occupancies",
+        "magmoms",
+        "forces",
+        "charges",
+        "ids",
+        "site_ids",
+    ]
+
+    # Atom columns expected by `from_rows`, in order.
+    columns = (
+        "id",
+        "site_id",
+        "element_id",
+        "x",
+        "y",
+        "z",
+        "fx",
+        "fy",
+        "fz",
+        "ox",
+        "occupancy",
+        "magmom",
+        "charge",
+    )
+
+    def __init__(
+        self,
+        coords,
+        elements,
+        species,
+        ox=None,
+        occupancies=None,
+        magmoms=None,
+        forces=None,
+        charges=None,
+        ids=None,
+        site_ids=None,
+    ):
+        self.coords = np.array(coords, dtype="float64").reshape(-1, 3)
+        n = len(self.coords)
+        self.elements = list(elements)
+        self.species = np.array(species, dtype="int64").reshape(n)
+
+        def _fill(values, shape, default):
+            if values is None:
+                return np.full(shape, default, dtype="float64")
+            return np.array(values, dtype="float64").reshape(shape)
+
+        self.ox = _fill(ox, n, np.nan)
+        self.occupancies = _fill(occupancies, n, 1.0)
+        self.magmoms = _fill(magmoms, n, np.nan)
+        self.forces = _fill(forces, (n, 3), np.nan)
+        self.charges = _fill(charges, n, np.nan)
+        if ids is None:
+            self.ids = np.full(n, -1, dtype="int64")
+        else:
+            self.ids = np.array(ids, dtype="int64").reshape(n)
+        if site_ids is None:
+            self.site_ids = np.full(n, -1, dtype="int64")
+        else:
+            self.site_ids = np.array(site_ids, dtype="int64").reshape(n)
+
+    def __len__(self):
+        return len(self.coords)
+
+    @staticmethod
+    def _float(value, default):
+        return default if value is None else value
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        """
+        Collects the data of a sequence of Atoms in one pass.
+
+        Examples::
+
+            >>> s = io.read(INSTALL_PATH+'/io/files/POSCAR_FCC')
+            >>> arr = AtomArrays.from_atoms(s.atoms)
+
+        """
+        atoms = list(atoms)
+        n = len(atoms)
+        coords = np.empty((n, 3))
+        forces = np.empty((n, 3))
+        species = np.empty(n, dtype="int64")
+        ox = np.empty(n)
+        occ = np.empty(n)
+        mag = np.empty(n)
+        chg = np.empty(n)
+        ids = np.empty(n, dtype="int64")
+        site_ids = np.empty(n, dtype="int64")
+        elements = []
+        lookup = {}
+        nan = np.nan
+        f = cls._float
+        for i, a in enumerate(atoms):
+            elt = a.element_id
+            if elt not in lookup:
+                lookup[elt] = len(elements)
+                elements.append(elt)
+            species[i] = lookup[elt]
+            coords[i] = (a.x, a.y, a.z)
+            forces[i] = (f(a.fx, nan), f(a.fy, nan), f(a.fz, nan))
+            ox[i] = f(a.ox, nan)
+            occ[i] = f(a.occupancy, 1.0)
+            mag[i] = f(a.magmom, nan)
+            chg[i] = f(a.charge, nan)
+            ids[i] = f(a.id, -1)
+            site_ids[i] = f(a.site_id, -1)
+        return cls(
+            coords,
+            elements,
+            species,
+            ox=ox,
+            occupancies=occ,
+            magmoms=mag,
+            forces=forces,
+            charges=chg,
+            ids=ids,
+            site_ids=site_ids,
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Collects the data of Atoms straight from database rows, without
+        instantiating any models.
+
+        Arguments:
+            rows: Sequence of tuples of the Atom fields in `columns`.
+
+        Examples::
+
+            >>> rows = Atom.objects.filter(structure=s).values_list(
+            ...     *AtomArrays.columns)
+            >>> arr = AtomArrays.from_rows(rows)
+
+        """
+        rows = list(rows)
+        if not rows:
+            return cls(np.empty((0, 3)), [], [])
+        ids, site_ids, elts, x, y, z, fx, fy, fz, ox, occ, mag, chg = zip(*rows)
+        elements = list(dict.fromkeys(elts))
+        lookup = dict((e, i) for i, e in enumerate(elements))
+
+        # None becomes nan when converted to a float array
+        def column(values, default=None):
+            values = np.array(values, dtype="float64")
+            if default is not None:
+                values[np.isnan(values)] = default
+            return values
+
+        return cls(
+            np.array([x, y, z], dtype="float64").T,
+            elements,
+            [lookup[e] for e in elts],
+            ox=column(ox),
+            occupancies=column(occ, 1.0),
+            magmoms=column(mag),
+            forces=np.array([fx, fy, fz], dtype="float64").T,
+            charges=column(chg),
+            ids=ids,
+            site_ids=column(site_ids, -1),
+        )
+
+    def to_atoms(self):
+        """
+        Materializes a list of Atom model instances. Atoms with an id are
+        marked as loaded from the database.
+        """
+        atoms = []
+        db = Atom.objects.db
+        elements = self.elements
+        species = self.species.tolist()
+        coords = self.coords.tolist()
+        forces = self.forces.tolist()
+        occ = self.occupancies.tolist()
+        mag = self.magmoms.tolist()
+        ox = self.ox.tolist()
+        chg = self.charges.tolist()
+        ids = self.ids.tolist()
+        site_ids = self.site_ids.tolist()
+        for i in range(len(self)):
+            x, y, z = coords[i]
+            kwargs = {
+                "element_id": elements[species[i]],
+                "x": x,
+                "y": y,
+                "z": z,
+                "occupancy": occ[i],
+            }
+            if ids[i] >= 0:
+                kwargs["id"] = ids[i]
+            if site_ids[i] >= 0:
+                kwargs["site_id"] = site_ids[i]
+            if not np.isnan(ox[i]):
+                kwargs["ox"] = int(ox[i])
+            if not np.isnan(mag[i]):
+                kwargs["magmom"] = mag[i]
+            if not np.isnan(chg[i]):
+                kwargs["charge"] = chg[i]
+            if not any(np.isnan(forces[i])):
+                kwargs["fx"], kwargs["fy"], kwargs["fz"] = forces[i]
+            atom = Atom(**kwargs)
+            if ids[i] >= 0:
+                atom._state.adding = False
+                atom._state.db = db
+            atoms.append(atom)
+        return atoms
+
+    @property
+    def symbols(self):
+        """(N,) array of element symbols."""
+        return np.array(self.elements)[self.species]
+
+    @property
+    def atomic_numbers(self):
+        """(N,) array of atomic numbers."""
+        z = np.array([qmpy.elements[e]["z"] for e in self.elements], dtype="int64")
+        return z[self.species]
+
+    def copy(self):
+        new = AtomArrays.__new__(AtomArrays)
+        new.elements = list(self.elements)
+        for field in self.fields:
+            setattr(new, field, np.array(getattr(self, field)))
+        return new
+
+    def take(self, indices):
+        """New AtomArrays containing only the atoms at `indices`."""
+        new = AtomArrays.__new__(AtomArrays)
+        new.elements = list(self.elements)
+        for field in self.fields:
+            setattr(new, field, np.array(getattr(self, field)[indices]))
+        return new
+
+    def freeze(self):
+        """Marks all arrays read-only, so views cannot silently go stale."""
+        for field in self.fields:
+            getattr(self, field).flags.writeable = False
+        return self
+
+    def pack(self, cell):
+        """
+        Serializes the lattice vectors and all per-atom data into one
+        compressed binary string.
+
+        Examples::
+
+            >>> blob = s.arrays.pack(s.cell)
+            >>> cell, arr = AtomArrays.unpack(blob)
+
+        """
+        elements = " ".join(self.elements).encode()
+        body = [np.asarray(cell, dtype="<f8").tobytes()]
+        for field, dtype, width in PACKED_FIELDS:
+            values = np.ascontiguousarray(getattr(self, field), dtype=dtype)
+            body.append(values.tobytes())
+        header = PACK_HEADER.pack(PACK_VERSION, len(self), len(elements))
+        return header + elements + zlib.compress(b"".join(body))
+
+    @classmethod
+    def unpack(cls, blob):
+        """
+        Inverse of :meth:`pack`.
+
+        Returns:
+            (cell, AtomArrays) pair.
+
+        """
+        blob = bytes(blob)
+        version, n, size = PACK_HEADER.unpack_from(blob)
+        if version != PACK_VERSION:
+            raise ValueError("Unknown packed geometry version: %s" % version)
+        start = PACK_HEADER.size
+        elements = blob[start : start + size].decode().split()
+        body = zlib.decompress(blob[start + size :])
+        cell = np.frombuffer(body, dtype="<f8", count=9).reshape(3, 3)
+        offset = cell.nbytes
+        values = {}
+        for field, dtype, width in PACKED_FIELDS:
+            values[field] = np.frombuffer(
+                body, dtype=dtype, count=n * width, offset=offset
+            )
+            offset += values[field].nbytes
+        coords = values.pop("coords")
+        species = values.pop("species")
+        return np.array(cell), cls(coords, elements, species, **values)
+
+
+class SpatialHash(object):
+    """
+    Periodic cell-list index of objects by fractional coordinate.
+
+    The unit cell is divided into a grid of bins whose widths (measured
+    perpendicular to the lattice planes) are at least `width` Angstroms, so
+    every object within `width` of a point lies in the 27 bins surrounding it.
+
+    Arguments:
+        cell: 3x3 lattice vectors.
+
+    Keyword Arguments:
+        width: Minimum bin width in Angstroms. Queries are exact for distances
+        up to `width`.
+
+    Examples::
+
+        >>> index = SpatialHash(s.cell, width=0.5)
+        >>> for atom in s:
+        ...     index.insert(atom.coord, atom)
+        >>> list(index.query([0, 0, 0]))
+
+    """
+
+    def __init__(self, cell, width=0.5):
+        self.width = width
+        inv = np.linalg.inv(np.array(cell, dtype="float64"))
+        spacing = 1.0 / np.linalg.norm(inv, axis=0)
+        self.shape = np.maximum(1, np.minimum(spacing // width, 1000)).astype(int)
+        self._shape = tuple(int(n) for n in self.shape)
+        offsets = []
+        for axis in range(3):
+            if self.shape[axis] < 3:
+                offsets.append(list(range(self.shape[axis])))
+            else:
+                offsets.append([-1, 0, 1])
+        self._absolute = [self.shape[axis] < 3 for axis in range(3)]
+        self._offsets = offsets
+        self._bins = {}
+        self.count = 0
+
+    def key(self, coord):
+        nx, ny, nz = self._shape
+        x, y, z = coord
+        return (
+            int(x % 1.0 * nx) % nx,
+            int(y % 1.0 * ny) % ny,
+            int(z % 1.0 * nz) % nz,
+        )
+
+    def insert(self, coord, item):
+        self._bins.setdefault(self.key(coord), []).append(item)
+        self.count += 1
+
+    def remove(self, coord, item):
+        items = self._bins.get(self.key(coord), [])
+        for i, other in enumerate(items):
+            if other is item:
+                del items[i]
+                self.count -= 1
+                return
+
+    def query(self, coord):
+        """Yields every object in the bins neighbouring `coord`."""
+        key = self.key(coord)
+        nx, ny, nz = self._shape
+        ox, oy, oz = self._offsets
+        ax, ay, az = self._absolute
+        for i in ox:
+            i = i if ax else (key[0] + i) % nx
+            for j in oy:
+                j = j if ay else (key[1] + j) % ny
+                for k in oz:
+                    k = k if az else (key[2] + k) % nz
+                    for item in self._bins.get((i, j, k), ()):
+                        yield item
@@ -33,6 +33,25 @@ class SiteError(qmpy.qmpyBaseError):
     pass
 
 
+# Atom fields mirrored in a Structure's AtomArrays. Setting any of them marks
+# the owning structure's arrays and spatial indices as stale.
+ARRAY_FIELDS = frozenset(
+    [
+        "x",
+        "y",
+        "z",
+        "fx",
+        "fy",
+        "fz",
+        "magmom",
+        "charge",
+        "occupancy",
+        "ox",
+        "element_id",
+    ]
+)
+
+
 @total_ordering
 class Atom(models.Model):
     """
@@ -100,6 +119,13 @@ class Atom(models.Model):
     def __str__(self):
         return "%s @ %0.3g %0.3g %0.3g" % (self.element_id, self.x, self.y, self.z)
 
+    def __setattr__(self, name, value):
+        super(Atom, self).__setattr__(name, value)
+        if name in ARRAY_FIELDS:
+            owner = self.__dict__.get("_owner")
+            if owner is not None:
+                owner._atoms_changed()
+
     def __hash__(self):
         return hash(self._get_pk_val())
 
@@ -151,7 +177,7 @@ class Atom(models.Model):
 
     @coord.setter
     def coord(self, values):
-        self.x, self.y, self.z = wrap(values)
+        self.x, self.y, self.z = wrap(np.array(values, dtype="float64"))
         self._cart = None
         self._coord = None
 
@@ -437,7 +463,7 @@ class Site(models.Model):
 
     @coord.setter
     def coord(self, coord):
-        coord = wrap(coord)
+        coord = wrap(np.array(coord, dtype="float64"))
         self.x, self.y, self.z = coord
         for a in self.atoms:
             a.coord = coord
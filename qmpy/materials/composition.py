@@ -273,34 +273,16 @@ class Composition(models.Model):
     def get_similar(self):
         return Composition.objects.filter(generic=self.generic)
 
-    def find_unique(self):
-        unique = []
-        # vih
-        for e1 in self.entry_set.all():
-            for i, e2 in enumerate(unique):
-                if e1.structure == e2.structure:
-                    ind = i
-            else:
-                unique.append(e1)
-                continue
-
-            exist = unique[ind]
-            if e1.energy is None and e2.energy is None:
-                e1.duplicate_of = exist.entry
-            elif e2 is None:
-                s1.entry.duplicate_of = exist.entry
-            elif e1 is None:
-                exist.entry.duplicate_of = s1.entry
-                s1.entry.duplicate_of = None
-                unique[ind] = s1
-            elif e1 <= e2:
-                s1.entry.duplicate_of = exist.entry
-            else:
-                exist.entry.duplicate_of = s1.entry
-                s1.entry.duplicate_of = None
-                unique[ind] = s1
-
-        self.unique = dict([(s.entry, []) for s in unique])
-        for s in inputs:
-            if not s.entry.duplicate_of is None:
-                self.unique[s.entry.duplicate_of].append(s.entry)
+    def find_unique(self, tol=1e-2, processes=1):
+        """
+        Groups the entries of the composition by structure, pointing their
+        `duplicate_of` to the oldest entry of each group (see
+        :meth:`~qmpy.Entry.find_duplicates`).
+
+        Sets `Composition.unique` to a dict of unique entry: list of
+        equivalent entries, and returns it.
+        """
+        entries = self.entry_set.all()
+        groups = entries.model.find_duplicates(entries, tol=tol, processes=processes)
+        self.unique = dict((group[0], group) for group in groups)
+        return self.unique
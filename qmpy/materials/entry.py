@@ -4,6 +4,7 @@ from datetime import datetime
 import time
 import os
 import re
+from collections import defaultdict
 
 from django.db import models
 from django.db import transaction
@@ -20,6 +21,11 @@ import qmpy.io.poscar as poscar
 import qmpy.io.cif as cif
 import qmpy.computing.scripts as scripts
 import qmpy.analysis.vasp as vasp
+from qmpy.analysis.fingerprint import (
+    cluster_structures,
+    fingerprints_match,
+    parse_fingerprint,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -97,7 +103,16 @@ class Entry(models.Model):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
-        """Saves the Entry, as well as all associated objects."""
+        """
+        Saves the Entry, as well as all associated objects.
+
+        Keyword Arguments:
+            symmetrize:
+                Passed on to :meth:`Structure.save`. If False, the symmetry of
+                unsymmetrized structures is not analyzed while saving.
+
+        """
+        symmetrize = kwargs.pop("symmetrize", True)
         if not self.reference is None:
             if self.reference.id is None:
                 self.reference.save()
@@ -110,13 +125,13 @@ class Entry(models.Model):
             for k, v in list(self.structures.items()):
                 v.label = k
                 v.entry = self
-                v.save()
+                v.save(symmetrize=symmetrize)
             # self.structure_set = self.structures.values()
         if self._calculations:
             for k, v in list(self.calculations.items()):
                 v.label = k
                 v.entry = self
-                v.save()
+                v.save(symmetrize=symmetrize)
             # self.calculation_set = self.calculations.values()
         if self._elements:
             self.element_set.set(self.elements)
@@ -215,12 +230,112 @@ class Entry(models.Model):
 
     @staticmethod
     def search_by_structure(structure, tol=1e-2):
+        """
+        Returns the first Entry (by energy) of the same composition whose
+        structure matches `structure`, or None.
+
+        Only the structures whose stored fingerprint matches that of
+        `structure` are loaded and compared in full. Missing fingerprints are
+        computed and saved along the way.
+        """
         c = Composition.get(structure.comp)
-        for e in c.entries:
-            if e.structure.compare(structure, tol=tol):
+        entries = c.entries
+        if not entries:
+            return None
+        fingerprint = structure.get_fingerprint()
+        key = parse_fingerprint(fingerprint)[0]
+
+        candidates = Entry._get_structure_ids(entries, key=key)
+        missing = [sid for sid, fp in candidates.values() if not fp]
+        loaded = dict((s.id, s) for s in Structure.objects.load_many(missing))
+        for s in loaded.values():
+            s.get_fingerprint()
+        Structure.objects.bulk_update(list(loaded.values()), ["fingerprint"])
+
+        matches = []
+        for e in entries:
+            if e.id not in candidates:
+                continue
+            sid, fp = candidates[e.id]
+            fp = fp or loaded[sid].fingerprint
+            if fingerprints_match(fp, fingerprint, tol=tol):
+                matches.append((e, sid))
+        ids = [sid for e, sid in matches if sid not in loaded]
+        loaded.update((s.id, s) for s in Structure.objects.load_many(ids))
+        for e, sid in matches:
+            if loaded[sid].compare(structure, tol=tol):
                 return e
         return None
 
+    @staticmethod
+    def _get_structure_ids(entries, key=None):
+        """
+        Returns a dict of entry id: (structure id, fingerprint) for the
+        structure `Entry.structure` would return for each of `entries`. If a
+        fingerprint `key` is given, entries whose structure has a stored
+        fingerprint with a different key are left out.
+        """
+        rows = defaultdict(dict)
+        qs = Structure.objects.filter(entry__in=entries).exclude(label="")
+        for sid, eid, label, fp in qs.values_list(
+            "id", "entry_id", "label", "fingerprint"
+        ):
+            if key and fp and not fp.startswith(key + "|"):
+                sid = None
+            rows[eid][label] = (sid, fp)
+        candidates = {}
+        for e in entries:
+            for label in Entry.structure_labels:
+                if label in rows[e.id]:
+                    if rows[e.id][label][0] is not None:
+                        candidates[e.id] = rows[e.id][label]
+                    break
+        return candidates
+
+    @staticmethod
+    def find_duplicates(entries, tol=1e-2, processes=1):
+        """
+        Groups `entries` by structure (see :func:`~qmpy.cluster_structures`)
+        and points `duplicate_of` of each entry to the oldest entry of its
+        group. Changed entries and new fingerprints are saved in bulk.
+
+        Keyword Arguments:
+            tol: Tolerance passed to `cluster_structures`.
+            processes: Number of worker processes. Default=1
+
+        Returns:
+            List of lists of equivalent entries, each starting with the
+            entry the others are duplicates of.
+
+        Examples::
+
+            >>> comp = Composition.get('Fe')
+            >>> Entry.find_duplicates(comp.entry_set.all())
+            [[<Entry: 1 - Fe1>, <Entry: 7 - Fe1>], [<Entry: 3 - Fe2>]]
+
+        """
+        entries = list(entries)
+        candidates = Entry._get_structure_ids(entries)
+        entries = [e for e in entries if e.id in candidates]
+        ids = [candidates[e.id][0] for e in entries]
+        structures = Structure.objects.load_many(ids)
+        missing = [s for s in structures if not s.fingerprint]
+        clusters = cluster_structures(structures, tol=tol, processes=processes)
+
+        groups = []
+        changed = []
+        for cluster in clusters:
+            group = sorted([entries[i] for i in cluster], key=lambda e: e.id)
+            for e in group:
+                if e.duplicate_of_id != group[0].id:
+                    e.duplicate_of = group[0]
+                    changed.append(e)
+            groups.append(group)
+        with transaction.atomic():
+            Structure.objects.bulk_update(missing, ["fingerprint"], batch_size=500)
+            Entry.objects.bulk_update(changed, ["duplicate_of"], batch_size=500)
+        return groups
+
     _elements = None
 
     @property
@@ -323,23 +438,22 @@ class Entry(models.Model):
     def input(self):
         return self.structures.get("input")
 
+    # labels of the structure returned by `structure`, in order of preference
+    structure_labels = (
+        "final",
+        "relaxed",
+        "relaxation",
+        "standard",
+        "fine_relax",
+        "input",
+    )
+
     @property
     def structure(self):
-        if "final" in self.structures:
-            return self.structures["final"]
-        elif "relaxed" in self.structures:
-            return self.structures["relaxed"]
-        elif "relaxation" in self.structures:
-            return self.structures["relaxation"]
-        elif "standard" in self.structures:
-            return self.structures["standard"]
-        elif "fine_relax" in self.structures:
-            return self.structures["fine_relax"]
-        else:
-            try:
-                return self.structures["input"]
-            except KeyError:
-                return None
+        for label in self.structure_labels:
+            if label in self.structures:
+                return self.structures[label]
+        return None
 
     @input.setter
     def input(self, structure):
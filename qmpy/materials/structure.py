@@ -22,8 +22,10 @@ import qmpy
 import shutil
 from .element import Element, Species
 from .atom import Atom, Site
+from .arrays import AtomArrays, SpatialHash
 from .composition import Composition
 from qmpy.utils import *
+from qmpy.db.custom import bulk_insert
 from qmpy.utils.folder_management import change_directory
 from qmpy.data.meta_data import *
 from qmpy.analysis.symmetry import *
@@ -35,6 +37,10 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+# k-point meshes, keyed by (reciprocal lattice vector lengths, natoms, kppra)
+KPOINT_MESH_CACHE = LRUCache(maxsize=4096)
+
+
 class StructureError(Exception):
     """Structure related problem"""
 
@@ -43,6 +49,188 @@ class TMKPointsError(Exception):
     """Problem with TM k-points generation"""
 
 
+class StructureQuerySet(models.QuerySet):
+    """
+    QuerySet of Structures that can load the atoms and sites of many
+    structures at once.
+    """
+
+    def load_many(self, ids=None, batch_size=500):
+        """
+        Loads Structures along with all of their Atoms and Sites in a few
+        queries per `batch_size` structures.
+
+        The atoms are read as raw rows (or from the packed `geometry`) into
+        :mod:`~qmpy.AtomArrays`, so `coords`, `atom_types`, `magmoms`, etc. are
+        available without creating any Atom instances. Atoms and Sites are
+        only materialized when `atoms` or `sites` are accessed.
+
+        Keyword Arguments:
+            ids: Primary keys of the structures to load. If None, every
+            structure in the queryset is loaded.
+
+            batch_size: Number of structures fetched per query.
+
+        Returns:
+            list of Structures, in the order of `ids` if given.
+
+        Examples::
+
+            >>> structs = Structure.objects.load_many([1, 2, 3])
+            >>> [s.coords for s in structs]
+            >>> structs = Structure.objects.filter(label="input").load_many()
+
+        """
+        qs = self.select_related("spacegroup", "composition")
+        if ids is not None:
+            ids = list(ids)
+            found = {}
+            for i in range(0, len(ids), batch_size):
+                for s in qs.filter(id__in=ids[i : i + batch_size]):
+                    found[s.id] = s
+            structures = [found[i] for i in ids if i in found]
+        else:
+            structures = list(qs)
+
+        for i in range(0, len(structures), batch_size):
+            batch = {}
+            for s in structures[i : i + batch_size]:
+                if s.geometry:
+                    s._unpack()
+                else:
+                    batch[s.id] = s
+            if not batch:
+                continue
+            atom_rows = defaultdict(list)
+            atoms = Atom.objects.filter(structure_id__in=list(batch))
+            atoms = atoms.order_by("structure_id", "id")
+            for row in atoms.values_list("structure_id", *AtomArrays.columns):
+                atom_rows[row[0]].append(row[1:])
+            site_rows = defaultdict(dict)
+            sites = Site.objects.filter(structure_id__in=list(batch)).order_by("id")
+            for sid, pk, x, y, z, wyckoff_id in sites.values_list(
+                "structure_id", "id", "x", "y", "z", "wyckoff_id"
+            ):
+                site_rows[sid][pk] = (x, y, z, wyckoff_id)
+            for sid, structure in batch.items():
+                structure.arrays = AtomArrays.from_rows(atom_rows[sid])
+                structure._site_rows = site_rows[sid]
+        return structures
+
+    def pack_geometry(self, batch_size=500):
+        """
+        Backfills the packed `geometry` column of every structure in the
+        queryset that doesn't have one yet, from its Atom rows.
+
+        Returns:
+            Number of structures packed.
+
+        Examples::
+
+            >>> Structure.objects.filter(label="input").pack_geometry()
+            1024
+
+        """
+        ids = list(self.filter(geometry__isnull=True).values_list("id", flat=True))
+        for i in range(0, len(ids), batch_size):
+            structures = self.model.objects.load_many(ids[i : i + batch_size])
+            for s in structures:
+                s.geometry = s.pack()
+            with transaction.atomic():
+                self.model.objects.bulk_update(structures, ["geometry"])
+        return len(ids)
+
+    def update_fingerprints(self, batch_size=500):
+        """
+        Computes and stores the `fingerprint` of every structure in the
+        queryset that doesn't have one yet.
+
+        Returns:
+            Number of structures fingerprinted.
+
+        """
+        ids = self.filter(fingerprint__isnull=True).values_list("id", flat=True)
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            structures = self.model.objects.load_many(ids[i : i + batch_size])
+            for s in structures:
+                s.get_fingerprint()
+            with transaction.atomic():
+                self.model.objects.bulk_update(structures, ["fingerprint"])
+        return len(ids)
+
+    def update_pdf_fingerprints(self, batch_size=500):
+        """
+        Computes and stores the `pdf_fingerprint` of every structure in the
+        queryset that doesn't have one yet.
+
+        Returns:
+            Number of structures fingerprinted.
+
+        """
+        ids = self.filter(pdf_fingerprint__isnull=True).values_list("id", flat=True)
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            structures = self.model.objects.load_many(ids[i : i + batch_size])
+            for s in structures:
+                s.get_pdf_fingerprint()
+            with transaction.atomic():
+                self.model.objects.bulk_update(structures, ["pdf_fingerprint"])
+        return len(ids)
+
+    def assign_oxidation_states(self, batch_size=500, processes=1, **kwargs):
+        """
+        Assigns the oxidation states (see
+        :func:`~qmpy.assign_oxidation_states`) of the atoms of every structure
+        in the queryset, and stores them on the Atoms, in the packed
+        `geometry` and as the species of the structure, so that structures
+        can be filtered by them.
+
+        Keyword Arguments:
+            processes:
+                Number of worker processes. If None, uses all available cpus.
+                Default=1
+            **kwargs: Passed on to :func:`~qmpy.assign_oxidation_states`.
+
+        Returns:
+            Number of structures with a charge balanced assignment.
+
+        Examples::
+
+            >>> Structure.objects.filter(label="input").assign_oxidation_states()
+            874
+            >>> Structure.objects.filter(species_set="Fe3+").count()
+            112
+
+        """
+        ids = list(self.values_list("id", flat=True))
+        count = 0
+        species = {}
+        for i in range(0, len(ids), batch_size):
+            structures = self.model.objects.load_many(ids[i : i + batch_size])
+            results = get_oxidation_states(structures, processes=processes, **kwargs)
+            atoms, packed = [], []
+            with transaction.atomic():
+                for s, states in zip(structures, results):
+                    if states is None:
+                        continue
+                    count += 1
+                    s.oxidation_states = states
+                    for pk, ox in zip(s.arrays.ids, states):
+                        if pk >= 0:
+                            atoms.append(Atom(id=int(pk), ox=int(ox)))
+                    if s.geometry:
+                        s.geometry = s.pack()
+                        packed.append(s)
+                    names = set(map(format_species, s.atom_types, states))
+                    for name in names - set(species):
+                        species[name] = Species.get(name)
+                    s.species_set.set([species[name] for name in names])
+                Atom.objects.bulk_update(atoms, ["ox"], batch_size=batch_size)
+                self.model.objects.bulk_update(packed, ["geometry"])
+        return count
+
+
 @add_meta_data("comment")
 @add_meta_data("keyword")
 class Structure(models.Model, object):
@@ -82,6 +270,12 @@ class Structure(models.Model, object):
         | z1, z2, z3: Lattice vectors of the cell. Accessed via `cell`.
         | volume
         | volume_pa
+        | geometry: Optional packed, compressed copy of the cell and all
+        |   per-atom data (see :meth:`AtomArrays.pack`).
+        | fingerprint: Indexed structure fingerprint used to find duplicate
+        |   candidates (see :func:`~qmpy.get_fingerprint`).
+        | pdf_fingerprint: Fixed length PDF fingerprint used to find similar
+        |   structures (see :func:`~qmpy.get_pdf_fingerprint`).
         |
         | **Calculated properties**
         | delta_e: Formation energy (eV/atom)
@@ -131,6 +325,11 @@ class Structure(models.Model, object):
     z1 = models.FloatField()
     z2 = models.FloatField()
     z3 = models.FloatField()
+    geometry = models.BinaryField(blank=True, null=True, editable=False)
+    fingerprint = models.CharField(
+        max_length=255, blank=True, null=True, db_index=True
+    )
+    pdf_fingerprint = models.BinaryField(blank=True, null=True, editable=False)
 
     volume = models.FloatField(blank=True, null=True)
     volume_pa = models.FloatField(blank=True, null=True)
@@ -153,6 +352,8 @@ class Structure(models.Model, object):
     delta_e = models.FloatField(blank=True, null=True)
     meta_stability = models.FloatField(blank=True, null=True)
 
+    objects = StructureQuerySet.as_manager()
+
     _reciprocal_lattice = None
     _distinct_atoms = []
     _magmoms = []
@@ -185,6 +386,8 @@ class Structure(models.Model, object):
         return self.atoms[i]
 
     def __len__(self):
+        if self._atoms is None and self._arrays is not None:
+            return len(self._arrays)
         return len(self.atoms)
 
     @staticmethod
@@ -233,37 +436,93 @@ class Structure(models.Model, object):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
+        """
+        Saves the Structure, along with its Sites and Atoms.
+
+        New Sites and Atoms are inserted with one bulk query each, so the
+        number of queries does not grow with the number of atoms.
+
+        If `qmpy.PACK_STRUCTURES` is set, the geometry is also stored as a
+        packed blob in the `geometry` column, and rows for the Atoms and Sites
+        are only written if `qmpy.ATOM_ROWS` is set.
+
+        Keyword Arguments:
+            symmetrize:
+                If True (default) and no spacegroup is set, analyze the
+                symmetry before saving. Pass False to defer it, e.g. to a
+                later batch job.
+
+        """
+        symmetrize = kwargs.pop("symmetrize", True)
         if not self.composition:
             self.composition = Composition.get(self.comp)
+        if symmetrize and not self.spacegroup:
+            self.symmetrize()
 
         self.natoms = len(self.atoms)
         self.nsites = len(self.sites)
         self.ntypes = len(list(self.comp.keys()))
         self.get_volume()
 
+        pack = qmpy.PACK_STRUCTURES
+        atom_rows = qmpy.ATOM_ROWS or not pack
+        # a stale blob must never shadow the atoms
+        self.geometry = self.pack() if pack and not atom_rows else None
+
         super(Structure, self).save(*args, **kwargs)
 
         self.element_set.set(self.elements)
         self.species_set.set(self.species)
         self.meta_data.set(self.comment_objects + self.keyword_objects)
-
-        if not self._sites is None:
-            for s in self.sites:
-                if not s.id:
-                    s.save()
-                if not s in self.site_set.all():
-                    self.site_set.add(s)
-        if not self._atoms is None:
-            for a in self.atoms:
-                if not a.id:
-                    a.save()
-                if not a in self.atom_set.all():
-                    self.atom_set.add(a)
-        super(Structure, self).save(*args, **kwargs)
-
-        if not self.spacegroup:
-            self.symmetrize()
-        super(Structure, self).save(*args, **kwargs)
+        if atom_rows:
+            self._save_sites_and_atoms()
+            if pack:
+                # repack, now including the primary keys of the rows
+                self.geometry = self.pack()
+                Structure.objects.filter(id=self.id).update(geometry=self.geometry)
+
+    def pack(self):
+        """
+        Returns the cell and per-atom data of the structure packed into a
+        compressed binary string, as stored in `geometry`.
+        """
+        return self.arrays.pack(self.cell)
+
+    def _unpack(self):
+        """Loads `arrays` from the packed `geometry` of a saved structure."""
+        if self._arrays is None and self._atoms is None and self.geometry:
+            cell, arrays = AtomArrays.unpack(self.geometry)
+            self._set_arrays(arrays)
+
+    def _save_sites_and_atoms(self):
+        """
+        Inserts new Sites and Atoms in bulk, then points the site and
+        structure foreign keys of all of them at their current owners.
+        """
+        if self._sites is not None:
+            for site in self._sites:
+                site.structure = self
+            new = [site for site in self._sites if site.id is None]
+            bulk_insert(Site, new, structure=self)
+            self.site_set.set(self._sites)
+
+        if self._atoms is not None:
+            moved = []
+            for site in self._sites or []:
+                for atom in site._atoms or []:
+                    if atom.site_id != site.id:
+                        atom.site = site
+                        if atom.id is not None:
+                            moved.append(atom)
+            for atom in self._atoms:
+                atom.structure = self
+            new = [atom for atom in self._atoms if atom.id is None]
+            bulk_insert(Atom, new, structure=self)
+            if moved:
+                Atom.objects.bulk_update(moved, ["site"])
+            self.atom_set.set(self._atoms)
+            # rebuild the arrays on next use, with the new primary keys
+            self._arrays = None
 
     _atoms = None
 
@@ -273,7 +532,14 @@ class Structure(models.Model, object):
         List of ``Atoms`` in the structure.
         """
         if self._atoms is None:
-            if not self.id:
+            self._unpack()
+            if self._arrays is not None:
+                self._atoms = self._arrays.to_atoms()
+                for a in self._atoms:
+                    a.structure = self
+                self._sites_from_arrays()
+                self._set_arrays(self._arrays)
+            elif not self.id:
                 self._atoms = []
             else:
                 self._atoms = list(self.atom_set.all())
@@ -289,6 +555,132 @@ class Structure(models.Model, object):
         self.natoms = len(self._atoms)
         self.ntypes = len(self.comp)
 
+    _arrays = None
+    _arrays_atoms = None
+    _arrays_natoms = None
+
+    @property
+    def arrays(self):
+        """
+        :mod:`~qmpy.AtomArrays` holding the per-atom data of the structure as
+        contiguous arrays.
+
+        Built in a single pass over `atoms` and reused until an Atom is
+        modified or the atom list changes. Structures created by bulk loaders
+        may hold only arrays, in which case Atoms are materialized on first
+        access to `atoms`.
+        """
+        self._unpack()
+        arrays = self._arrays
+        if arrays is not None:
+            if self._atoms is None:
+                return arrays
+            if (
+                self._arrays_atoms is self._atoms
+                and self._arrays_natoms == len(self._atoms)
+            ):
+                return arrays
+        self._set_arrays(AtomArrays.from_atoms(self.atoms))
+        return self._arrays
+
+    @arrays.setter
+    def arrays(self, arrays):
+        self._atoms = None
+        self._sites = None
+        self._site_rows = None
+        self._set_arrays(arrays)
+
+    # {site id: (x, y, z, wyckoff_id)} of a structure loaded by `load_many`
+    _site_rows = None
+
+    def _sites_from_arrays(self):
+        """
+        Places Atoms materialized from `arrays` back onto their saved Sites.
+        """
+        rows = self._site_rows
+        db = Site.objects.db
+        sites = {}
+        if rows is not None:
+            for sid, (x, y, z, wyckoff_id) in rows.items():
+                sites[sid] = Site(id=sid, x=x, y=y, z=z, wyckoff_id=wyckoff_id)
+                sites[sid].atoms = []
+        for atom in self._atoms:
+            if atom.site_id is None:
+                continue
+            site = sites.get(atom.site_id)
+            if site is None:
+                site = Site(id=atom.site_id, x=atom.x, y=atom.y, z=atom.z)
+                site.atoms = []
+                sites[atom.site_id] = site
+            site.atoms.append(atom)
+            atom.site = site
+        for site in sites.values():
+            site.structure = self
+            site._state.adding = False
+            site._state.db = db
+        if rows is not None:
+            self._sites = list(sites.values())
+
+    def _set_arrays(self, arrays):
+        if self._atoms is not None:
+            for a in self._atoms:
+                a._owner = self
+            self._arrays_natoms = len(self._atoms)
+        self._arrays_atoms = self._atoms
+        self._arrays = arrays.freeze()
+
+    _atom_index = None
+    _site_index = None
+
+    def _atoms_changed(self):
+        """Drops the cached arrays and spatial indices after an Atom changes."""
+        self._arrays = None
+        self._atom_index = None
+        self._site_index = None
+        self.fingerprint = None
+        self.pdf_fingerprint = None
+
+    def _spatial_index(self, kind, tol=0.01):
+        """
+        :mod:`~qmpy.SpatialHash` of `atoms` (kind="atoms") or `sites`
+        (kind="sites"). Built on demand and kept current by `add_atom`.
+        """
+        if kind == "atoms":
+            items, index = self.atoms, self._atom_index
+        else:
+            items, index = self.sites, self._site_index
+        if (
+            index is None
+            or index.source is not items
+            or index.count != len(items)
+            or index.width < tol
+        ):
+            index = SpatialHash(self.cell, width=max(tol, 0.5))
+            index.source = items
+            for item in items:
+                item.structure = self
+                if item.coord is None:
+                    index.count += 1
+                    continue
+                index.insert(item.coord, item)
+            if kind == "atoms":
+                self._atom_index = index
+            else:
+                self._site_index = index
+        return index
+
+    def _update_arrays(self, field, values, write):
+        """
+        Replaces one per-atom array and writes the new values back onto any
+        materialized Atoms with `write(atom, value)`.
+        """
+        arrays = self.arrays.copy()
+        setattr(arrays, field, values)
+        if self._atoms is not None:
+            for atom, value in zip(self._atoms, values):
+                write(atom, value)
+        self._set_arrays(arrays)
+
     _abc = None
 
     @property
@@ -511,9 +903,13 @@ class Structure(models.Model, object):
         self._lat_params = None
         self._inv = None
         self._metrical_matrix = None
-        for a in self.atoms:
+        self._atom_index = None
+        self._site_index = None
+        self.fingerprint = None
+        self.pdf_fingerprint = None
+        for a in self._atoms or []:
             a._cart = None
-        for s in self.sites:
+        for s in self._sites or []:
             s._cart = None
         self._cell = None
 
@@ -539,12 +935,12 @@ class Structure(models.Model, object):
     @property
     def atomic_numbers(self):
         """List of atomic numbers, length equal to number of atoms."""
-        return np.array([atom.element.z for atom in self.atoms])
+        return self.arrays.atomic_numbers
 
     @property
     def atom_types(self):
         """List of atomic symbols, length equal to number of atoms."""
-        return np.array([atom.element_id for atom in self.atoms])
+        return self.arrays.symbols
 
     @atom_types.setter
     def atom_types(self, elements):
@@ -593,8 +989,12 @@ class Structure(models.Model, object):
         if not dataset:
             return
         self.spacegroup = Spacegroup.objects.get(pk=dataset["number"])
+        wyckoffs = {}
         for i, site in enumerate(self.sites):
-            site.wyckoff = self.spacegroup.get_site(dataset["wyckoffs"][i])
+            symbol = dataset["wyckoffs"][i]
+            if symbol not in wyckoffs:
+                wyckoffs[symbol] = self.spacegroup.get_site(symbol)
+            site.wyckoff = wyckoffs[symbol]
             site.structure = self
         counts = defaultdict(int)
         orbits = defaultdict(list)
@@ -738,7 +1138,7 @@ class Structure(models.Model, object):
         me = self.copy()
         you = other.copy()
 
-        if not set(me.elements) == set(you.elements):
+        if not set(me.comp) == set(you.comp):
             logger.debug("Structure comparison: element mismatch")
             return False
 
@@ -752,7 +1152,7 @@ class Structure(models.Model, object):
             return False
 
         # 4
-        if not Composition.get(me.comp) == Composition.get(you.comp):
+        if format_comp(reduce_comp(me.comp)) != format_comp(reduce_comp(you.comp)):
             logger.debug("Structure comparison: composition mismatch")
             return False
 
@@ -808,72 +1208,52 @@ class Structure(models.Model, object):
         # 9
         min_elt = sorted(me.comp, key=lambda x: me.comp[x])[0]
         test_atom = [a for a in me.atoms if a.element_id == min_elt][0]
-        me.coords -= test_atom.coord
+        me.coords = me.coords - test_atom.coord
 
         # get all rotational symmetries of the lattice
         test_struct = Structure()
         test_struct.cell = me.cell
         test_struct.atoms = [Atom.create("Fe", [0, 0, 0])]
-        test_struct.symmetrize()
-        rotations = test_struct.rotations
-
-        test_struct = you.copy()
+        rotations = []
+        for r in get_symmetry_dataset(test_struct)["rotations"]:
+            if not any([np.allclose(r, x) for x in rotations]):
+                rotations.append(r)
 
         eps = 2 * tol * atom_tol  # *me.volume**(1./3)
         eps2 = eps ** 2
 
+        my_types = np.array([a.element_id for a in me.atoms])
+        your_types = np.array([a.element_id for a in you.atoms])
+        same_type = your_types[:, None] == my_types[None, :]
+        anchors = np.flatnonzero(your_types == min_elt)
+
         for rot in rotations:
             # loop over all possible re-orientations of the cell
             inv = la.inv(rot)
-            test_struct.cell = rot.dot(you.cell)
-            test_struct.coords = np.array([inv.dot(c) for c in you.coords])
-            for i, atom in enumerate(you.atoms):
-                # loop over atoms
-                if atom.element_id != min_elt:
+            coords = wrap(you.coords.dot(inv.T))
+            for i in anchors:
+                # vectors from every atom to every atom of the same element
+                vecs = me._get_vectors(wrap(coords - coords[i]), me.coords)
+                d2 = (vecs ** 2).sum(axis=-1)
+                close = same_type & (abs(vecs) <= eps).all(axis=-1) & (d2 <= eps2)
+                if not close.any(axis=1).all():
                     continue
 
-                test_struct.coords -= test_struct[i].coord
-                # check if all sites have a match
-                match = True
+                # check if all sites have a match, taking the closest
+                # unmatched atom for each in turn
+                d2[~close] = np.inf
                 matches = []
-                vecs = []
-                for atom2 in test_struct:
-                    best = 1000
-                    id = None
-                    vec = None
-                    for j, atom3 in enumerate(me):
-                        if j in matches:
-                            continue
-                        if atom2.element_id != atom3.element_id:
-                            continue
-                        d = me._get_vector(atom2, atom3)
-                        if any([abs(dd) > eps for dd in d]):
-                            continue
-                        d2 = d.dot(d)
-                        if d2 > eps2:
-                            continue
-
-                        # matching case
-                        if d2 < best:
-                            best = d2
-                            id = j
-                            vec = d
-
-                    if id is None:
-                        match = False
+                for j in range(len(d2)):
+                    id = np.argmin(d2[j])
+                    if not np.isfinite(d2[j, id]):
                         break
+                    d2[:, id] = np.inf
                     matches.append(id)
-                    vecs.append(vec)
-
-                if match == False:
-                    continue
-                vecs = np.array(vecs)
-                err = np.average(vecs, 0)
-                vecs -= err
-                if all([d.dot(d) ** 0.5 < tol * atom_tol for d in vecs]):
-                    return True
-                # else:
-                #    print vecs
+                else:
+                    vecs = vecs[np.arange(len(matches)), matches]
+                    vecs -= np.average(vecs, 0)
+                    if (la.norm(vecs, axis=1) < tol * atom_tol).all():
+                        return True
 
         logger.debug("Atoms don't match.")
         return False
@@ -887,15 +1267,9 @@ class Structure(models.Model, object):
 
     def contains(self, atom, tol=0.01):
         atom.structure = self
-        for atom2 in self.atoms:
-            atom2.structure = self
+        for atom2 in self._spatial_index("atoms", tol).query(atom.coord):
             if not atom2.element_id == atom.element_id:
                 continue
-            if (
-                abs(shortest_dist(atom2, self.cell) - shortest_dist(atom, self.cell))
-                > tol
-            ):
-                continue
             d = self.get_distance(atom, atom2, limit=1)
             if not d is None:
                 if d < tol:
@@ -981,6 +1355,18 @@ class Structure(models.Model, object):
         dist -= round(dist.dot(z) / zz) * z
         return dist
 
+    def _get_vectors(self, coords1, coords2):
+        """
+        Array version of `_get_vector`: the shortest vectors from each of
+        `coords1` to each of `coords2`, of shape (len(coords1), len(coords2), 3).
+        """
+        vecs = coords2[None, :, :] - coords1[:, None, :]
+        vecs -= np.round(vecs)
+        dists = vecs.dot(self.cell)
+        for i, x in enumerate(self.cell):
+            dists -= np.round(dists.dot(x) / self.metrical_matrix[i, i])[..., None] * x
+        return dists
+
     def add_site(self, site):
         site.structure = self
         self.sites.append(site)
@@ -1001,25 +1387,38 @@ class Structure(models.Model, object):
     def add_atom(self, atom, tol=0.01):
         """
         Adds `atom` to the structure if it isn't already contained.
+
+        Duplicate detection and site assignment look up nearby atoms and sites
+        in periodic spatial indices, so each call is O(1) on average.
         """
-        if not self.atoms or not self.sites:
-            atom.structure = self
-            self._atoms = [atom]
-            site = atom.get_site()
-            self._sites = [site]
-            return
-        elif self.contains(atom, tol=tol):
-            return
-        self._atoms.append(atom)
+        if not self.atoms:
+            self._atoms = []
+            self._sites = []
+        elif self._sites is None:
+            self.get_sites()
         atom.structure = self
-        for site in self.sites:
+        atom._owner = self
+        if self.contains(atom, tol=tol):
+            return
+
+        atom_index = self._spatial_index("atoms", tol)
+        site_index = self._spatial_index("sites", tol)
+        for site in site_index.query(atom.coord):
             if self.atom_on_site(atom, site, tol=tol):
                 site.add_atom(atom, tol=tol)
                 break
-            else:
-                site = atom.get_site()
-                if not site in self._sites:
-                    self._sites.append(site)
+        else:
+            site = atom.site
+            if site is None:
+                site = Site()
+                site.coord = atom.coord
+                site.atoms = [atom]
+                atom.site = site
+            site.structure = self
+            self._sites.append(site)
+            site_index.insert(site.coord, site)
+        self._atoms.append(atom)
+        atom_index.insert(atom.coord, atom)
         self.spacegroup = None
 
     def sort(self):
@@ -1111,8 +1510,8 @@ class Structure(models.Model, object):
 
     @property
     def coords(self):
-        """numpy.ndarray of atom coordinates."""
-        return np.array([atom.coord for atom in self.atoms])
+        """numpy.ndarray of atom coordinates (read-only view)."""
+        return self.arrays.coords
 
     @property
     def site_coords(self):
@@ -1132,45 +1531,81 @@ class Structure(models.Model, object):
 
     @coords.setter
     def coords(self, coords):
-        if len(coords) != len(self.atoms):
+        if len(coords) != len(self):
             raise ValueError("%s != %s" % (len(coords), len(self)))
-        for a, c in zip(self.atoms, coords):
-            c = np.array(list(map(float, c)))
-            a.coord = wrap(c)
-            a._dist = None
+        coords = wrap(np.array(coords, dtype="float64").reshape(-1, 3))
+
+        def write(atom, coord):
+            atom.x, atom.y, atom.z = coord
+            atom._coord = None
+            atom._cart = None
+            atom._dist = None
+
+        self._update_arrays("coords", coords, write)
 
     @property
     def magmoms(self):
-        """numpy.ndarray of magnetic moments of shape (natoms,)."""
-        return np.array([atom.magmom for atom in self.atoms])
+        """
+        numpy.ndarray of magnetic moments of shape (natoms,). Unset moments
+        are 0.
+        """
+        return np.nan_to_num(self.arrays.magmoms)
 
     @magmoms.setter
     def magmoms(self, moms):
-        for mom, atom in zip(self, moms):
-            atom.magmom = mom
+        moms = np.array(moms, dtype="float64").reshape(len(self))
+
+        def write(atom, mom):
+            atom.magmom = None if np.isnan(mom) else mom
+
+        self._update_arrays("magmoms", moms, write)
 
     @property
     def cartesian_coords(self):
         """Return atomic positions in cartesian coordinates."""
-        return np.array([atom.cart_coord for atom in self.atoms])
+        return self.coords.dot(self.cell)
 
     @cartesian_coords.setter
     def cartesian_coords(self, cc):
-        for atom, coord in zip(self.atoms, cc):
-            atom.cart_coord = coord
+        self.coords = np.dot(cc, self.inv)
 
     @property
     def forces(self):
-        """numpy.ndarray of forces on atoms."""
-        forces = []
-        for atom in self.atoms:
-            forces.append(atom.forces)
-        return np.array(forces)
+        """numpy.ndarray of forces on atoms. Unset forces are nan."""
+        return self.arrays.forces
 
     @forces.setter
     def forces(self, forces):
-        for forces, atom in zip(forces, self.atoms):
-            atom.forces = force
+        forces = np.array(forces, dtype="float64").reshape(len(self), 3)
+
+        def write(atom, force):
+            atom.fx, atom.fy, atom.fz = force
+
+        self._update_arrays("forces", forces, write)
+
+    @property
+    def charges(self):
+        """numpy.ndarray of charges on atoms. Unset charges are nan."""
+        return self.arrays.charges
+
+    @property
+    def occupancies(self):
+        """numpy.ndarray of atomic occupancies."""
+        return self.arrays.occupancies
+
+    @property
+    def oxidation_states(self):
+        """numpy.ndarray of oxidation states of atoms. Unset states are nan."""
+        return self.arrays.ox
+
+    @oxidation_states.setter
+    def oxidation_states(self, states):
+        states = np.array(states, dtype="float64").reshape(len(self))
+
+        def write(atom, ox):
+            atom.ox = None if np.isnan(ox) else int(ox)
+
+        self._update_arrays("ox", states, write)
 
     @property
     def reciprocal_lattice(self):
@@ -1234,6 +1669,11 @@ class Structure(models.Model, object):
         """
         recs = self.reciprocal_lattice
         rec_mags = [norm(recs[0]), norm(recs[1]), norm(recs[2])]
+        key = (tuple(np.round(rec_mags, 8)), self.natoms, kppra)
+        kpts = KPOINT_MESH_CACHE.get(key)
+        if kpts is not None:
+            return kpts.copy()
+
         r0 = max(rec_mags)
         refr = np.array([roundclose(r / r0, 1e-2) for r in rec_mags])
         refr = np.round(refr, 4)
@@ -1250,6 +1690,7 @@ class Structure(models.Model, object):
         lower = np.product(kpts) * self.natoms - kppra
         if upper < lower:
             kpts = prev_kpts.copy()
+        KPOINT_MESH_CACHE[key] = kpts.copy()
         return kpts
 
     def copy(self):
@@ -1358,17 +1799,35 @@ class Structure(models.Model, object):
         than tol from one another are considered on the same site.
 
         """
-        if not any([a.occupancy < 1 for a in self.atoms]):
-            self._sites = [a.get_site() for a in self.atoms]
-            return self._sites
-
-        _sites = []
-        for atom in self.atoms:
-            site = atom.get_site()
+        atoms = self.atoms
+        partial = any([a.occupancy < 1 for a in atoms])
+        index = SpatialHash(self.cell, width=max(tol, 0.5))
+        self._sites = []
+        seen = set()
+        for atom in atoms:
+            atom.structure = self
+            site = atom.site
+            if site is None and partial:
+                for site2 in index.query(atom.coord):
+                    if self.atom_on_site(atom, site2, tol=tol):
+                        site = site2
+                        if not any([a is atom for a in site.atoms]):
+                            site.atoms.append(atom)
+                        atom.site = site
+                        break
+            if site is None:
+                site = Site()
+                site.coord = atom.coord
+                site.atoms = [atom]
+                atom.site = site
+            if id(site) in seen:
+                continue
+            seen.add(id(site))
             site.structure = self
-            if not any([site is site2 for site2 in _sites]):
-                _sites.append(site)
-        self._sites = _sites
+            self._sites.append(site)
+            index.insert(site.coord, site)
+        index.source = self._sites
+        self._site_index = index
         return self._sites
 
     def group_atoms_by_symmetry(self):
@@ -1421,6 +1880,25 @@ class Structure(models.Model, object):
                 return False
         return True
 
+    def get_fingerprint(self):
+        """
+        Returns the structure fingerprint (see :func:`~qmpy.get_fingerprint`),
+        computing it if it isn't stored yet.
+        """
+        if not self.fingerprint:
+            self.fingerprint = get_fingerprint(self)
+        return self.fingerprint
+
+    def get_pdf_fingerprint(self):
+        """
+        Returns the PDF fingerprint (see :func:`~qmpy.get_pdf_fingerprint`),
+        computing it if it isn't stored yet.
+        """
+        if not self.pdf_fingerprint:
+            vector = get_pdf_fingerprint(self)
+            self.pdf_fingerprint = vector.astype("<f4").tobytes()
+        return np.frombuffer(self.pdf_fingerprint, dtype="<f4")
+
     def find_nearest_neighbors(self, method="closest", tol=0.05, limit=5.0, **kwargs):
         """
         Determine the nearest neighbors for all Atoms in Structure.
@@ -1447,6 +1925,22 @@ class Structure(models.Model, object):
         )
 
     _neighbor_dict = None
+    _voronoi = None
+
+    def get_voronoi(self, limit=5.0):
+        """
+        Returns the :mod:`~qmpy.VoronoiAnalysis` of the structure, which is
+        reused until the cell or the atoms change.
+
+        Keyword Arguments:
+            limit: How far from the unit cell periodic images are included in
+            the tessellation. Default=5.0.
+
+        """
+        voronoi = self._voronoi
+        if voronoi is None or not voronoi.is_current(limit=limit):
+            self._voronoi = VoronoiAnalysis(self, limit=limit)
+        return self._voronoi
 
     @property
     def nearest_neighbor_dict(self):
@@ -1505,16 +1999,14 @@ class Structure(models.Model, object):
             struct = self.get_sublattice(elements)
             return struct.get_lattice_network()
         self.find_nearest_neighbors(**kwargs)
-        for s1 in self.sites:
-            n0 = len(pairs)
-            lp1 = LatticePoint(s1.coord)
+        points = [LatticePoint(site.coord) for site in self.sites]
+        index = dict((id(site), i) for i, site in enumerate(self.sites))
+        for i, s1 in enumerate(self.sites):
             for s2 in s1.neighbors:
-                # if a1 < a2:
-                #    continue
-                lp2 = LatticePoint(s2.coord)
-                # pairs.append((s1, s2))
-                pairs.add(frozenset([lp1, lp2]))
-        pairs = list(pairs)
+                j = index[id(s2)]
+                if i != j:
+                    pairs.add((min(i, j), max(i, j)))
+        pairs = [(points[i], points[j]) for i, j in sorted(pairs)]
 
         lattice = LatticeNetwork(pairs)
         lattice.structure = self
@@ -1642,11 +2134,14 @@ class Structure(models.Model, object):
         if cartesian:
             cv = np.array(list(map(float, np.dot(self.inv.T, cv))))
 
+        # read the site coordinates first: sites built lazily from the atoms
+        # would otherwise already include the shift
+        site_coords = self.site_coords + cv
+
         coords = self.coords + cv
         self.coords = wrap(coords)
 
-        coords = self.site_coords + cv
-        self.site_coords = coords
+        self.site_coords = site_coords
         return self
 
     def find_lattice_points_within_distance(self, distance, tol=1e-6):
@@ -1669,62 +2164,28 @@ class Structure(models.Model, object):
                 lattice_points.append([i, j, k])
         return np.vstack(lattice_points)
 
-    def find_lattice_points_by_transform(self, transform, tol=1e-6):
+    def find_lattice_points_by_transform(self, transform):
         """
         Find the lattice points contained within the transformation.
 
-        """
-        transform = np.array(transform)
-        inv_trans = la.inv(transform.T)
-        lattice_points = [None, None, None]
-
-        for i in range(3):
-            is_new = True
-            cur_vec = np.array([0, 0, 0])
-            trans_vecs = [np.array(cur_vec)]
-            lattice_points[i] = [cur_vec]
-            while is_new:
-                cur_vec[i] += 1
-                trans_vec = inv_trans.dot(cur_vec)
-                trans_vec = wrap(trans_vec)
-
-                # check for found
-                for known in trans_vecs:
-                    diff = known - trans_vec
-                    diff = wrap(diff)
-
-                    if all([abs(x) < tol for x in diff]):
-                        is_new = False
-                        break
+        The points are taken from the Hermite normal form H of `transform`:
+        since H is triangular and spans the same supercell lattice, the
+        integer vectors with 0 <= p[i] < H[i,i] are one representative of
+        each lattice point in the supercell.
 
-                if is_new:
-                    trans_vecs.append(np.array(trans_vec))
-                    lattice_points[i].append(np.array(cur_vec))
-
-        # loop over permutations of vectors
-        enough = round(la.det(transform))
-        trans_vecs = []
-        dists = []
-        for x, y, z in itertools.product(*lattice_points):
-            cur_vec = x + y + z
-            trans_vec = inv_trans.dot(cur_vec)
-            trans_vec = wrap(trans_vec)
-
-            found = False
-            for known in trans_vecs:
-                diff = known - trans_vec
-                diff = wrap(diff)
-
-                if all([abs(x) < tol or abs(abs(x) - 1) < tol for x in diff]):
-                    found = True
-                    break
+        Returns:
+            (|det(transform)|, 3) integer array of lattice points, in the
+            fractional coordinates of the current cell.
 
-            if not found:
-                trans_vecs.append(trans_vec)
-            if len(trans_vecs) == enough:
-                break
+        Examples::
+
+            >>> s.find_lattice_points_by_transform([[1,1,0],[0,1,0],[0,0,2]])
+            array([[0, 0, 0],
+                   [0, 0, 1]])
 
-        return [transform.T.dot(vec) for vec in trans_vecs]
+        """
+        diag = np.diag(hermite_normal_form(transform))
+        return np.indices(diag).reshape(3, -1).T
 
     def remove_atom(self, atom):
         ind = self.sites.index(atom.site)
@@ -1749,6 +2210,11 @@ class Structure(models.Model, object):
             >>> s.transform([[0,1,0],[1,0,0],[0,0,1]]) # swap axis 1 for 2
             >>> s2 = s.transform([2,2,2], in_place=False)
 
+        For supercells, the lattice points used are stored in
+        `lattice_points`, and `sites_by_lattice_point` and
+        `atoms_by_lattice_point` map each point to the indices of the sites
+        and atoms that were generated from it.
+
         """
 
         if not in_place:
@@ -1777,51 +2243,56 @@ class Structure(models.Model, object):
             self.cell = new_cell
             return self
 
-        # Test for simple IxJxK lattice multiplication
-        diag = True
-        for i, j in itertools.combinations(list(range(3)), r=2):
-            if i == j:
-                continue
-            if transform[i, j] != 0:
-                diag = False
-                break
-        if diag:
-            # do simple expansion
-            i = int(transform[0, 0])
-            j = int(transform[1, 1])
-            k = int(transform[2, 2])
-            points = itertools.product(list(range(i)), list(range(j)), list(range(k)))
-        else:
-            points = self.find_lattice_points_by_transform(transform)
+        new_cell = transform.dot(self.cell)
+        inv = la.inv(transform)
+
+        if not np.allclose(transform, np.round(transform)):
+            # the new cell is a sublattice of the old one: map every atom
+            # into it and let `add_atom` merge the periodic images
+            atoms = self.atoms
+            coords = wrap(self.coords.dot(inv))
+            self.cell = new_cell
+            for atom, coord in zip(atoms, coords):
+                atom.coord = coord
+                atom.site = None
+            self.atoms = atoms
+            return self
 
-        # construct the new lattice
-        cell = list(self.cell)
-        elts = list(self.atom_types)
-        new_cell = transform.dot(cell)
-        inv = la.inv(transform.T)
-        n_cells = abs(roundclose(la.det(transform)))
+        # Every (lattice point, site) pair becomes a site of the supercell,
+        # with the lattice point varying slowest.
+        points = self.find_lattice_points_by_transform(transform)
+        sites = self.sites
+        n_points, n_sites = len(points), len(sites)
+        site_coords = np.array([s.coord for s in sites], dtype="float64")
+        new_coords = (points[:, None, :] + site_coords[None, :, :]).dot(inv)
+        new_coords = wrap(new_coords.reshape(-1, 3))
+
+        # Atoms are ordered site by site, and then repeated per lattice point.
+        atom_sites = np.repeat(np.arange(n_sites), [len(s.atoms) for s in sites])
+        base = AtomArrays.from_atoms(a for s in sites for a in s.atoms)
+        n_base = len(base)
+        arrays = base.take(np.tile(np.arange(n_base), n_points))
+        lp_index = np.repeat(np.arange(n_points), n_base)
+        site_index = lp_index * n_sites + np.tile(atom_sites, n_points)
+        arrays.coords = new_coords[site_index]
+        arrays.ids[:] = -1
+        arrays.site_ids[:] = -1
 
-        sites = []
         self.lattice_points = points
         self.sites_by_lattice_point = {}
         self.atoms_by_lattice_point = {}
-        for point in points:
-            lp_sites = []
-            lp_atoms = []
-            for site in self.sites:
-                new = site.copy()
-                coord = point + site.coord
-                new.coord = inv.dot(coord)
-                new.base_site = site
-                sites.append(new)
-
-                lp_atoms += new.atoms
-                lp_sites.append(new)
-            self.sites_by_lattice_point[tuple(point)] = lp_sites
-            self.atoms_by_lattice_point[tuple(point)] = lp_atoms
+        for i, point in enumerate(points.tolist()):
+            self.sites_by_lattice_point[tuple(point)] = np.arange(
+                i * n_sites, (i + 1) * n_sites
+            )
+            self.atoms_by_lattice_point[tuple(point)] = np.arange(
+                i * n_base, (i + 1) * n_base
+            )
 
+        self.arrays = arrays
         self.cell = new_cell
-        self.sites = sites
+        self.natoms = len(arrays)
+        self.spacegroup = None
         return self
 
     t = transform
@@ -2078,11 +2549,32 @@ class Structure(models.Model, object):
         return trans
 
     def get_xrd(self, **kwargs):
-        xrd = XRD(self)
+        """
+        Computes the X-ray diffraction pattern of the structure. Keyword
+        arguments are passed to :mod:`~qmpy.XRD` (wavelength, 2theta range,
+        resolution).
+        """
+        xrd = XRD(self, **kwargs)
         xrd.get_peaks()
         xrd.get_intensities()
         return xrd
 
+    def assign_oxidation_states(self, **kwargs):
+        """
+        Sets the oxidation states of the atoms to the charge balanced ones
+        with the lowest global instability index. Keyword arguments are
+        passed to :func:`~qmpy.assign_oxidation_states`.
+
+        Returns:
+            True if a charge balanced assignment was found, otherwise False.
+
+        """
+        states = assign_oxidation_states(self, **kwargs)
+        if states is None:
+            return False
+        self.oxidation_states = states
+        return True
+
     def get_pdf(self, **kwargs):
         self.pdf = PDF(self, **kwargs)
         self.pdf.get_pair_distances()
@@ -239,12 +239,195 @@ class StructureTestCase(TestCase):
         self.assertTrue(self.becl.compare(s6, volume=True))
         self.assertTrue(self.becl.compare(s7, volume=True))
 
+    def test_arrays(self):
+        coords = self.nacl.coords
+        self.assertFalse(coords.flags.writeable)
+        self.assertIs(self.nacl.coords, coords)
+
+        # modifying an atom invalidates the cached arrays
+        self.nacl[0].coord = [0.25, 0.25, 0.25]
+        self.assertTrue(np.allclose(self.nacl.coords[0], [0.25, 0.25, 0.25]))
+
+        # unset moments read as 0, but stay unset on the Atoms
+        self.assertTrue(np.all(np.isnan(self.nacl.arrays.magmoms)))
+        self.assertFalse(self.nacl.magmoms.any())
+        atoms = self.nacl.arrays.to_atoms()
+        self.assertTrue(all(a.magmom is None for a in atoms))
+
+        self.nacl.magmoms = [1] * len(self.nacl)
+        self.assertTrue(all(a.magmom == 1 for a in self.nacl))
+        self.nacl.magmoms = [None] * len(self.nacl)
+        self.assertTrue(all(a.magmom is None for a in self.nacl))
+        self.assertTrue(
+            np.allclose(
+                self.nacl.cartesian_coords,
+                [a.coord.dot(self.nacl.cell) for a in self.nacl],
+            )
+        )
+
+        # structures can hold arrays only, and create Atoms on demand
+        new = Structure()
+        new.cell = self.nacl.cell
+        new.arrays = self.nacl.arrays.copy()
+        self.assertEqual(len(new), len(self.nacl))
+        self.assertEqual(new.comp, self.nacl.comp)
+
+    def test_add_atom(self):
+        s = Structure.create(
+            3 * np.eye(3),
+            [("Fe", [0, 0, 0]), ("Fe", [1e-4, 0, 0.99999]), ("Ni", [0.5, 0.5, 0.5])],
+        )
+        self.assertEqual(len(s), 2)
+        self.assertEqual(len(s.sites), 2)
+
+        s.add_atom(Atom.create("Co", [0.5, 0.5, 0.5], occupancy=0.5))
+        self.assertEqual(len(s), 3)
+        self.assertEqual(len(s.sites), 2)
+
+        big = self.fcc.transform([4, 4, 4], in_place=False)
+        self.assertEqual(len(big.copy()), 64 * len(self.fcc))
+
+    def test_supercell(self):
+        transform = [[2, 1, 0], [-1, 4, 1], [0, 1, 5]]
+        H = hermite_normal_form(transform)
+        self.assertTrue(np.allclose(np.tril(H, -1), 0))
+        self.assertEqual(np.prod(np.diag(H)), 43)
+
+        new = self.fcc.transform(transform, in_place=False)
+        self.assertEqual(len(new), 43 * len(self.fcc))
+        self.assertEqual(len(np.unique(new.coords.round(6), axis=0)), len(new))
+        self.assertEqual(len(new.sites), len(new))
+        self.assertEqual(len(new.sites_by_lattice_point), 43)
+        for point, inds in new.sites_by_lattice_point.items():
+            coords = new.site_coords[inds].dot(transform)
+            diff = coords - np.array(point) - self.fcc.coords
+            self.assertTrue(np.allclose(diff, np.round(diff)))
+
+    def test_save(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.fcc.copy().save()
+        counts = []
+        for size in [1, 2]:
+            s = self.fcc.transform([size, size, size], in_place=False)
+            with CaptureQueriesContext(connection) as queries:
+                s.save()
+            counts.append(len(queries))
+            self.assertEqual(s.atom_set.count(), len(s))
+            self.assertEqual(s.site_set.count(), len(s.sites))
+            self.assertTrue(all(a.site_id for a in s.atom_set.all()))
+        self.assertEqual(counts[0], counts[1])
+
+        new = Structure.objects.get(id=s.id)
+        self.assertEqual(len(new), 8 * len(self.fcc))
+        self.assertEqual(new.spacegroup_id, 225)
+
+        s.save()
+        self.assertEqual(s.atom_set.count(), len(s))
+
+        s2 = self.nacl.copy()
+        s2.save(symmetrize=False)
+        self.assertEqual(s2.spacegroup, None)
+
+    def test_load_many(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.nacl.save()
+        self.partial.save()
+        ids = [self.partial.id, self.nacl.id]
+        with CaptureQueriesContext(connection) as queries:
+            partial, nacl = Structure.objects.load_many(ids)
+            self.assertTrue(np.allclose(nacl.coords, self.nacl.coords))
+            self.assertEqual(list(partial.atom_types), list(self.partial.atom_types))
+            self.assertEqual(nacl.spacegroup_id, self.nacl.spacegroup_id)
+        self.assertEqual(len(queries), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                sorted(a.id for a in partial.atoms),
+                sorted(a.id for a in self.partial.atoms),
+            )
+            self.assertEqual(len(partial.sites), len(self.partial.sites))
+            self.assertTrue(all(s.id for s in partial.sites))
+        self.assertEqual(len(queries), 0)
+        partial.save()
+        self.assertEqual(partial.atom_set.count(), len(self.partial))
+
+    def test_packed_geometry(self):
+        cell, arrays = AtomArrays.unpack(self.partial.pack())
+        self.assertTrue(np.allclose(cell, self.partial.cell))
+        for field in ["coords", "occupancies", "magmoms"]:
+            self.assertTrue(
+                np.allclose(
+                    getattr(arrays, field),
+                    getattr(self.partial.arrays, field),
+                    equal_nan=True,
+                )
+            )
+        self.assertEqual(list(arrays.symbols), list(self.partial.atom_types))
+
+        # backfill
+        self.nacl.save()
+        self.assertEqual(Structure.objects.filter(id=self.nacl.id).pack_geometry(), 1)
+        nacl = Structure.objects.get(id=self.nacl.id)
+        self.assertTrue(nacl.geometry)
+        self.assertTrue(np.allclose(nacl.coords, self.nacl.coords))
+        self.assertEqual(sorted(a.id for a in nacl), sorted(a.id for a in self.nacl))
+
+        # packed with rows, the blob holds the primary keys of the rows
+        s = self.nacl.copy()
+        qmpy.PACK_STRUCTURES = True
+        try:
+            s.save()
+            ids = sorted((a.id, a.site_id) for a in s)
+            natoms = Atom.objects.count()
+            packed = Structure.objects.get(id=s.id)
+            (loaded,) = Structure.objects.load_many([s.id])
+            for new in [packed, loaded]:
+                self.assertEqual(sorted((a.id, a.site_id) for a in new), ids)
+                new.save()
+                self.assertEqual(Atom.objects.count(), natoms)
+                self.assertEqual(new.atom_set.count(), len(s))
+        finally:
+            qmpy.PACK_STRUCTURES = False
+        cell, arrays = AtomArrays.unpack(packed.geometry)
+        self.assertEqual(sorted(zip(arrays.ids, arrays.site_ids)), ids)
+
+        # packed only
+        qmpy.PACK_STRUCTURES, qmpy.ATOM_ROWS = True, False
+        try:
+            self.partial.save()
+        finally:
+            qmpy.PACK_STRUCTURES, qmpy.ATOM_ROWS = False, True
+        self.assertEqual(self.partial.atom_set.count(), 0)
+        (partial,) = Structure.objects.load_many([self.partial.id])
+        self.assertTrue(np.allclose(partial.coords, self.partial.coords))
+        self.assertEqual(list(partial.atom_types), list(self.partial.atom_types))
+        self.assertEqual(len(partial.sites), len(self.partial.sites))
+
     def test_compare(self):
         zns2 = self.zns.copy()
         zns2.transform([[2, -1, -1], [1, 2, 0], [0, 0, 1]])
         zns2.translate([0.41, -0.14, 0.74], cartesian=False)
         self.assertTrue(zns2, self.zns)
 
+    def test_compare_atoms(self):
+        zns2 = self.zns.copy()
+        zns2.transform([[2, 0, 0], [0, 1, 0], [0, 0, 1]])
+        vecs = zns2._get_vectors(zns2.coords, zns2.coords)
+        for i, j in [(0, 1), (1, 3), (2, 0)]:
+            vec = zns2._get_vector(zns2[i], zns2[j])
+            self.assertTrue(np.allclose(vecs[i, j], vec))
+
+        zns2.translate([0.41, -0.14, 0.74], cartesian=False)
+        self.assertTrue(self.zns.compare(zns2))
+        coords = zns2.coords.copy()
+        coords[0] += [0.05, 0, 0]
+        zns2.coords = coords
+        self.assertFalse(self.zns.compare(zns2))
+
 
 class EntryTestCase(TestCase):
     def setUp(self):
@@ -311,3 +494,17 @@ class EntryTestCase(TestCase):
         self.assertEqual(set(entry.holds), set(["partial occupancy"]))
         self.assertEqual(entry.keywords, ["solid solution"])
         # self.assertEqual(entry.duplicate_of.id, perfect.id)
+
+    def test_find_duplicates(self):
+        fcc = self.entries["POSCAR_FCC"]
+        fcc.save()
+        # saved without the duplicate check, as if from a bulk import
+        fcc2 = self.entries["POSCAR_FCC2"]
+        fcc2.duplicate_of = None
+        fcc2.save()
+        self.assertEqual(fcc2.duplicate_of, fcc2)
+
+        groups = fcc.composition.find_unique()
+        self.assertEqual(groups, {fcc: [fcc, fcc2]})
+        self.assertEqual(Entry.objects.get(id=fcc2.id).duplicate_of_id, fcc.id)
+        self.assertFalse(Structure.objects.filter(fingerprint=None).exists())
@@ -6,6 +6,7 @@ from .math import *
 from .strings import *
 from .rendering import *
 from .daemon import Daemon
+from .cache import LRUCache
 from .rest_query_parser import *
 
 
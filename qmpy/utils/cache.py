@@ -0,0 +1,91 @@
+"""qmpy.utils.cache
+
+Small in-process caches used to avoid recomputing expensive, frequently
+repeated results (assembled input files, symmetry datasets, ...).
+
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping that evicts the least recently used key
+    once `maxsize` entries are stored.
+
+    Examples::
+
+        >>> cache = LRUCache(maxsize=2)
+        >>> cache["a"] = 1
+        >>> cache["b"] = 2
+        >>> cache["a"]
+        1
+        >>> cache["c"] = 3
+        >>> "b" in cache
+        False
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def get(self, key, default=None):
+        """Return the cached value for `key` (marking it as recently used)."""
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return self[key]
+            self.misses += 1
+            return default
+
+    def get_or_set(self, key, func, *args, **kwargs):
+        """
+        Return the cached value for `key`, computing and storing
+        `func(*args, **kwargs)` on a miss.
+        """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return self[key]
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self[key] = value
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
@@ -77,6 +77,38 @@ def lcm(a, b):
     return a * b / gcd([a, b])
 
 
+def hermite_normal_form(matrix):
+    """
+    Returns the upper triangular Hermite normal form of a nonsingular integer
+    matrix. Only unimodular row operations are used, so the rows of the
+    result span the same lattice as the rows of `matrix`.
+
+    Example:
+    >>> hermite_normal_form([[1, 1, 0], [-1, 2, 1], [0, 1, 2]])
+    array([[1, 0, 3],
+           [0, 1, 2],
+           [0, 0, 5]])
+    """
+    H = np.array(np.round(matrix), dtype=int)
+    n = len(H)
+    for col in range(n):
+        while True:
+            rows = [r for r in range(col, n) if H[r, col] != 0]
+            if not rows:
+                raise ValueError("Matrix is singular")
+            pivot = min(rows, key=lambda r: abs(H[r, col]))
+            H[[col, pivot]] = H[[pivot, col]]
+            for r in range(col + 1, n):
+                H[r] -= (H[r, col] // H[col, col]) * H[col]
+            if not H[col + 1 :, col].any():
+                break
+        if H[col, col] < 0:
+            H[col] *= -1
+        for r in range(col):
+            H[r] -= (H[r, col] // H[col, col]) * H[col]
+    return H
+
+
 def ffloat(string):
     """
     In case of fortran digits overflowing and returing ********* this